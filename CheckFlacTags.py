@@ -17,16 +17,46 @@
 #   are present.  Optionally warn if the old version is used.
 # * Miscellaneous checks for reasonableness - for instance, make sure that the
 #   tracks for an album have consecutive track numbers.
+# * Optionally fix the obsolete tags, leading 'The' and missing sort tags
+#   found by the checks above, rewriting just the tag block of each file in
+#   place when it fits in the existing padding.
+# * Optionally verify the CRCs of every audio frame in each FLAC file, and
+#   that the frames hold the number of samples the file claims to have.
+# * Optionally decode the audio, and check it against the MD5 in STREAMINFO
+#   and the peaks in the ReplayGain tags.
+# * Optionally check the cover art in folder.jpg and embedded in the tracks:
+#   that it's really a JPEG, isn't a tiny placeholder scan, and that the
+#   embedded pictures match each other and folder.jpg.  Only the image headers
+#   are parsed, and the pictures are compared by hash, without decoding them.
+# * Optionally cross-check the disc layout given by the cdtoc tag and the
+#   cuesheet against the number of samples in each track, and check that the
+#   audio is in CD format.
+# * Optionally cross-check the crc and accurateripresult tags of each track
+#   against the disc's extraction log, and warn about tracks the log shows
+#   were ripped insecurely or needed re-reads (see QueryRipLogs).
 
 import argparse
 import collections
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import mutagen
+import mutagen.flac
 import os
 import re
+import shutil
 import sys
+import time
+import zlib
 
 from CommonUtils import *
 from CommonUtils import uprint as print
+import FlacFrames
+import QueryRipLogs
 
 def enum(*args):
     enums = dict(zip(args, range(len(args))))
@@ -129,9 +159,20 @@ sorted_tags = {
 test_leading_The_tags = ['artist', 'albumartist', 'composer']
 
 default_path = 'D:\\CDRip'
+default_min_cover_size = 500
+cover_lookahead = 8     # Albums whose cover art is read ahead with --cover-art
+
+cd_format = (44100, 16, 2)      # Sample rate, bits per sample and channels
+samples_per_cd_frame = 588      # 44100 samples per second / 75 frames
+session_gap_frames = 11400      # Gap before the data session of an enhanced CD
+peak_tolerance = 1e-4           # Difference allowed between a ReplayGain peak and the audio
+max_listed_unchecked = 20       # Albums left unchecked by --budget listed by name
+results_version = 1
 
 args = None
 msgs = None
+frame_executor = None   # Process pool for --verify-frames and --verify-audio
+rip_log_cache = None    # QueryRipLogs.LogCache for --rip-log
 
 album_count = 0
 disc_count = 0
@@ -139,10 +180,12 @@ track_count = 0
 warn_count = 0
 
 
-def parse_args():
+def parse_args(argv=None):
+    # Parse the command line, or the list of options in argv when the checks
+    # are being run on behalf of another script (see RearrangeAudioFiles -c).
     global args
     parser = argparse.ArgumentParser(description='Check FLAC files for tag consistency.')
-    parser.add_argument('path', nargs='*', default=[default_path],
+    parser.add_argument('path', nargs='*',
                         help='root of the tree to search for albums of FLAC files (default: %s)' % default_path)
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Show every album processed, not just ones with issues')
@@ -162,7 +205,81 @@ def parse_args():
                              "tracks of a disc, not just some")
     parser.add_argument('-t', '--tag', action='append',
                         help='Find all tracks with the given tag')
-    args = parser.parse_args()
+    parser.add_argument('-F', '--verify-frames', action='store_true',
+                        help='Verify the CRCs and sample count of every audio '
+                             'frame, to catch truncated or corrupted files')
+    parser.add_argument('-A', '--verify-audio', action='store_true',
+                        help='Decode the audio, and check it against the MD5 in '
+                             'STREAMINFO and the ReplayGain peak tags (slow, '
+                             'needs numpy)')
+    parser.add_argument('-c', '--cover-art', action='store_true',
+                        help='Check the size and format of folder.jpg and any '
+                             'embedded pictures, and that they all match')
+    parser.add_argument('--min-cover-size', type=int, default=default_min_cover_size,
+                        metavar='PX',
+                        help='Smallest width and height of cover art allowed '
+                             'with --cover-art (default: %d)' % default_min_cover_size)
+    parser.add_argument('-l', '--layout', action='store_true',
+                        help='Check track lengths against the cdtoc tag and '
+                             'cuesheet, and check the audio is CD format')
+    parser.add_argument('-R', '--rip-log', action='store_true',
+                        help='Check the crc and accurateripresult tags against '
+                             'the extraction log, and warn about insecure rips')
+    parser.add_argument('-f', '--fix', action='store_true',
+                        help='Fix obsolete tags, leading \'The\' and missing '
+                             'sort tags in place before checking each album')
+    parser.add_argument('-r', '--recent-first', action='store_true',
+                        help='Check the albums with the newest FLAC files first')
+    parser.add_argument('--since', metavar='DATE',
+                        help='Only check albums with FLAC files modified on or '
+                             'after DATE (YYYY-MM-DD, optionally followed by HH:MM)')
+    parser.add_argument('--budget', type=float, metavar='SECONDS',
+                        help="Stop starting new albums after SECONDS, and list "
+                             "the albums left unchecked")
+    parser.add_argument('--shard', metavar='i/N',
+                        help='Only check shard i (1 to N) of the albums, chosen '
+                             'by a hash of the album path under its root, and '
+                             'save the results for --merge')
+    parser.add_argument('--results', metavar='FILE',
+                        help='File to save the results in (default with --shard: '
+                             'CheckFlacTags-shard-i-of-N.json)')
+    parser.add_argument('--merge', nargs='+', metavar='FILE',
+                        help='Combine the results files saved by each shard into '
+                             'a single report, instead of checking any albums '
+                             '(album paths are shown under the given paths, if '
+                             'any, instead of the roots each shard used)')
+    parser.add_argument('--export-snapshot', metavar='FILE',
+                        help='Save a snapshot of the tags and file listings of '
+                             'the albums to FILE, for --from-snapshot, instead '
+                             'of checking them')
+    parser.add_argument('--from-snapshot', metavar='FILE',
+                        help='Check the albums saved in a snapshot instead of '
+                             'reading the disk (path defaults to the roots of '
+                             'the snapshot)')
+    args = parser.parse_args(argv)
+    if args.from_snapshot and (args.verify_frames or args.verify_audio or
+                               args.cover_art or args.rip_log or args.fix):
+        parser.error('--verify-frames, --verify-audio, --cover-art, --rip-log '
+                     'and --fix need the files themselves, not a snapshot')
+    if not args.path and not args.from_snapshot and not args.merge:
+        args.path = [default_path]
+    if args.since:
+        for date_format in ('%Y-%m-%d', '%Y-%m-%d %H:%M'):
+            try:
+                args.since = datetime.datetime.strptime(args.since, date_format).timestamp()
+                break
+            except ValueError:
+                pass
+        else:
+            parser.error("--since must be YYYY-MM-DD or 'YYYY-MM-DD HH:MM', not '%s'" %
+                         args.since)
+    if args.shard:
+        match = re.match(r'(\d+)/(\d+)$', args.shard)
+        if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+            parser.error("--shard must be i/N, with i from 1 to N, not '%s'" % args.shard)
+        args.shard = (int(match.group(1)), int(match.group(2)))
+        if not args.results:
+            args.results = 'CheckFlacTags-shard-%d-of-%d.json' % args.shard
     if args.tag:
         def flatten_args(el):
             if isinstance(el, collections.Iterable) and not isinstance(el, str):
@@ -278,39 +395,132 @@ def check_identical_tags_across_discs(album):
         msgs.error('Tags not identical across discs: ' + ', '.join(sorted(mismatches)))
 
 
+def find_album_tag(album, tag):
+    # Return the first value found for a tag in any track of an album
+    for disc in album.values():
+        for track in disc.values():
+            if tag in track:
+                return flatten_tag(track[tag])
+
+
+def aux_file_name(album, discnum, ext):
+    # Return the expected name of a disc's cuesheet (ext '.cue') or extraction
+    # log ('.txt'), or None if the AlbumArtist or Album tag is missing:
+    # * [AlbumArtist] - [Album] (Disc #).ext    -- (Disc #) only for multi-disc
+    album_artist = find_album_tag(album, 'albumartist')
+    album_title = find_album_tag(album, 'album')
+    if not (album_artist and album_title):
+        return None
+    filename = str(album_artist + ' - ' + album_title)
+    if album.disc_count != 1:
+        filename = '%s (Disc %s)' % (filename, discnum)
+    return replace_reserved_chars(filename + ext)
+
+
 def check_nontag_info(album):
     # Make sure the expected non-FLAC files are found in the album directory.
-    # These are
-    # * folder.jpg
-    # * [AlbumArtist] - [Album] (Disc #).cue    -- (Disc #) only for multi-disc
-    # * [AlbumArtist] - [Album] (Disc #).txt    -- (Disc #) only for multi-disc
+    # These are folder.jpg, and the cuesheet and extraction log of each disc
+    # (see aux_file_name).
     if not args.other:
         return
 
     def check_for_file(filename):
         f = replace_reserved_chars(filename)
-        if not os.path.isfile(os.path.join(album.path, f)):
+        if not isfile(album.path, f):
             msgs.error("File '%s' not found" % f)
 
-    def find_tag(tag):
-        for disc in album.values():
-            for track in disc.values():
-                if tag in track:
-                    return flatten_tag(track[tag])
-
     check_for_file('folder.jpg')
-    album_artist = find_tag('albumartist')
-    album_title = find_tag('album')
-    if album_artist and album_title:
-        filename = str(album_artist + ' - ' + album_title)
-        if album.disc_count == 1:
-            check_for_file(filename + '.cue')
-            check_for_file(filename + '.txt')
-        else:
-            for discnum in album:
-                discname = '%s (Disc %s)' % (filename, discnum)
-                check_for_file(discname + '.cue')
-                check_for_file(discname + '.txt')
+    for discnum in album:
+        for ext in ('.cue', '.txt'):
+            filename = aux_file_name(album, discnum, ext)
+            if filename:
+                check_for_file(filename)
+
+
+def read_cover_info(album_path):
+    # Read the headers of folder.jpg and the pictures embedded in the FLAC
+    # files of an album, along with an MD5 of each image.  Returns a tuple of
+    # the (ImageInfo, md5) of folder.jpg, or None if it's missing, and a dict
+    # mapping the name of each FLAC file to a list of (picture type,
+    # ImageInfo, md5) tuples.  ImageInfo is None for images that aren't a
+    # JPEG or PNG.  Only reads files, so it can run ahead in another thread.
+    folder = None
+    try:
+        with open(os.path.join(album_path, 'folder.jpg'), 'rb') as f:
+            info = get_image_info(f)
+            f.seek(0)
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+            folder = (info, md5.digest())
+    except FileNotFoundError:
+        pass
+    embedded = {}
+    for file in os.listdir(album_path):
+        if not file.endswith('.flac'):
+            continue
+        try:
+            header = FlacHeader(os.path.join(album_path, file))
+        except (OSError, ValueError):
+            continue    # get_album reports unreadable files
+        pictures = []
+        for kind, data in header.blocks:
+            if kind == FLAC_PICTURE:
+                picture_type, image = parse_flac_picture(data)
+                pictures.append((picture_type, get_image_info(io.BytesIO(image)),
+                                 hashlib.md5(image).digest()))
+        embedded[file] = pictures
+    return folder, embedded
+
+
+def check_cover_art(album, cover_info=None):
+    # Check folder.jpg and the embedded pictures read by read_cover_info,
+    # reading them now if they weren't read ahead.
+    if not args.cover_art:
+        return
+    folder, embedded = cover_info or read_cover_info(album.path)
+
+    def describe(info):
+        if info is None:
+            return 'not a JPEG or PNG image'
+        if min(info.width, info.height) < args.min_cover_size:
+            return 'only %dx%d pixels (minimum %d)' % (info.width, info.height,
+                                                       args.min_cover_size)
+        return None
+
+    if folder:
+        info, folder_md5 = folder
+        problem = describe(info)
+        if problem:
+            msgs.error('folder.jpg is %s' % problem)
+        elif info.format != 'JPEG':
+            msgs.error('folder.jpg is a %s image, not a JPEG' % info.format)
+    # Check the front cover of each track, or its first picture if there's
+    # no front cover.
+    bad_tracks = defaultdict(list)
+    covers = defaultdict(list)
+    for discnum, disc in sorted(album.items()):
+        for tracknum, track in sorted(disc.items()):
+            pictures = embedded.get(track.file)
+            if not pictures:
+                continue
+            picture_type, info, md5 = next((picture for picture in pictures
+                                            if picture[0] == 3), pictures[0])
+            label = 'Track %d' % tracknum
+            if len(album) > 1:
+                label = 'Disc %d %s' % (discnum, label)
+            problem = describe(info)
+            if problem:
+                bad_tracks[problem].append(label)
+            covers[md5].append(label)
+    for problem, labels in sorted(bad_tracks.items()):
+        msgs.error('Embedded picture is %s: %s' % (problem, ', '.join(labels)))
+    if len(covers) > 1:
+        msgs.error('Embedded pictures differ between tracks:')
+        for labels in sorted(covers.values(), key=len, reverse=True):
+            msgs.error('  %s' % ', '.join(labels))
+    elif covers and folder and folder[1] not in covers:
+        msgs.error('Embedded pictures differ from folder.jpg')
 
 
 def handle_mapped_tags(disc):
@@ -468,7 +678,7 @@ def check_identical_tags(disc):
     # Check that tags which should be identical across all tracks are identical
     mismatch_tags = (identical_tags_within_disc & disc.tagset) - disc.identical.tagset
     if mismatch_tags:
-        msgs.error('Tags not same across all tracks: ' + ', '.join(mismatch_tags))
+        msgs.error('Tags not same across all tracks: ' + ', '.join(sorted(mismatch_tags)))
 
 
 def check_different_tags(disc):
@@ -704,6 +914,253 @@ def check_orchestra(disc):
         output_dict_of_bad_tracks(bad_tracks, disc)
 
 
+def parse_cdtoc(value):
+    # Parse a cdtoc tag, which holds the number of tracks, the start of each
+    # track and the start of the lead-out, in hex CD frames, separated by '+'
+    # (e.g. '3+96+3A2B+6F10+9D42').  Data tracks have an 'X' before their
+    # start.  Returns a dict mapping each audio track number to its length in
+    # CD frames, or None if the tag is malformed.
+    fields = value.strip().split('+')
+    try:
+        count = int(fields[0], 16)
+        starts = [(int(field.lstrip('Xx'), 16), field[:1] in 'Xx')
+                  for field in fields[1:]]
+    except ValueError:
+        return None
+    if count < 1 or len(starts) != count + 1:
+        return None
+    lengths = {}
+    for index, (start, is_data) in enumerate(starts[:-1]):
+        if is_data:
+            continue
+        end, next_is_data = starts[index + 1]
+        if next_is_data:
+            end -= session_gap_frames
+        lengths[index + 1] = end - start
+    return lengths
+
+
+def parse_cuesheet(data):
+    # Parse the FILE, TRACK and INDEX lines of the bytes of a cuesheet.
+    # Returns a list with an entry for each FILE, which is a list of (track
+    # number, index number, CD frames from the start of the file) tuples.
+    try:
+        lines = data.decode('utf-8-sig').splitlines()
+    except UnicodeDecodeError:
+        lines = data.decode('latin-1').splitlines()
+    files = []
+    tracknum = None
+    for line in lines:
+        words = line.split()
+        if not words:
+            continue
+        keyword = words[0].upper()
+        if keyword == 'FILE':
+            files.append([])
+        elif keyword == 'TRACK' and len(words) > 1 and words[1].isdigit():
+            tracknum = int(words[1])
+        elif keyword == 'INDEX' and len(words) > 2 and files and tracknum:
+            match = re.match(r'(\d+):(\d+):(\d+)$', words[2])
+            if match and words[1].isdigit():
+                minutes, seconds, frames = map(int, match.groups())
+                files[-1].append((tracknum, int(words[1]),
+                                  (minutes * 60 + seconds) * 75 + frames))
+    return files
+
+
+def check_disc_layout(album, discnum):
+    # Cross-check the disc layout given by the cdtoc tag and the cuesheet
+    # against the number of samples STREAMINFO gives for each track, and check
+    # the audio is CD format.  Ripped tracks include the gap before the next
+    # track, so each track should run from its own start to the next track's.
+    if not args.layout:
+        return
+    disc = album[discnum]
+    samples = {tracknum: track.streaminfo.total_samples for tracknum, track in disc.items()}
+    bad_tracks = defaultdict(list)
+    for tracknum, track in sorted(disc.items()):
+        info = track.streaminfo
+        audio_format = (info.sample_rate, info.bits_per_sample, info.channels)
+        if audio_format != cd_format:
+            bad_tracks['%d Hz, %d-bit, %d channels' % audio_format].append(tracknum)
+    if bad_tracks:
+        msgs.error('Audio is not CD format (%d Hz, %d-bit, %d channels):' % cd_format)
+        output_dict_of_bad_tracks(bad_tracks, disc)
+        return
+    partial = [tracknum for tracknum, count in sorted(samples.items())
+               if count % samples_per_cd_frame]
+    if partial:
+        msgs.error('Track length not a whole number of CD frames: %s' %
+                   track_list(partial, len(disc)))
+
+    def compare(source, expected):
+        # expected maps track numbers to lengths in CD frames
+        if set(expected) != set(disc):
+            msgs.error('Tracks in %s (%s) do not match the disc (%s)' %
+                       (source, track_list(sorted(expected), -1),
+                        track_list(sorted(disc), -1)))
+        for tracknum in sorted(set(expected) & set(disc)):
+            expected_samples = expected[tracknum] * samples_per_cd_frame
+            if samples[tracknum] != expected_samples:
+                msgs.error('Track %d has %d samples, %s gives %d' %
+                           (tracknum, samples[tracknum], source, expected_samples))
+
+    cdtoc = disc.identical.get('cdtoc')
+    if cdtoc:
+        lengths = parse_cdtoc(flatten_tag(cdtoc))
+        if lengths is None:
+            msgs.error("Malformed cdtoc tag '%s'" % flatten_tag(cdtoc))
+        else:
+            compare('cdtoc', lengths)
+    filename = aux_file_name(album, discnum, '.cue')
+    if not filename or not isfile(album.path, filename):
+        return
+    with open_file(album.path, filename) as f:
+        files = parse_cuesheet(f.read())
+    if not any(files):
+        msgs.error("No tracks found in cuesheet '%s'" % filename)
+        return
+    if len(files) == 1:
+        # A single-file image: each track runs from its INDEX 01 to the next
+        starts = sorted((tracknum, frames) for tracknum, index, frames in files[0]
+                        if index == 1)
+        lengths = {tracknum: next_start - start for (tracknum, start), (_, next_start)
+                   in zip(starts, starts[1:])}
+        if starts and starts[-1][0] in disc:
+            lengths[starts[-1][0]] = samples[starts[-1][0]] // samples_per_cd_frame
+        compare('cuesheet', lengths)
+        return
+    # One file per track: every index in a track's file must fall within it
+    tracknums = []
+    for entries in files:
+        tracknum = next((tracknum for tracknum, index, _ in entries if index == 1), None)
+        if tracknum is None:
+            continue
+        tracknums.append(tracknum)
+        for other, index, frames in entries:
+            if tracknum in samples and frames * samples_per_cd_frame >= samples[tracknum]:
+                msgs.error('Cuesheet INDEX %02d of track %d is past the end of track %d' %
+                           (index, other, tracknum))
+    if sorted(tracknums) != sorted(disc):
+        msgs.error('Tracks in cuesheet (%s) do not match the disc (%s)' %
+                   (track_list(sorted(tracknums), -1), track_list(sorted(disc), -1)))
+
+
+def check_rip_log(album, discnum):
+    # Cross-check the crc and accurateripresult tags of each track against the
+    # disc's extraction log, and warn about tracks ripped insecurely or with
+    # re-reads.  Parsed logs come from the cache when run from main.
+    if not args.rip_log:
+        return
+    filename = aux_file_name(album, discnum, '.txt')
+    if not filename or not isfile(album.path, filename):
+        return
+    log_path = os.path.join(album.path, filename)
+    if rip_log_cache:
+        log = rip_log_cache.get(log_path)
+    else:
+        log = QueryRipLogs.read_log(log_path)
+    if log is None:
+        msgs.error("'%s' is not an extraction log" % filename)
+        return
+    disc = album[discnum]
+    logged = {track['track']: track for track in log['tracks']}
+    missing = sorted(set(disc) - set(logged))
+    if missing:
+        msgs.error('Tracks missing from extraction log: %s' % track_list(missing, len(disc)))
+    insecure = []
+    reread = []
+    for tracknum, track in sorted(disc.items()):
+        entry = logged.get(tracknum)
+        if not entry:
+            continue
+        crc = flatten_tag(track.get('crc', ''))
+        if crc and entry['crc'] and crc.upper() != entry['crc']:
+            msgs.error('Track %d: crc tag %s, extraction log gives %s' %
+                       (tracknum, crc, entry['crc']))
+        tag_result = flatten_tag(track.get('accurateripresult', ''))
+        if tag_result and entry['result'] is not None:
+            result = QueryRipLogs.parse_result(re.sub(r'^AccurateRip:\s*', '', tag_result))
+            if (result[0].lower(), result[1]) != (entry['result'].lower(), entry['confidence']):
+                msgs.error("Track %d: accurateripresult tag '%s', extraction "
+                           "log gives '%s'" % (tracknum, tag_result,
+                                               QueryRipLogs.format_result(entry)))
+        if entry['secure'] is False:
+            insecure.append(tracknum)
+        if entry['rereads']:
+            reread.append('Track %d (%d frames)' % (tracknum, entry['rereads']))
+    if insecure:
+        msgs.warn('Tracks ripped insecurely: %s' % track_list(insecure, len(disc)))
+    if reread:
+        msgs.warn('Tracks with re-ripped frames: %s' % ', '.join(reread))
+
+
+def verify_album_frames(album):
+    # Walk the audio frames of every track, in parallel when run from main,
+    # saving the problems found in track.frame_problems.
+    tracks = [track for disc in album.values() for track in disc.values()]
+    paths = [os.path.join(album.path, track.file) for track in tracks]
+    mapper = frame_executor.map if frame_executor else map
+    for track, problems in zip(tracks, mapper(FlacFrames.verify_frames, paths)):
+        track.frame_problems = problems
+
+
+def verify_album_audio(album):
+    # Decode every track, in parallel when run from main, saving the problems
+    # found in track.audio_problems and the peak level in track.peak.
+    tracks = [track for disc in album.values() for track in disc.values()]
+    paths = [os.path.join(album.path, track.file) for track in tracks]
+    mapper = frame_executor.map if frame_executor else map
+    for track, (problems, peak) in zip(tracks, mapper(FlacFrames.verify_audio, paths)):
+        track.audio_problems = problems
+        track.peak = peak
+
+
+def check_audio(disc):
+    # Report the problems found by verify_album_audio, and check the
+    # ReplayGain peak tags against the peaks of the decoded audio.  The album
+    # peak is checked against the loudest track of the disc.
+    if not args.verify_audio:
+        return
+    bad_tracks = [(tracknum, track) for tracknum, track in sorted(disc.items())
+                  if track.audio_problems]
+    if bad_tracks:
+        msgs.error('Audio verification failed:')
+        for tracknum, track in bad_tracks:
+            for problem in track.audio_problems:
+                msgs.error('  Track %d: %s' % (tracknum, problem))
+        return
+
+    def check_peak(tracknum, track, tag, peak):
+        value = flatten_tag(track.get(tag, ''))
+        if not value:
+            return
+        try:
+            if abs(float(value) - peak) <= peak_tolerance:
+                return
+        except ValueError:
+            pass
+        msgs.error('Track %d: %s is %s, audio peak is %.6f' % (tracknum, tag, value, peak))
+
+    album_peak = max(track.peak for track in disc.values())
+    for tracknum, track in sorted(disc.items()):
+        check_peak(tracknum, track, 'replaygain_track_peak', track.peak)
+        check_peak(tracknum, track, 'replaygain_album_peak', album_peak)
+
+
+def check_frames(disc):
+    # Report any damaged audio found by verify_album_frames
+    if not args.verify_frames:
+        return
+    bad_tracks = [(tracknum, track) for tracknum, track in sorted(disc.items())
+                  if track.frame_problems]
+    if bad_tracks:
+        msgs.error('Audio frame verification failed:')
+        for tracknum, track in bad_tracks:
+            for problem in track.frame_problems:
+                msgs.error('  Track %d: %s' % (tracknum, problem))
+
+
 def find_selected_tags(disc):
     # Not a correctness check - display any tracks using the selected tags.
     for tag in sorted(args.tag & disc.tagset):
@@ -715,15 +1172,201 @@ def find_selected_tags(disc):
         output_dict_of_bad_tracks(tag_vals, disc, msgs.note)
 
 
-def process_album(album_path):
+def plan_track_fixes(track, disc, derive_sort_tags):
+    # Work out the mechanical fixes for a track's tags: obsolete tags renamed
+    # to their mapped tags (or dropped if the newer tag has the same value),
+    # a leading 'The ' moved to the end, and missing sort tags copied from
+    # the main tag.  Returns the fixed tags as a dict, a dict of renamed
+    # tags, and a list of descriptions of the fixes.
+    tags = {tag: list(values) for tag, values in track.items()}
+    renamed = {}
+    fixes = []
+    for old_tag, new_tag in mapped_tags.items():
+        if old_tag not in tags:
+            continue
+        if new_tag not in tags:
+            tags[new_tag] = tags.pop(old_tag)
+            renamed[old_tag] = new_tag
+            fixes.append('%s -> %s' % (old_tag, new_tag))
+        elif tags[old_tag] == tags[new_tag]:
+            del tags[old_tag]
+            fixes.append('removed %s, same as %s' % (old_tag, new_tag))
+    for tag in test_leading_The_tags:
+        values = tags.get(tag, [])
+        fixed = ['%s, %s' % (value[4:], value[0:3])
+                 if value[0:4].lower() == 'the ' else value for value in values]
+        if fixed != values:
+            tags[tag] = fixed
+            fixes.append("%s '%s' -> '%s'" % (tag, flatten_tag(values), flatten_tag(fixed)))
+    if derive_sort_tags:
+        for tag, sort_tag in sorted_tags.items():
+            if (tag in tags and sort_tag not in tags and
+                    (sort_tag in disc.tagset or args.no_sort_tag or disc.classical)):
+                tags[sort_tag] = list(tags[tag])
+                fixes.append('added %s from %s' % (sort_tag, tag))
+    return tags, renamed, fixes
+
+
+def fix_comments(comments, tags, renamed):
+    # Rebuild a list of raw (name, value) Vorbis comments to hold the fixed
+    # tags, keeping the original order and spelling of the tag names.  Tags
+    # not already present are added at the end in upper case.
+    fixed = []
+    done = set()
+    for name, _ in comments:
+        tag = name.lower()
+        new_tag = renamed.get(tag, tag)
+        if new_tag in done or new_tag not in tags:
+            continue
+        done.add(new_tag)
+        if new_tag != tag:
+            name = new_tag.upper()
+        fixed.extend((name, value) for value in tags[new_tag])
+    for tag, values in tags.items():
+        if tag not in done:
+            fixed.extend((tag.upper(), value) for value in values)
+    return fixed
+
+
+def stage_track_fix(path, tags, renamed):
+    # Prepare the fixed version of a FLAC file without touching the original.
+    # If the new tags fit in the existing padding, returns ('header', data),
+    # with the new metadata to write over the start of the file.  Otherwise
+    # writes a fixed copy of the whole file next to it using mutagen, which
+    # adds fresh padding, and returns ('copy', temp_path).
+    header = FlacHeader(path)
+    block = header.get_block(FLAC_VORBIS_COMMENT)
+    vendor, comments = parse_vorbis_comment(block) if block else ('', [])
+    comments = fix_comments(comments, tags, renamed)
+    metadata = header.build_metadata(FLAC_VORBIS_COMMENT,
+                                     make_vorbis_comment(vendor, comments))
+    if metadata is not None:
+        return ('header', metadata)
+    temp_path = path + '.fixtmp'
+    shutil.copy2(path, temp_path)
+    try:
+        flac = mutagen.flac.FLAC(temp_path)
+        if flac.tags is None:
+            flac.add_tags()
+        del flac.tags[:]
+        flac.tags.extend(comments)
+        flac.save()
+    except:
+        os.remove(temp_path)
+        raise
+    return ('copy', temp_path)
+
+
+def commit_track_fixes(staged):
+    # Apply the staged fixes for an album, given as (path, (kind, value))
+    # pairs from stage_track_fix.  If any file can't be updated, the files
+    # already updated are restored, so the album is either entirely fixed or
+    # left as it was.
+    done = []
+    try:
+        for path, (kind, value) in staged:
+            if kind == 'header':
+                with open(path, 'r+b') as f:
+                    old_metadata = f.read(len(value))
+                    # Noted before writing, so a partial write is undone too
+                    done.append((path, old_metadata))
+                    f.seek(0)
+                    f.write(value)
+            else:
+                os.replace(path, path + '.fixbak')
+                done.append((path, None))
+                os.replace(value, path)
+    except Exception:
+        # Restore each file separately, so one that can't be restored
+        # doesn't stop the rest, or hide the error that stopped the fixes
+        for path, old_metadata in reversed(done):
+            try:
+                if old_metadata is None:
+                    os.replace(path + '.fixbak', path)
+                else:
+                    with open(path, 'r+b') as f:
+                        f.write(old_metadata)
+            except Exception as e:
+                print("Warning: Unable to restore '%s', so it may be damaged: %s" % (path, e))
+        raise
+    finally:
+        for path, (kind, value) in staged:
+            if kind == 'copy' and os.path.exists(value):
+                os.remove(value)
+    for path, old_metadata in done:
+        if old_metadata is None:
+            os.remove(path + '.fixbak')
+
+
+def fix_album(album):
+    # Apply the mechanical tag fixes to every track of an album that needs
+    # them, writing the files in parallel.  Returns True if any files were
+    # changed, in which case the album should be read again.
+    plans = []
+    for discnum, disc in sorted(album.items()):
+        profiles = {flatten_tag(track.get('profile', '')).lower()
+                    for track in disc.values()}
+        disc.classical = (profiles == {'classical'})
+        for tracknum, track in sorted(disc.items()):
+            tags, renamed, fixes = plan_track_fixes(track, disc, args.sort_tag_mismatch)
+            if fixes:
+                path = os.path.join(album.path, track.file)
+                plans.append((discnum, tracknum, path, tags, renamed, fixes))
+    if not plans:
+        return False
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(stage_track_fix, path, tags, renamed)
+                   for _, _, path, tags, renamed, _ in plans]
+    try:
+        staged = [(plan[2], future.result()) for plan, future in zip(plans, futures)]
+    except (OSError, ValueError, mutagen.MutagenError) as e:
+        for future in futures:
+            if not future.exception() and future.result()[0] == 'copy':
+                os.remove(future.result()[1])
+        print("\nCan't fix tags in '%s': %s" % (album.path, e))
+        return False
+    try:
+        commit_track_fixes(staged)
+    except OSError as e:
+        print("\nCan't fix tags in '%s', no files changed: %s" % (album.path, e))
+        return False
+    print("\nFixed tags in '%s':" % album.path)
+    for discnum, tracknum, _, _, _, fixes in plans:
+        label = 'Track %d' % tracknum
+        if len(album) > 1:
+            label = 'Disc %d %s' % (discnum, label)
+        print('  %s: %s' % (label, ', '.join(fixes)))
+    return True
+
+
+def process_album(album_path, cover_future=None):
+    # Wait for the cover art read ahead before any fixes rewrite the files
+    cover_info = cover_future.result() if cover_future else None
+    album, album_msgs = get_album(album_path)
+    if args.fix and fix_album(album):
+        album, album_msgs = get_album(album_path)
+    check_album(album, album_msgs, cover_info)
+
+
+def check_album(album, album_msgs, cover_info=None):
+    # Run all the checks on an album already read by get_album, printing any
+    # problems found.  album_msgs holds the messages from get_album, and
+    # collects the messages from the checks.  cover_info is the result of
+    # read_cover_info if the cover art was read ahead.  Returns True if no
+    # errors or warnings were found.
     global msgs, album_count, disc_count, track_count, warn_count
-    warn = False
+    album_path = album.path
+    msgs = album_msgs
     album_count += 1
-    album, msgs = get_album(album_path)
     if album:
         check_disc_numbers(album)
         check_identical_tags_across_discs(album)
         check_nontag_info(album)
+        check_cover_art(album, cover_info)
+        if args.verify_frames:
+            verify_album_frames(album)
+        if args.verify_audio:
+            verify_album_audio(album)
     if msgs:
         print("\nEarly checks of '%s' found problems:" % album_path)
         print(msgs)
@@ -736,6 +1379,10 @@ def process_album(album_path):
         find_identical_disc_tags(disc)
         check_profile(disc)
         check_inaccurate_rips(disc)
+        check_frames(disc)
+        check_audio(disc)
+        check_disc_layout(album, discnum)
+        check_rip_log(album, discnum)
         check_missing_tags(disc)
         check_unknown_tags(disc)
         check_multivalued_tags(disc)
@@ -761,14 +1408,11 @@ def process_album(album_path):
             print(msgs)
     if msgs.errors or msgs.warnings:
         warn_count += 1
+        return False
+    return True
 
 
-def main():
-    parse_args()
-    for root in sorted(args.path):
-        for album_path in find_albums(root):
-            process_album(album_path)
-
+def print_summary():
     def plural(count, name, zero='0'):
         if count == 1:
             return '1 ' + name
@@ -780,6 +1424,187 @@ def main():
     print("\nProcessed %s, %s, %s - %s with issues" %
           (plural(album_count, 'album'), plural(disc_count, 'disc'),
            plural(track_count, 'track'), plural(warn_count, 'album', zero='No')))
+
+
+def in_shard(root, album_path):
+    # Check if an album belongs to the shard being checked.  Albums are
+    # assigned on a CRC of the path relative to the root, so every machine
+    # splits up the library the same way, wherever it's mounted.
+    if not args.shard:
+        return True
+    shard, shard_count = args.shard
+    rel_path = os.path.relpath(album_path, root).replace(os.sep, '/')
+    return zlib.crc32(rel_path.encode('UTF-8')) % shard_count == shard - 1
+
+
+def save_results(results):
+    # Save the output and counts for the albums checked, for --merge.
+    data = {
+        'version': results_version,
+        'shard': list(args.shard or (1, 1)),
+        'roots': sorted(args.path),
+        'counts': [album_count, disc_count, track_count, warn_count],
+        'albums': [{'root': root, 'path': album_path, 'output': output}
+                   for root, album_path, output in results],
+    }
+    temp_path = args.results + '.tmp'
+    with open(temp_path, 'w', encoding='UTF-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_path, args.results)
+
+
+def merge_results(paths):
+    # Print the combined report of the results files saved by all shards,
+    # with the albums in the same order as a run over the whole library.
+    global album_count, disc_count, track_count, warn_count
+    albums = []
+    shards = set()
+    shard_count = None
+    for path in paths:
+        with open(path, encoding='UTF-8') as f:
+            data = json.load(f)
+        if data.get('version') != results_version:
+            print("Error: '%s' is not a results file from this version" % path, file=sys.stderr)
+            sys.exit(1)
+        shard, count = data['shard']
+        # Each machine can mount the library in a different place, so only
+        # the number of shards and of roots has to match
+        if shard_count is None:
+            shard_count, root_count = count, len(data['roots'])
+        elif (count, len(data['roots'])) != (shard_count, root_count):
+            print("Error: '%s' is from a different set of shards" % path, file=sys.stderr)
+            sys.exit(1)
+        if args.path and len(args.path) != root_count:
+            print('Error: the shards were run on %d root%s, but %d paths were given' %
+                  (root_count, '' if root_count == 1 else 's', len(args.path)),
+                  file=sys.stderr)
+            sys.exit(1)
+        if shard in shards:
+            print("Error: shard %d/%d found more than once" % (shard, count), file=sys.stderr)
+            sys.exit(1)
+        shards.add(shard)
+        counts = data['counts']
+        album_count += counts[0]
+        disc_count += counts[1]
+        track_count += counts[2]
+        warn_count += counts[3]
+        for album in data['albums']:
+            album['root_index'] = data['roots'].index(album['root'])
+            album['rel_path'] = album['path'][len(album['root']):].strip('\\/').replace('\\', '/')
+        albums += data['albums']
+    # Roots are matched up by their sorted order, which is the order each
+    # shard checked them in
+    new_roots = sorted(args.path) if args.path else None
+    for album in sorted(albums, key=lambda album: (album['root_index'], album['rel_path'])):
+        output = album['output']
+        if new_roots:
+            parts = album['rel_path'].split('/') if album['rel_path'] else []
+            new_path = os.path.join(new_roots[album['root_index']], *parts)
+            output = output.replace(album['path'], new_path)
+        print(output, end='')
+    print_summary()
+    missing = sorted(set(range(1, shard_count + 1)) - shards)
+    if missing:
+        print('Warning: no results for shard%s %s of %d' %
+              ('' if len(missing) == 1 else 's', ', '.join(map(str, missing)),
+               shard_count))
+
+
+def schedule_albums(albums):
+    # Apply --since and --recent-first to the (root, album_path) pairs found,
+    # using the modification time of each album's newest FLAC file.  Returns
+    # the list of albums to check, in order.
+    if not (args.since or args.recent_first):
+        return list(albums)
+    dated = [(newest_mtime(album_path), root, album_path) for root, album_path in albums]
+    if args.since:
+        dated = [album for album in dated if album[0] >= args.since]
+    if args.recent_first:
+        dated.sort(key=lambda album: -album[0])
+    return [(root, album_path) for _, root, album_path in dated]
+
+
+def report_unchecked(unchecked):
+    # List the albums --budget ran out of time for
+    print('\nTime budget of %g seconds used up, %d album%s left unchecked:' %
+          (args.budget, len(unchecked), '' if len(unchecked) == 1 else 's'))
+    for _, album_path in unchecked[:max_listed_unchecked]:
+        print('  %s' % album_path)
+    if len(unchecked) > max_listed_unchecked:
+        print('  ... and %d more' % (len(unchecked) - max_listed_unchecked))
+
+
+def read_ahead_covers(albums, executor):
+    # Yield each (root, album_path) pair from albums with a future for its
+    # cover art, keeping cover_lookahead albums being read ahead in executor.
+    pending = collections.deque()
+    for root, album_path in albums:
+        pending.append((root, album_path, executor.submit(read_cover_info, album_path)))
+        if len(pending) > cover_lookahead:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def main():
+    global frame_executor, rip_log_cache
+    start_time = time.monotonic()
+    parse_args()
+    if args.from_snapshot:
+        try:
+            snapshot = load_snapshot(args.from_snapshot)
+        except (OSError, ValueError) as e:
+            print("Error: can't load snapshot '%s': %s" % (args.from_snapshot, e),
+                  file=sys.stderr)
+            sys.exit(1)
+        args.path = args.path or snapshot.roots
+    if args.merge:
+        merge_results(args.merge)
+    elif args.export_snapshot:
+        count = export_snapshot(args.path, args.export_snapshot)
+        print("Saved %d albums to '%s'" % (count, args.export_snapshot))
+    else:
+        if args.verify_frames or args.verify_audio:
+            frame_executor = ProcessPoolExecutor()
+        cover_executor = ThreadPoolExecutor(cover_lookahead) if args.cover_art else None
+        if args.rip_log:
+            rip_log_cache = QueryRipLogs.LogCache(QueryRipLogs.default_cache)
+        results = []
+        unchecked = None
+        try:
+            albums = ((root, album_path) for root in sorted(args.path)
+                      for album_path in find_albums(root) if in_shard(root, album_path))
+            if args.since or args.recent_first or args.budget is not None:
+                albums = schedule_albums(albums)
+            if cover_executor:
+                queue = read_ahead_covers(albums, cover_executor)
+            else:
+                queue = ((root, album_path, None) for root, album_path in albums)
+            for index, (root, album_path, cover_future) in enumerate(queue):
+                if args.budget is not None and time.monotonic() - start_time >= args.budget:
+                    unchecked = albums[index:]
+                    break
+                if not args.results:
+                    process_album(album_path, cover_future)
+                    continue
+                # Capture the album's output to save with the results
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    process_album(album_path, cover_future)
+                print(output.getvalue(), end='')
+                results.append((root, album_path, output.getvalue()))
+        finally:
+            if frame_executor:
+                frame_executor.shutdown()
+            if cover_executor:
+                cover_executor.shutdown()
+            if rip_log_cache:
+                rip_log_cache.save()
+        print_summary()
+        if unchecked:
+            report_unchecked(unchecked)
+        if args.results:
+            save_results(results)
     if args.pause:
         try:
             input('\nPress Enter when ready...')
@@ -2,9 +2,15 @@
 
 # Contains some utility code used by my dBpoweramp FLAC-handling scripts.
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import fnmatch
+import gzip
+import io
+import json
 import mutagen.flac
 import os
+import struct
 import sys
 
 
@@ -47,6 +53,7 @@ class Track(dict):
     creates these instance attributes:
     track.file = name of the FLAC file
     track.tagset = set of all tags found
+    track.streaminfo = StreamInfo from the FLAC file's STREAMINFO block
     """
     def __init__(self, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)
@@ -79,11 +86,235 @@ class Album(dict):
         self.tagset = set()
 
 
-def uprint(*objects, sep=' ', end='\n', file=sys.stdout):
+# FLAC metadata block types
+FLAC_STREAMINFO = 0
+FLAC_PADDING = 1
+FLAC_VORBIS_COMMENT = 4
+FLAC_PICTURE = 6
+
+StreamInfo = collections.namedtuple('StreamInfo', (
+    'min_blocksize', 'max_blocksize', 'min_framesize', 'max_framesize',
+    'sample_rate', 'channels', 'bits_per_sample', 'total_samples', 'md5'))
+
+
+class FlacHeader:
+    """
+    The metadata blocks at the start of a FLAC file, read without touching
+    the audio frames.  Code also creates these instance attributes:
+    header.path = the path to the FLAC file
+    header.blocks = list of (block type, block data) tuples, in file order
+    header.audio_offset = file offset of the first audio frame
+    header.file_size = size of the whole file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.blocks = []
+        with open(path, 'rb') as f:
+            if f.read(4) != b'fLaC':
+                raise ValueError("'%s' is not a FLAC file" % path)
+            last = False
+            while not last:
+                block_header = f.read(4)
+                if len(block_header) != 4:
+                    raise ValueError("'%s' has truncated metadata" % path)
+                last = bool(block_header[0] & 0x80)
+                length = int.from_bytes(block_header[1:], 'big')
+                data = f.read(length)
+                if len(data) != length:
+                    raise ValueError("'%s' has truncated metadata" % path)
+                self.blocks.append((block_header[0] & 0x7f, data))
+            self.audio_offset = f.tell()
+            self.file_size = os.fstat(f.fileno()).st_size
+
+    def get_block(self, block_type):
+        # Return the data of the first block of the given type, or None.
+        for kind, data in self.blocks:
+            if kind == block_type:
+                return data
+        return None
+
+    @property
+    def streaminfo(self):
+        data = self.get_block(FLAC_STREAMINFO)
+        min_block, max_block = struct.unpack('>HH', data[0:4])
+        min_frame = int.from_bytes(data[4:7], 'big')
+        max_frame = int.from_bytes(data[7:10], 'big')
+        bits = int.from_bytes(data[10:18], 'big')
+        return StreamInfo(min_block, max_block, min_frame, max_frame,
+                          sample_rate=bits >> 44,
+                          channels=((bits >> 41) & 0x7) + 1,
+                          bits_per_sample=((bits >> 36) & 0x1f) + 1,
+                          total_samples=bits & 0xfffffffff,
+                          md5=data[18:34])
+
+    @property
+    def audio_size(self):
+        return self.file_size - self.audio_offset
+
+    def get_tags(self):
+        # Return the Vorbis comment tags as a dict of lists of values, keyed
+        # on the lower-cased tag name, like the tags mutagen returns.
+        tags = collections.defaultdict(list)
+        block = self.get_block(FLAC_VORBIS_COMMENT)
+        if block:
+            for name, value in parse_vorbis_comment(block)[1]:
+                tags[name.lower()].append(value)
+        return tags
+
+    def build_metadata(self, block_type, new_data):
+        # Return the complete metadata, from the 'fLaC' marker up to the
+        # audio, with the data of the first block of the given type replaced
+        # by new_data.  The first padding block is resized to keep the audio
+        # at the same offset, so the result can be written over the start of
+        # the file in place.  Returns None if there's no such block, or not
+        # enough padding to absorb the change in size.
+        blocks = list(self.blocks)
+        index = next((i for i, (kind, _) in enumerate(blocks)
+                      if kind == block_type), None)
+        pad_index = next((i for i, (kind, _) in enumerate(blocks)
+                          if kind == FLAC_PADDING), None)
+        if index is None or pad_index is None:
+            return None
+        pad_len = len(blocks[pad_index][1]) - (len(new_data) - len(blocks[index][1]))
+        if pad_len < 0:
+            return None
+        blocks[index] = (block_type, new_data)
+        blocks[pad_index] = (FLAC_PADDING, bytes(pad_len))
+        parts = [b'fLaC']
+        for i, (kind, data) in enumerate(blocks):
+            last = 0x80 if i == len(blocks) - 1 else 0
+            parts.append(bytes([kind | last]) + len(data).to_bytes(3, 'big'))
+            parts.append(data)
+        return b''.join(parts)
+
+
+ImageInfo = collections.namedtuple('ImageInfo', ('format', 'width', 'height'))
+
+# JPEG start-of-frame markers, which hold the image dimensions
+jpeg_sof_markers = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+
+def get_image_info(f):
+    # Get the format and dimensions of a JPEG or PNG image from the file
+    # object f, reading only the header bytes up to the JPEG start-of-frame
+    # segment or the PNG IHDR chunk.  Returns an ImageInfo, or None if the
+    # data isn't a JPEG or PNG image.
+    start = f.read(8)
+    if start == b'\x89PNG\r\n\x1a\n':
+        chunk = f.read(16)
+        if len(chunk) < 16 or chunk[4:8] != b'IHDR':
+            return None
+        width, height = struct.unpack('>II', chunk[8:16])
+        return ImageInfo('PNG', width, height)
+    if start[:2] != b'\xff\xd8':
+        return None
+    f.seek(2 - len(start), os.SEEK_CUR)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            continue
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0xd8 or marker == 0x01 or 0xd0 <= marker <= 0xd7:
+            continue        # Markers without a segment
+        if marker in (0xd9, 0xda):
+            return None     # End of image or start of scan before any SOF
+        segment = f.read(2)
+        if len(segment) < 2:
+            return None
+        length = struct.unpack('>H', segment)[0]
+        if marker in jpeg_sof_markers:
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None
+            height, width = struct.unpack('>HH', sof[1:5])
+            return ImageInfo('JPEG', width, height)
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def parse_flac_picture(data):
+    # Split the data of a FLAC PICTURE block into the picture type and the
+    # image data itself.
+    picture_type, mime_len = struct.unpack_from('>II', data, 0)
+    pos = 8 + mime_len
+    desc_len = struct.unpack_from('>I', data, pos)[0]
+    pos += 4 + desc_len + 16
+    data_len = struct.unpack_from('>I', data, pos)[0]
+    return picture_type, data[pos + 4:pos + 4 + data_len]
+
+
+def parse_vorbis_comment(data):
+    # Split the data of a FLAC VORBIS_COMMENT block into the vendor string
+    # and a list of (name, value) tuples, in file order, with the original
+    # case of the tag names preserved.
+    def read_string(pos):
+        length = struct.unpack_from('<I', data, pos)[0]
+        pos += 4
+        return data[pos:pos + length].decode('UTF-8', errors='replace'), pos + length
+
+    vendor, pos = read_string(0)
+    count = struct.unpack_from('<I', data, pos)[0]
+    pos += 4
+    comments = []
+    for _ in range(count):
+        comment, pos = read_string(pos)
+        name, _, value = comment.partition('=')
+        comments.append((name, value))
+    return vendor, comments
+
+
+def make_vorbis_comment(vendor, comments):
+    # The reverse of parse_vorbis_comment
+    def string(text):
+        text = text.encode('UTF-8')
+        return struct.pack('<I', len(text)) + text
+
+    parts = [string(vendor), struct.pack('<I', len(comments))]
+    parts.extend(string('%s=%s' % comment) for comment in comments)
+    return b''.join(parts)
+
+
+class DisjointSets:
+    """
+    Union-find over hashable items, used to merge items matched in different
+    ways into a single group.
+    """
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        parent = self.parent.setdefault(item, item)
+        if parent != item:
+            parent = self.parent[item] = self.find(parent)
+        return parent
+
+    def union(self, item1, item2):
+        root1, root2 = self.find(item1), self.find(item2)
+        if root1 != root2:
+            self.parent[root2] = root1
+
+    def groups(self):
+        groups = collections.defaultdict(list)
+        for item in self.parent:
+            groups[self.find(item)].append(item)
+        return [sorted(group) for group in groups.values() if len(group) > 1]
+
+
+def uprint(*objects, sep=' ', end='\n', file=None):
     # Work around UnicodeEncodeErrors when attempting to print to the Windows
     # console using a non-unicode code page.  Replacement for builtin print()
-    enc = file.encoding
-    if enc == 'UTF-8':
+    # The default file is looked up on each call, so output can be captured
+    # with contextlib.redirect_stdout.
+    if file is None:
+        file = sys.stdout
+    enc = getattr(file, 'encoding', None)
+    if enc is None or enc == 'UTF-8':
         print(*objects, sep=sep, end=end, file=file)
     else:
         f = lambda obj: str(obj).encode(enc, errors='backslashreplace').decode(enc)
@@ -107,10 +338,185 @@ def flatten_tag(tag, sep='; '):
         return sep.join(tag)
 
 
+snapshot_version = 2
+snapshot_jobs = 8           # Albums read in parallel when exporting a snapshot
+snapshot_kept = {'.cue': None, '.txt': 512}     # Bytes of file contents saved
+snapshot = None             # Snapshot read instead of the disk, if loaded
+album_lookahead = 2         # Albums read ahead per thread by map_albums
+
+
+class Snapshot:
+    """
+    The directory listings, FLAC tags and STREAMINFO, and cuesheets and
+    extraction log headers of one or more trees, saved by export_snapshot so
+    the checks can be run later without access to the files themselves.
+    Code also creates these instance attributes:
+    snapshot.roots = list of the roots of the trees saved
+    snapshot.sep = path separator used by the saved paths
+    snapshot.dirs = dict mapping every directory under the roots, in the
+        order find_albums finds them, to a dict of
+        'entries' = list of [name, size, mtime] lists, with size and mtime
+            None for a directory
+        'tracks' = dict mapping FLAC file names to a [tags, streaminfo] pair,
+            where tags is a list of [tag name, values] pairs
+        'files' = dict mapping file names to the contents saved, as latin-1
+    Each directory is saved as a separate JSON string, only decoded when it's
+    first used, so even a large snapshot loads quickly.
+    """
+    def __init__(self, data):
+        if data.get('version') != snapshot_version:
+            raise ValueError('Snapshot is not from this version of the scripts')
+        self.roots = data['roots']
+        self.sep = data['sep']
+        self.dirs = data['dirs']
+
+    def under(self, path, root):
+        return path == root or path.startswith(root.rstrip(self.sep) + self.sep)
+
+    def covers(self, path):
+        return any(self.under(path, root) for root in self.roots)
+
+    def find_albums(self, root, pattern):
+        for path in list(self.dirs):
+            if self.under(path, root) and any(size is not None and fnmatch.fnmatch(name, pattern)
+                                              for name, size, _ in self.get_dir(path)['entries']):
+                yield path
+
+    def get_dir(self, path):
+        path = path.rstrip(self.sep) or path
+        info = self.dirs.get(path)
+        if info is None:
+            raise FileNotFoundError("'%s' not found in snapshot" % path)
+        if isinstance(info, str):
+            info = self.dirs[path] = json.loads(info)
+        return info
+
+    def open_file(self, path, name):
+        contents = self.get_dir(path)['files'].get(name)
+        if contents is None:
+            raise FileNotFoundError("'%s' not found in snapshot" % os.path.join(path, name))
+        return io.BytesIO(contents.encode('latin-1'))
+
+    def get_track(self, album_path, trackfile):
+        tags, info = self.get_dir(album_path)['tracks'][trackfile]
+        track = Track(tags)
+        track.file = trackfile
+        track.streaminfo = StreamInfo(*info[:-1], bytes.fromhex(info[-1]))
+        return track
+
+
+def load_snapshot(path):
+    # Load a snapshot saved by export_snapshot, and use it in place of the
+    # disk for any path under its roots.
+    global snapshot
+    with gzip.open(path, 'rt', encoding='UTF-8') as f:
+        snapshot = Snapshot(json.load(f))
+    return snapshot
+
+
+def export_snapshot(roots, path):
+    # Save a snapshot of the trees under roots for load_snapshot.  Returns
+    # the number of albums saved.
+    dirs = collections.OrderedDict()
+    for root in roots:
+        for dir_path, _, _ in sorted(os.walk(root)):
+            # Keep the entries in the order os.listdir gives them
+            entries = []
+            for entry in os.scandir(dir_path):
+                if entry.is_dir():
+                    entries.append([entry.name, None, None])
+                else:
+                    stat = entry.stat()
+                    entries.append([entry.name, stat.st_size, stat.st_mtime])
+            dirs[dir_path] = {'entries': entries, 'tracks': {}, 'files': {}}
+
+    def read_dir(dir_path):
+        info = dirs[dir_path]
+        for name, size, _ in info['entries']:
+            ext = os.path.splitext(name)[1].lower()
+            if size is None:
+                continue
+            if ext == '.flac':
+                track = get_track(dir_path, name)
+                info['tracks'][name] = [list(track.items()),
+                                        list(track.streaminfo[:-1]) +
+                                        [track.streaminfo.md5.hex()]]
+            elif ext in snapshot_kept:
+                with open(os.path.join(dir_path, name), 'rb') as f:
+                    info['files'][name] = f.read(snapshot_kept[ext]).decode('latin-1')
+
+    with ThreadPoolExecutor(snapshot_jobs) as executor:
+        list(executor.map(read_dir, dirs))
+    data = {
+        'version': snapshot_version,
+        'roots': list(roots),
+        'sep': os.sep,
+        'dirs': collections.OrderedDict(
+                (dir_path, json.dumps(info, ensure_ascii=False, separators=(',', ':')))
+                for dir_path, info in dirs.items()),
+    }
+    temp_path = path + '.tmp'
+    with gzip.open(temp_path, 'wt', encoding='UTF-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, path)
+    return sum(1 for info in dirs.values() if info['tracks'])
+
+
+def listdir(path):
+    # os.listdir, reading the loaded snapshot for paths it covers
+    if snapshot and snapshot.covers(path):
+        return [name for name, _, _ in snapshot.get_dir(path)['entries']]
+    return os.listdir(path)
+
+
+def isfile(path, name):
+    # Check if the directory path holds a file called name, using the loaded
+    # snapshot for paths it covers.
+    if snapshot and snapshot.covers(path):
+        return any(size is not None and entry == name
+                   for entry, size, _ in snapshot.get_dir(path)['entries'])
+    return os.path.isfile(os.path.join(path, name))
+
+
+def exists(path):
+    # os.path.exists, using the loaded snapshot for paths it covers
+    if snapshot and snapshot.covers(path):
+        parent, name = os.path.split(path.rstrip(snapshot.sep))
+        try:
+            return name in listdir(parent) or path in snapshot.dirs
+        except FileNotFoundError:
+            return False
+    return os.path.exists(path)
+
+
+def newest_mtime(path, pattern='*.flac'):
+    # Return the newest modification time of the files matching pattern in
+    # the directory path, or 0 if there are none.
+    if snapshot and snapshot.covers(path):
+        times = [mtime for name, size, mtime in snapshot.get_dir(path)['entries']
+                 if size is not None and fnmatch.fnmatch(name, pattern)]
+    else:
+        times = [entry.stat().st_mtime for entry in os.scandir(path)
+                 if fnmatch.fnmatch(entry.name, pattern) and entry.is_file()]
+    return max(times, default=0)
+
+
+def open_file(path, name):
+    # Open the file name in the directory path for reading as binary.  For
+    # paths the loaded snapshot covers, only the contents it saved are
+    # available (see snapshot_kept).
+    if snapshot and snapshot.covers(path):
+        return snapshot.open_file(path, name)
+    return open(os.path.join(path, name), 'rb')
+
+
 def find_albums(root, pattern='*.flac'):
     # Generator to find album directories.
     # Walk tree under root and yield all dirs that have at least
     # one .flac file in them.
+    if snapshot:
+        yield from snapshot.find_albums(root, pattern)
+        return
     for path, subdirs, files in sorted(os.walk(root)):
         for file in files:
             if fnmatch.fnmatch(file, pattern):
@@ -118,13 +524,38 @@ def find_albums(root, pattern='*.flac'):
                 break
 
 
+def map_albums(executor, func, album_paths, jobs):
+    # Generator yielding func(album_path) for each album in order, like
+    # executor.map, but keeping at most album_lookahead albums per job in
+    # flight, so the whole library isn't queued up front and the results
+    # aren't held until the caller gets to them.
+    pending = collections.deque()
+    album_paths = iter(album_paths)
+    while True:
+        for album_path in album_paths:
+            pending.append(executor.submit(func, album_path))
+            if len(pending) >= jobs * album_lookahead:
+                break
+        if not pending:
+            break
+        yield pending.popleft().result()
+
+
 def get_track(album_path, trackfile):
     # Read all the metadata tags from a FLAC file into a Track object.
-    # Use mutagen to retrieve the tags.
+    # Use mutagen to retrieve the tags, and keep the STREAMINFO it read too.
+    if snapshot and snapshot.covers(album_path):
+        return snapshot.get_track(album_path, trackfile)
     path = os.path.join(album_path, trackfile)
-    tags = mutagen.flac.Open(path).items()
-    track = Track(tags)
+    flac = mutagen.flac.Open(path)
+    track = Track(flac.items())
     track.file = trackfile
+    info = flac.info
+    track.streaminfo = StreamInfo(info.min_blocksize, info.max_blocksize,
+                                  info.min_framesize, info.max_framesize,
+                                  info.sample_rate, info.channels,
+                                  info.bits_per_sample, info.total_samples,
+                                  info.md5_signature.to_bytes(16, 'big'))
     return track
 
 
@@ -157,7 +588,7 @@ def get_album(album_path):
     msgs = Messages()
     album = Album()
     album.path = album_path
-    for trackfile in [f for f in os.listdir(album_path) if f.endswith('.flac')]:
+    for trackfile in [f for f in listdir(album_path) if f.endswith('.flac')]:
         track = get_track(album_path, trackfile)
         discnumber = check_critical_tag(track, 'discnumber', msgs)
         if discnumber is None:
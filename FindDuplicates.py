@@ -0,0 +1,205 @@
+#! python3
+
+# Find duplicate albums and tracks across one or more trees of FLAC albums.
+#
+# The library is read in a single pass, reading just the metadata blocks at
+# the start of each FLAC file, and every disc and track is added to hash
+# indexes, so the time taken grows linearly with the size of the library.
+#
+# Discs are matched on the tags CD Ripper saves from the CD itself.  Discs
+# with the same 'cdtoc' tag, or the same AccurateRip disc ID (the
+# 'accurateripdiscid' tag without its trailing track number), were ripped from
+# the same pressing, and are reported as duplicates.  Discs which only share
+# a 'cddb disc id' are reported as likely duplicates, since CDDB IDs are short
+# enough that different CDs do collide.
+#
+# Tracks are matched without decoding any audio, using the MD5 of the decoded
+# audio and the number of samples, both stored in the STREAMINFO block.
+# Tracks with the same sample count and MD5 have identical audio.  Tracks with
+# the same sample count and title, but different audio (e.g. the same track
+# ripped with a different read offset), are reported as likely duplicates.
+# Track duplicates are only shown when they aren't already explained by a
+# duplicate disc.
+
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import sys
+
+from CommonUtils import *
+from CommonUtils import uprint as print
+
+default_path = 'D:\\CDRip'
+default_jobs = 8
+
+args = None
+
+
+def parse_args():
+    global args
+    parser = argparse.ArgumentParser(
+            description='Find duplicate albums and tracks in trees of FLAC files.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', nargs='*', default=[default_path],
+                        help='root of a tree to search for albums of FLAC files')
+    parser.add_argument('-e', '--exact', action='store_true',
+                        help='only show exact duplicates, not likely ones')
+    parser.add_argument('-d', '--discs-only', action='store_true',
+                        help="don't look for duplicate tracks")
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs,
+                        help='number of albums to read in parallel')
+    args = parser.parse_args()
+
+
+def read_album(album_path):
+    # Read the tags and STREAMINFO of every FLAC file in an album folder.
+    # Returns a list of (file, tags, total_samples, md5) tuples, where tags
+    # is a dict of lists of values, keyed on the lower-cased tag name.
+    tracks = []
+    for file in sorted(os.listdir(album_path)):
+        if not file.endswith('.flac'):
+            continue
+        try:
+            header = FlacHeader(os.path.join(album_path, file))
+            streaminfo = header.streaminfo
+        except (OSError, ValueError) as e:
+            print('Warning: %s' % e, file=sys.stderr)
+            continue
+        tracks.append((file, header.get_tags(), streaminfo.total_samples, streaminfo.md5))
+    return tracks
+
+
+def disc_keys(tags):
+    # Return the (kind, value, exact) keys identifying the disc a track was
+    # ripped from.
+    keys = []
+    if 'cdtoc' in tags:
+        keys.append(('cdtoc', flatten_tag(tags['cdtoc']), True))
+    if 'accurateripdiscid' in tags:
+        disc_id = re.sub(r'-\d+$', '', flatten_tag(tags['accurateripdiscid']))
+        keys.append(('accurateripdiscid', disc_id, True))
+    if 'cddb disc id' in tags:
+        keys.append(('cddb disc id', flatten_tag(tags['cddb disc id']).lower(), False))
+    return keys
+
+
+def canon_title(title):
+    return re.sub(r'\W+', ' ', title.casefold()).strip()
+
+
+class Library:
+    """
+    Hash indexes of the discs and tracks read so far.  A disc is identified
+    by its (album path, disc number) pair.
+    """
+    def __init__(self):
+        self.disc_index = defaultdict(set)      # (kind, value, exact) -> discs
+        self.sample_index = defaultdict(list)   # total_samples -> tracks
+        self.disc_count = 0
+        self.track_count = 0
+
+    def add_album(self, album_path, tracks):
+        discs = set()
+        for file, tags, total_samples, md5 in tracks:
+            try:
+                discnumber = int(flatten_tag(tags.get('discnumber', ['1'])))
+            except ValueError:
+                discnumber = 1
+            disc = (album_path, discnumber)
+            discs.add(disc)
+            for key in disc_keys(tags):
+                self.disc_index[key].add(disc)
+            if not args.discs_only and total_samples:
+                title = canon_title(flatten_tag(tags.get('title', [''])))
+                self.sample_index[total_samples].append(
+                        (md5, title, disc, os.path.join(album_path, file)))
+        self.disc_count += len(discs)
+        self.track_count += len(tracks)
+
+    def duplicate_discs(self):
+        # Returns the groups of exact and likely duplicate discs, and the
+        # union-find of exact duplicates.
+        exact = DisjointSets()
+        likely = DisjointSets()
+        for (kind, value, is_exact), discs in self.disc_index.items():
+            if len(discs) < 2:
+                continue
+            discs = sorted(discs)
+            for disc in discs[1:]:
+                (exact if is_exact else likely).union(discs[0], disc)
+        # Drop likely groups that are all duplicates of each other anyway
+        likely_groups = [group for group in likely.groups()
+                         if len({exact.find(disc) for disc in group}) > 1]
+        return exact.groups(), likely_groups, exact
+
+    def duplicate_tracks(self, exact_discs):
+        # Returns the groups of exact and likely duplicate tracks, as lists of
+        # paths.  Groups whose tracks all come from duplicate discs are
+        # skipped.
+        exact_groups = []
+        likely_groups = []
+
+        def explained(entries):
+            return len({exact_discs.find(entry[2]) for entry in entries}) < 2
+
+        for total_samples, entries in self.sample_index.items():
+            if len(entries) < 2:
+                continue
+            by_md5 = defaultdict(list)
+            by_title = defaultdict(list)
+            for entry in entries:
+                md5, title = entry[0], entry[1]
+                if any(md5):
+                    by_md5[md5].append(entry)
+                if title:
+                    by_title[title].append(entry)
+            for group in by_md5.values():
+                if len(group) > 1 and not explained(group):
+                    exact_groups.append(sorted(entry[3] for entry in group))
+            for group in by_title.values():
+                if (len(group) > 1 and not explained(group) and
+                        len({entry[0] for entry in group}) > 1):
+                    likely_groups.append(sorted(entry[3] for entry in group))
+        return sorted(exact_groups), sorted(likely_groups)
+
+
+def disc_name(disc):
+    album_path, discnumber = disc
+    return '%s (Disc %d)' % (album_path, discnumber)
+
+
+def show_groups(title, groups, name=str):
+    if not groups:
+        return
+    print('\n%s:' % title)
+    for group in groups:
+        print()
+        for item in group:
+            print('  %s' % name(item))
+
+
+def main():
+    parse_args()
+    library = Library()
+    album_paths = (album_path for root in args.path for album_path in find_albums(root))
+    jobs = max(args.jobs, 1)
+    with ThreadPoolExecutor(jobs) as executor:
+        # map_albums() reads ahead, but returns the albums in order
+        for album_path, tracks in map_albums(executor, lambda path: (path, read_album(path)),
+                                             album_paths, jobs):
+            library.add_album(album_path, tracks)
+    exact_discs, likely_discs, exact_sets = library.duplicate_discs()
+    show_groups('Duplicate discs (same CD TOC or AccurateRip ID)', exact_discs, disc_name)
+    if not args.exact:
+        show_groups('Likely duplicate discs (same CDDB ID)', likely_discs, disc_name)
+    if not args.discs_only:
+        exact_tracks, likely_tracks = library.duplicate_tracks(exact_sets)
+        show_groups('Duplicate tracks (identical audio)', exact_tracks)
+        if not args.exact:
+            show_groups('Likely duplicate tracks (same length and title)', likely_tracks)
+    print('\nRead %d discs, %d tracks' % (library.disc_count, library.track_count))
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,19 @@
 #! python3
 
-import sys, os, glob, fnmatch, argparse
+# Find files with long pathnames.
+#
+# The trees are walked with os.scandir, passing down the length of each
+# directory's path instead of joining strings for every file, and the
+# top-level directories under each root are walked in parallel.  Besides
+# listing every long path, the script can show just the N longest paths, a
+# histogram of path lengths, or the worst offender in each album folder.
+
+import sys, os, heapq, argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 default_path = 'D:\\CDRip'
+default_jobs = 4
 
 def uprint(*objects, sep=' ', end='\n', file=sys.stdout):
     # Work around UnicodeEncodeErrors when attempting to print to the Windows
@@ -22,13 +33,160 @@ def parse_args():
                         help='root of tree to search for long paths')
     parser.add_argument('-l', '--len', type=int, default=250,
                         help='minimum path length to be reported')
-    return parser.parse_args()
+    parser.add_argument('-t', '--top', type=int, metavar='N',
+                        help='only show the N longest paths, longest first')
+    parser.add_argument('-H', '--histogram', type=int, nargs='?', const=10,
+                        metavar='WIDTH',
+                        help='show a histogram of the lengths of all paths, '
+                             'in buckets of WIDTH characters (default 10)')
+    parser.add_argument('-a', '--albums', action='store_true',
+                        help='show the longest path in each folder with '
+                             'paths of at least the minimum length, worst '
+                             'folders first')
+    parser.add_argument('-w', '--windows', action='store_true',
+                        help='count lengths in UTF-16 code units, the way '
+                             'Windows does')
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs,
+                        help='number of directories to walk in parallel')
+    args = parser.parse_args()
+    if args.histogram is not None and args.histogram < 1:
+        parser.error('--histogram WIDTH must be at least 1')
+    return args
+
+
+def name_len(name):
+    # Length of a pathname component, in UTF-16 code units for --windows.
+    # Characters outside the Basic Multilingual Plane take two code units.
+    if args.windows:
+        return len(name) + sum(1 for c in name if ord(c) > 0xffff)
+    return len(name)
+
+
+class Results:
+    """
+    Long paths and length statistics gathered while walking part of a tree.
+    Only the matches are kept as (dir, name) pairs, so strings are joined
+    just for the paths actually reported.
+    """
+    def __init__(self):
+        self.matches = []           # (length, dir, name) of long paths
+        self.lengths = Counter()    # path length -> number of files
+        self.longest = []           # heap of the args.top longest paths
+        self.folders = {}           # dir -> [worst length, name, count]
+
+    def add(self, path, name, length):
+        if args.histogram is not None:
+            self.lengths[length] += 1
+        if args.top:
+            item = (length, path, name)
+            if len(self.longest) < args.top:
+                heapq.heappush(self.longest, item)
+            elif item > self.longest[0]:
+                heapq.heapreplace(self.longest, item)
+        if length >= args.len:
+            if args.albums:
+                folder = self.folders.get(path)
+                if folder is None:
+                    self.folders[path] = [length, name, 1]
+                else:
+                    folder[2] += 1
+                    if length > folder[0]:
+                        folder[:2] = length, name
+            elif not args.top:
+                self.matches.append((length, path, name))
+
+    def merge(self, other):
+        self.matches += other.matches
+        self.lengths += other.lengths
+        for item in other.longest:
+            if len(self.longest) < args.top:
+                heapq.heappush(self.longest, item)
+            elif item > self.longest[0]:
+                heapq.heapreplace(self.longest, item)
+        self.folders.update(other.folders)
+
+
+def walk(path, path_len, results=None):
+    # Walk the tree under path, the length of which is path_len, recording
+    # each file in results.  Returns the results.
+    if results is None:
+        results = Results()
+    try:
+        entries = list(os.scandir(path))
+    except OSError as e:
+        uprint('Warning: %s' % e, file=sys.stderr)
+        return results
+    for entry in entries:
+        length = path_len + 1 + name_len(entry.name)
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            is_dir = False
+        if is_dir:
+            walk(entry.path, length, results)
+        else:
+            results.add(path, entry.name, length)
+    return results
+
+
+def walk_root(root):
+    # Walk a root, handling each of its top-level directories in parallel.
+    # Files directly under the root are handled here.
+    root_len = name_len(root.rstrip('\\/'))
+    results = Results()
+    subdirs = []
+    try:
+        entries = sorted(os.scandir(root), key=lambda e: e.name)
+    except OSError as e:
+        uprint('Warning: %s' % e, file=sys.stderr)
+        return results
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append((entry.path, root_len + 1 + name_len(entry.name)))
+        else:
+            results.add(root, entry.name, root_len + 1 + name_len(entry.name))
+    show_matches(results)
+    with ThreadPoolExecutor(max(args.jobs, 1)) as executor:
+        # map() returns the results in order, so long paths can be printed
+        # as soon as each top-level directory is done.
+        for subdir_results in executor.map(lambda d: walk(*d), subdirs):
+            show_matches(subdir_results)
+            results.merge(subdir_results)
+    return results
+
+
+def show_matches(results):
+    # Print the long paths found so far, then forget them.
+    for length, path, name in sorted(results.matches, key=lambda m: (m[1], m[2])):
+        uprint('%d %s' % (length, os.path.join(path, name)))
+    results.matches = []
+
+
+def show_histogram(lengths):
+    width = args.histogram
+    if not lengths:
+        return
+    counts = Counter()
+    for length, count in lengths.items():
+        counts[length // width * width] += count
+    scale = max(counts.values())
+    for bucket in range(min(counts), max(counts) + 1, width):
+        count = counts[bucket]
+        bar = '#' * (count * 50 // scale if count else 0)
+        uprint('%4d-%-4d %8d %s' % (bucket, bucket + width - 1, count, bar))
 
 
 args = parse_args()
+results = Results()
 for root in args.path:
-    for path, _, files in os.walk(root):
-        for file in files:
-            p = os.path.join(path, file)
-            if len(p) >= args.len:
-                uprint('%d %s' % (len(p), p))
+    results.merge(walk_root(root))
+if args.top:
+    for length, path, name in sorted(results.longest, reverse=True):
+        uprint('%d %s' % (length, os.path.join(path, name)))
+if args.albums:
+    for path, (length, name, count) in sorted(results.folders.items(),
+                                               key=lambda f: (-f[1][0], f[0])):
+        uprint('%d %s (%d path%s of %d+)' % (length, os.path.join(path, name),
+               count, '' if count == 1 else 's', args.len))
+if args.histogram is not None:
+    show_histogram(results.lengths)
@@ -0,0 +1,204 @@
+#! python3
+
+# Find likely variant spellings of names across a library of FLAC albums,
+# e.g. 'Tchaikovsky' versus 'Tschaikowsky', or 'Berliner Philharmoniker'
+# versus 'Berlin Philharmonic Orchestra'.
+#
+# Every distinct value of the name tags is reduced to a skeleton: case,
+# accents and punctuation are dropped, a trailing ', The' is moved to the
+# front, doubled letters are collapsed, and letter groups that are often
+# transliterated differently (e.g. 'tsch', 'tch' and 'ch', or 'w' and 'v')
+# are merged.  Names with the same skeleton are variants of each other.
+#
+# To find variants with different skeletons without comparing every pair of
+# names, the skeletons are indexed on their character trigrams.  Trigrams
+# shared by too many names say little and are left out of the index.  Only
+# names sharing enough indexed trigrams are compared, word by word: two names
+# are variants if each word of the name with fewer words matches a different
+# word of the other name, either by being a prefix of it, or by having
+# similar trigrams.
+#
+# Variants are merged into clusters, which are shown with the number of
+# tracks using each variant.
+
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import sys
+import unicodedata
+
+from CommonUtils import *
+from CommonUtils import uprint as print
+
+default_path = 'D:\\CDRip'
+default_fields = 'artist,albumartist,composer,conductor,orchestra,label'
+default_jobs = 8
+
+max_trigram_share = 0.01    # Skip trigrams used by more than 1% of names...
+min_trigram_names = 50      # ...unless they're used by fewer than this many
+min_shared_trigrams = 2     # Indexed trigrams a pair must share to be compared
+min_prefix_ratio = 0.7      # Shortest word prefix, relative to the full word
+
+# Letter groups merged when building skeletons, applied in order
+skeleton_subs = (
+    ('tsch', 'ch'), ('tch', 'ch'), ('sch', 'sh'), ('ph', 'f'), ('th', 't'),
+    ('ck', 'k'), ('ch', 'k'), ('c', 'k'), ('kh', 'k'), ('w', 'v'), ('y', 'i'),
+    ('z', 's'),
+)
+
+moved_articles = ('the', 'los', 'la', 'le', 'les', 'die', 'der')
+
+args = None
+
+
+def parse_args():
+    global args
+    parser = argparse.ArgumentParser(
+            description='Find likely variant spellings of names in trees of FLAC files.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', nargs='*', default=[default_path],
+                        help='root of a tree to search for albums of FLAC files')
+    parser.add_argument('-f', '--fields', default=default_fields,
+                        help='comma-separated list of the tags to check')
+    parser.add_argument('-t', '--threshold', type=float, default=0.7,
+                        help='minimum trigram similarity (0 to 1) for two '
+                             'words to match')
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs,
+                        help='number of albums to read in parallel')
+    args = parser.parse_args()
+    args.fields = {field.strip().lower() for field in args.fields.split(',')}
+
+
+def read_album_names(album_path):
+    # Return a Counter of (tag, value) pairs for the name tags of every FLAC
+    # file in an album folder, reading just the metadata blocks.
+    names = Counter()
+    for file in os.listdir(album_path):
+        if not file.endswith('.flac'):
+            continue
+        try:
+            tags = FlacHeader(os.path.join(album_path, file)).get_tags()
+        except (OSError, ValueError) as e:
+            print('Warning: %s' % e, file=sys.stderr)
+            continue
+        for tag in args.fields & set(tags):
+            for value in tags[tag]:
+                if value.strip():
+                    names[(tag, value.strip())] += 1
+    return names
+
+
+def skeleton(name):
+    name = unicodedata.normalize('NFKD', name.casefold())
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    match = re.match(r'(.*), (%s)$' % '|'.join(moved_articles), name)
+    if match:
+        name = '%s %s' % (match.group(2), match.group(1))
+    name = re.sub(r'[\W_]+', ' ', name)
+    for old, new in skeleton_subs:
+        name = name.replace(old, new)
+    name = re.sub(r'(.)\1+', r'\1', name)
+    return name.strip()
+
+
+def trigrams(text):
+    text = ' %s ' % text
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def similarity(grams1, grams2):
+    # Dice coefficient of two sets of trigrams
+    return 2 * len(grams1 & grams2) / (len(grams1) + len(grams2))
+
+
+def words_match(word1, word2):
+    if word1 == word2:
+        return True
+    short, long = sorted((word1, word2), key=len)
+    if long.startswith(short) and len(short) >= min_prefix_ratio * len(long):
+        return True
+    return similarity(trigrams(word1), trigrams(word2)) >= args.threshold
+
+
+def names_match(skeleton1, skeleton2):
+    # Check that every word of the skeleton with fewer words matches a
+    # different word of the other skeleton.
+    words1, words2 = sorted((skeleton1.split(), skeleton2.split()), key=len)
+    unused = list(words2)
+    for word in words1:
+        for index, other in enumerate(unused):
+            if words_match(word, other):
+                del unused[index]
+                break
+        else:
+            return False
+    return True
+
+
+def find_clusters(skeletons):
+    # Given a list of distinct skeletons, return a DisjointSets of the indexes
+    # of skeletons which are variants of each other.
+    grams = [trigrams(skel) for skel in skeletons]
+    index = defaultdict(list)
+    for i, skel_grams in enumerate(grams):
+        for gram in skel_grams:
+            index[gram].append(i)
+    max_names = max(min_trigram_names, int(len(skeletons) * max_trigram_share))
+    clusters = DisjointSets()
+    for i, skel_grams in enumerate(grams):
+        shared = Counter()
+        for gram in skel_grams:
+            names = index[gram]
+            if len(names) <= max_names:
+                shared.update(j for j in names if j > i)
+        needed = min(min_shared_trigrams, len(skel_grams))
+        for j, count in shared.items():
+            if count >= needed and names_match(skeletons[i], skeletons[j]):
+                clusters.union(i, j)
+    return clusters
+
+
+def main():
+    parse_args()
+    counts = Counter()      # (tag, value) -> track count
+    album_paths = (album_path for root in args.path for album_path in find_albums(root))
+    jobs = max(args.jobs, 1)
+    with ThreadPoolExecutor(jobs) as executor:
+        for names in map_albums(executor, read_album_names, album_paths, jobs):
+            counts.update(names)
+    # Group the distinct names by skeleton, then cluster the skeletons
+    by_name = defaultdict(Counter)      # value -> Counter of tag -> tracks
+    for (tag, value), count in counts.items():
+        by_name[value][tag] += count
+    by_skeleton = defaultdict(list)
+    for value in by_name:
+        skel = skeleton(value)
+        if skel:
+            by_skeleton[skel].append(value)
+    skeletons = sorted(by_skeleton)
+    clusters = find_clusters(skeletons)
+    members = defaultdict(list)
+    for i in range(len(skeletons)):
+        members[clusters.find(i)].append(i)
+    groups = []
+    for group in members.values():
+        values = [value for i in group for value in by_skeleton[skeletons[i]]]
+        if len(values) > 1:
+            values.sort(key=lambda value: (-sum(by_name[value].values()), value))
+            groups.append(values)
+    groups.sort(key=lambda values: (-sum(sum(by_name[value].values()) for value in values),
+                                    values[0]))
+    for values in groups:
+        print()
+        for index, value in enumerate(values):
+            tags = by_name[value]
+            total = sum(tags.values())
+            print('%s%s (%d track%s: %s)' %
+                  ('' if index == 0 else '  ', value, total, '' if total == 1 else 's',
+                   ', '.join(sorted(tags))))
+    print('\nFound %d groups of variants among %d distinct names' % (len(groups), len(by_name)))
+
+if __name__ == '__main__':
+    main()
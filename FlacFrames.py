@@ -0,0 +1,665 @@
+#! python3
+
+# Contains code to walk, verify and decode the audio frames of FLAC files,
+# used by my dBpoweramp FLAC-handling scripts.
+#
+# Every FLAC frame starts with a sync code and a header protected by a CRC-8,
+# and ends with a CRC-16 of the whole frame.  Checking those CRCs, and that
+# the frames add up to the number of samples given in the STREAMINFO block,
+# catches truncated or corrupted files without decoding any audio.
+#
+# CRCs are table-driven, processing 16 bits at a time.  If numpy is available,
+# the CRC-16s of many frames are computed at once, which is fast enough to
+# keep up with the disk.
+#
+# The audio can also be decoded, with numpy, to check it against the MD5 in
+# the STREAMINFO block and find its peak level.
+
+import array
+import collections
+import hashlib
+import mmap
+import re
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from CommonUtils import FlacHeader
+
+FrameHeader = collections.namedtuple('FrameHeader', (
+    'pos', 'length', 'variable', 'number', 'blocksize', 'sample_rate',
+    'channel_assignment', 'sample_size'))
+
+sync_re = re.compile(b'\xff[\xf8\xf9]')
+
+max_frame_gap = 64          # Max frames skipped when resyncing after damage
+max_reported_frames = 5     # Max bad frames listed individually per file
+crc_batch_bytes = 1 << 21   # Bytes of frame data per numpy CRC-16 batch
+
+sample_rates = (None, 88200, 176400, 192000, 8000, 16000, 22050, 24000,
+                32000, 44100, 48000, 96000)
+sample_sizes = (None, 8, 12, None, 16, 20, 24, 32)
+
+
+def _make_crc_table(bits, poly):
+    top = 1 << (bits - 1)
+    mask = (1 << bits) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (bits - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & top else (crc << 1)
+        table.append(crc & mask)
+    return table
+
+
+crc8_table = _make_crc_table(8, 0x07)
+crc16_table = _make_crc_table(16, 0x8005)
+
+# CRC-16 table for 16-bit words: since the CRC register is also 16 bits wide,
+# the register after a word depends only on (register XOR word).
+crc16_word_table = [0] * 65536
+for _word in range(65536):
+    _crc = ((_word << 8) & 0xffff) ^ crc16_table[_word >> 8]
+    crc16_word_table[_word] = ((_crc << 8) & 0xffff) ^ crc16_table[_crc >> 8]
+if numpy:
+    crc16_word_array = numpy.array(crc16_word_table, dtype=numpy.uint16)
+    # Count of leading zero bits in each 16-bit value
+    leading_zeros = 16 - numpy.frexp(numpy.arange(65536, dtype=numpy.float64))[1]
+    leading_zeros = leading_zeros.astype(numpy.uint64)
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = crc8_table[crc ^ byte]
+    return crc
+
+
+def crc16(data):
+    # The CRC starts at zero, so leading zero bytes don't change it, and an
+    # odd length can be padded at the front to make whole words.
+    if len(data) % 2:
+        data = b'\0' + data
+    words = array.array('H', bytes(data))
+    if sys.byteorder == 'little':
+        words.byteswap()
+    crc = 0
+    table = crc16_word_table
+    for word in words:
+        crc = table[crc ^ word]
+    return crc
+
+
+def crc16_spans(data, spans):
+    # Return the CRC-16 of each (start, end) span of data.  With numpy, a
+    # batch of spans is processed together, as columns of a 2-D array with
+    # shorter spans padded with leading zeros.
+    if not numpy:
+        return [crc16(data[start:end]) for start, end in spans]
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    crcs = []
+    index = 0
+    while index < len(spans):
+        longest = spans[index][1] - spans[index][0]
+        count = 1
+        while index + count < len(spans):
+            length = spans[index + count][1] - spans[index + count][0]
+            if max(longest, length) * (count + 1) > crc_batch_bytes:
+                break
+            longest = max(longest, length)
+            count += 1
+        batch = spans[index:index + count]
+        index += count
+        width = longest + longest % 2
+        starts = numpy.array([start for start, _ in batch])
+        ends = numpy.array([end for _, end in batch])
+        positions = ends[numpy.newaxis, :] - width + numpy.arange(width)[:, numpy.newaxis]
+        frames = numpy.where(positions >= starts, buf[numpy.maximum(positions, 0)], 0)
+        words = (frames[0::2].astype(numpy.uint16) << 8) | frames[1::2]
+        crc = numpy.zeros(len(batch), dtype=numpy.uint16)
+        for row in words:
+            crc = crc16_word_array[crc ^ row]
+        crcs.extend(crc.tolist())
+        del positions, frames, words
+    del buf
+    return crcs
+
+
+def parse_frame_header(data, pos, streaminfo=None):
+    # Parse the frame header at data[pos].  Returns a FrameHeader, or None if
+    # there's no valid header there (no sync code, reserved values used, or a
+    # bad CRC-8).  Sample rate and size come from streaminfo when the header
+    # says to use those values.
+    end = len(data)
+    if pos + 6 > end or data[pos] != 0xff or data[pos + 1] & 0xfe != 0xf8:
+        return None
+    variable = bool(data[pos + 1] & 1)
+    block_code = data[pos + 2] >> 4
+    rate_code = data[pos + 2] & 0xf
+    channel_assignment = data[pos + 3] >> 4
+    size_code = (data[pos + 3] >> 1) & 0x7
+    if (block_code == 0 or rate_code == 15 or channel_assignment > 10 or
+            size_code in (3,) or data[pos + 3] & 1):
+        return None
+    # The frame or sample number is UTF-8 style coded
+    first = data[pos + 4]
+    if first < 0x80:
+        extra, number = 0, first
+    elif first >= 0xc0 and first != 0xff:
+        extra = 1
+        while first & (0x40 >> extra) and extra < 6:
+            extra += 1
+        number = first & (0x3f >> extra)
+    else:
+        return None
+    cur = pos + 5
+    if cur + extra > end:
+        return None
+    for byte in data[cur:cur + extra]:
+        if byte & 0xc0 != 0x80:
+            return None
+        number = (number << 6) | (byte & 0x3f)
+    cur += extra
+    if block_code == 1:
+        blocksize = 192
+    elif block_code <= 5:
+        blocksize = 576 << (block_code - 2)
+    elif block_code == 6:
+        blocksize = data[cur] + 1 if cur < end else 0
+        cur += 1
+    elif block_code == 7:
+        blocksize = int.from_bytes(data[cur:cur + 2], 'big') + 1
+        cur += 2
+    else:
+        blocksize = 256 << (block_code - 8)
+    if rate_code == 0:
+        sample_rate = streaminfo.sample_rate if streaminfo else None
+    elif rate_code < 12:
+        sample_rate = sample_rates[rate_code]
+    elif rate_code == 12:
+        sample_rate = data[cur] * 1000 if cur < end else 0
+        cur += 1
+    else:
+        sample_rate = int.from_bytes(data[cur:cur + 2], 'big')
+        if rate_code == 14:
+            sample_rate *= 10
+        cur += 2
+    if cur >= end or crc8(data[pos:cur]) != data[cur]:
+        return None
+    if size_code == 0:
+        sample_size = streaminfo.bits_per_sample if streaminfo else None
+    else:
+        sample_size = sample_sizes[size_code]
+    return FrameHeader(pos, cur + 1 - pos, variable, number, blocksize,
+                       sample_rate, channel_assignment, sample_size)
+
+
+def matches_streaminfo(header, streaminfo):
+    # Check that a frame header agrees with STREAMINFO on the sample size,
+    # sample rate, channel count and block size.  Only the last frame may be
+    # shorter than the minimum block size.
+    if streaminfo is None:
+        return True
+    channels = header.channel_assignment + 1 if header.channel_assignment < 8 else 2
+    if (header.sample_size != streaminfo.bits_per_sample or
+            header.sample_rate != streaminfo.sample_rate or
+            channels != streaminfo.channels or
+            header.blocksize > streaminfo.max_blocksize):
+        return False
+    if header.blocksize < streaminfo.min_blocksize and streaminfo.total_samples:
+        first = header.number if header.variable else header.number * streaminfo.max_blocksize
+        return first + header.blocksize == streaminfo.total_samples
+    return True
+
+
+def frame_ends_at(data, frame, pos):
+    # Check if the frame starting at frame.pos ends at pos, by its CRC-16
+    return crc16(data[frame.pos:pos]) == 0
+
+
+def expected_frame_follows(data, frame, pos, expected, streaminfo):
+    # Check if the frame numbered expected starts after pos, where the frame
+    # before it ends.  The search stops at the largest size a frame can be.
+    if streaminfo is None:
+        return False
+    limit = frame.pos + (streaminfo.max_framesize or
+                         streaminfo.max_blocksize * streaminfo.channels *
+                         (streaminfo.bits_per_sample + 7) // 8 + 64)
+    for match in sync_re.finditer(data, pos + 2, min(limit + 2, len(data))):
+        header = parse_frame_header(data, match.start(), streaminfo)
+        if (header and header.number == expected and
+                matches_streaminfo(header, streaminfo) and
+                frame_ends_at(data, frame, header.pos)):
+            return True
+    return False
+
+
+def find_frames(data, start, streaminfo=None):
+    # Find the headers of the audio frames in data, starting at offset start.
+    # A header is only accepted if it continues the sequence of frame (or
+    # sample) numbers and agrees with STREAMINFO, so a sync code that happens
+    # to appear inside the audio data is ignored.  After damage, the sequence
+    # is picked up again if a header is found within max_frame_gap frames,
+    # unless the previous frame doesn't end there and the expected frame
+    # turns up after it, which means the header was inside the audio data
+    # too.  Returns the list of FrameHeaders, and a list of (position,
+    # expected number, found number) for each gap in the sequence.
+    frames = []
+    gaps = []
+    expected = 0
+    next_pos = start
+    for match in sync_re.finditer(data, start):
+        pos = match.start()
+        if pos < next_pos:
+            continue
+        header = parse_frame_header(data, pos, streaminfo)
+        if header is None or not matches_streaminfo(header, streaminfo):
+            continue
+        if header.number != expected:
+            step = header.blocksize if header.variable else 1
+            if not expected < header.number <= expected + max_frame_gap * step:
+                continue
+            if (frames and not frame_ends_at(data, frames[-1], pos) and
+                    expected_frame_follows(data, frames[-1], pos, expected, streaminfo)):
+                continue
+            gaps.append((pos, expected, header.number))
+        frames.append(header)
+        expected = header.number + (header.blocksize if header.variable else 1)
+        next_pos = pos + header.length
+    return frames, gaps
+
+
+def verify_frames(path):
+    # Verify the audio frames of a FLAC file by checking the CRCs of every
+    # frame and adding up the samples, without decoding the audio.  Returns a
+    # list of problems found, empty if the file is fine.
+    try:
+        header = FlacHeader(path)
+        streaminfo = header.streaminfo
+    except (OSError, ValueError) as e:
+        return [str(e)]
+    if header.audio_size <= 0:
+        return ['No audio data']
+    problems = []
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            end = len(data)
+            if data[end - 128:end - 125] == b'TAG':
+                end -= 128      # Ignore an ID3v1 tag at the end
+            frames, gaps = find_frames(data, header.audio_offset, streaminfo)
+            if not frames:
+                return ['No valid audio frames found']
+            if frames[0].pos != header.audio_offset:
+                problems.append('Audio does not start with a valid frame header')
+            for pos, expected, found in gaps:
+                problems.append('Frames missing or damaged at offset %d '
+                                '(expected frame %d, found %d)' % (pos, expected, found))
+            spans = [(frame.pos, next_frame.pos)
+                     for frame, next_frame in zip(frames, frames[1:])]
+            spans.append((frames[-1].pos, end))
+            bad = [index for index, crc in enumerate(crc16_spans(data, spans)) if crc]
+        finally:
+            data.close()
+    if bad:
+        if bad[-1] == len(frames) - 1:
+            problems.append('Last frame fails CRC-16 check (truncated file?)')
+            bad.pop()
+        if bad:
+            listed = ', '.join(str(frames[index].number)
+                               for index in bad[:max_reported_frames])
+            if len(bad) > max_reported_frames:
+                listed += ', ...'
+            problems.append('%d frame%s fail%s CRC-16 check: %s' %
+                            (len(bad), '' if len(bad) == 1 else 's',
+                             's' if len(bad) == 1 else '', listed))
+    samples = sum(frame.blocksize for frame in frames)
+    if streaminfo.total_samples and samples != streaminfo.total_samples:
+        problems.append('Frames hold %d samples, STREAMINFO total_samples is %d' %
+                        (samples, streaminfo.total_samples))
+    return problems
+
+
+# Decoding the audio, to check the STREAMINFO MD5 and find the peak sample.
+#
+# Each subframe is a predictor (constant, verbatim, fixed polynomial or LPC)
+# plus a Rice-coded residual, and both steps are serial within a subframe.
+# So instead, a batch of frames is decoded together, one frame per numpy
+# lane: every step decodes the next residual, or restores the next sample,
+# of all the frames at once.  Only the subframe headers are parsed one at a
+# time.
+
+Subframe = collections.namedtuple('Subframe', (
+    'kind', 'wasted', 'order', 'values', 'coefs', 'shift', 'param_bits',
+    'partition_order', 'pos'))
+
+SUBFRAME_CONSTANT, SUBFRAME_VERBATIM, SUBFRAME_FIXED, SUBFRAME_LPC = range(4)
+
+decode_batch_frames = 1024  # Frames decoded together, one per numpy lane
+fixed_coefs = ((), (1,), (2, -1), (3, -3, 1), (4, -6, 4, -1))
+
+
+def read_bits(data, pos, count):
+    # Return the unsigned count-bit value at bit position pos of data
+    start = pos >> 3
+    end = (pos + count + 7) >> 3
+    if end > len(data):
+        raise ValueError('Subframe runs past the end of the file')
+    value = int.from_bytes(data[start:end], 'big')
+    return (value >> (end * 8 - pos - count)) & ((1 << count) - 1)
+
+
+def read_signed(data, pos, count):
+    value = read_bits(data, pos, count)
+    if count and value >> (count - 1):
+        value -= 1 << count
+    return value
+
+
+def read_rice(data, pos, param):
+    # Return a Rice-coded residual and the position after it, a bit at a
+    # time.  Only used for the rare residuals too long for _decode_residuals.
+    quotient = 0
+    while not read_bits(data, pos, 1):
+        quotient += 1
+        pos += 1
+    value = (quotient << param) | read_bits(data, pos + 1, param)
+    return (value >> 1) ^ -(value & 1), pos + 1 + param
+
+
+def parse_subframe(data, pos, sample_size, blocksize):
+    # Parse the subframe at bit position pos of data.  Returns a Subframe,
+    # where values holds the constant value, the verbatim samples or the
+    # warm-up samples of a predictor, and pos is the position of the
+    # residual, or the end of the subframe if it has none.  Raises ValueError
+    # for anything malformed.
+    header = read_bits(data, pos, 8)
+    pos += 8
+    if header & 0x80:
+        raise ValueError('Bad subframe header')
+    wasted = 0
+    if header & 1:
+        wasted = 1
+        while not read_bits(data, pos, 1):
+            wasted += 1
+            pos += 1
+        pos += 1
+    size = sample_size - wasted
+    code = (header >> 1) & 0x3f
+    if code == 0:
+        return Subframe(SUBFRAME_CONSTANT, wasted, 0, [read_signed(data, pos, size)],
+                        (), 0, 0, 0, pos + size)
+    if code == 1:
+        values = [read_signed(data, pos + index * size, size) for index in range(blocksize)]
+        return Subframe(SUBFRAME_VERBATIM, wasted, 0, values, (), 0, 0, 0,
+                        pos + blocksize * size)
+    if 8 <= code <= 12:
+        kind, order = SUBFRAME_FIXED, code - 8
+    elif code >= 32:
+        kind, order = SUBFRAME_LPC, code - 31
+    else:
+        raise ValueError('Reserved subframe type %d' % code)
+    if order > blocksize:
+        raise ValueError('Predictor order %d exceeds block size %d' % (order, blocksize))
+    values = [read_signed(data, pos + index * size, size) for index in range(order)]
+    pos += order * size
+    coefs = fixed_coefs[order] if kind == SUBFRAME_FIXED else ()
+    shift = 0
+    if kind == SUBFRAME_LPC:
+        precision = read_bits(data, pos, 4) + 1
+        shift = read_signed(data, pos + 4, 5)
+        pos += 9
+        if precision == 16 or shift < 0:
+            raise ValueError('Bad LPC precision or shift')
+        coefs = tuple(read_signed(data, pos + index * precision, precision)
+                      for index in range(order))
+        pos += order * precision
+    method = read_bits(data, pos, 2)
+    if method > 1:
+        raise ValueError('Reserved residual coding method %d' % method)
+    partition_order = read_bits(data, pos + 2, 4)
+    pos += 6
+    if (blocksize % (1 << partition_order) or
+            (blocksize >> partition_order) < order):
+        raise ValueError('Bad residual partition order %d' % partition_order)
+    return Subframe(kind, wasted, order, values, coefs, shift, 4 + method,
+                    partition_order, pos)
+
+
+def _windows(buf, pos):
+    # Return the 64 bits of buf starting at the byte holding each bit position
+    # in pos, shifted so each window starts at its bit.  At least 57 bits of
+    # each window are valid, enough for any Rice code with a quotient under
+    # 16.  buf is a view of the file's bytes with a row of 8 bytes starting at
+    # each byte (see verify_audio).
+    words = buf[pos >> numpy.uint64(3)].view('>u8')[:, 0].astype(numpy.uint64)
+    return words << (pos & numpy.uint64(7))
+
+
+def _decode_residuals(data, buf, pos, orders, blocksizes, param_bits, partition_orders):
+    # Decode the Rice-coded residuals of a batch of subframes, one per lane,
+    # starting at the bit positions in pos.  Returns an array with the
+    # residual of each lane's sample n in column n (the first order columns
+    # are left zero), and the bit position after each lane's residual.
+    one = numpy.uint64(1)
+    lanes = len(pos)
+    width = int(blocksizes.max())
+    residuals = numpy.zeros((lanes, width), dtype=numpy.int64, order='F')
+    pos = pos.astype(numpy.uint64)
+    param_bits = param_bits.astype(numpy.uint64)
+    partition_lengths = blocksizes >> partition_orders
+    params = numpy.zeros(lanes, dtype=numpy.uint64)
+    low_shifts = numpy.zeros(lanes, dtype=numpy.uint64)
+    escape_bits = numpy.zeros(lanes, dtype=numpy.uint64)
+    escaped = numpy.zeros(lanes, dtype=bool)
+    any_escaped = False
+    # Every lane is decoding from the highest order to the smallest blocksize,
+    # and only needs to read a Rice parameter at the start of a partition
+    all_active = range(int(orders.max()), int(blocksizes.min()))
+    partition_starts = set(orders.tolist())
+    for length in set(partition_lengths.tolist()):
+        partition_starts.update(range(length, width, length))
+    for n in range(int(orders.min()), width):
+        active = None if n in all_active else (n >= orders) & (n < blocksizes)
+        if n in partition_starts:
+            starting = (n % partition_lengths == 0) | (n == orders)
+            if active is not None:
+                starting &= active
+            lane = numpy.flatnonzero(starting)
+            window = _windows(buf, pos[lane])
+            bits = param_bits[lane]
+            param = window >> (numpy.uint64(64) - bits)
+            escape = param == (one << bits) - one
+            params[lane] = numpy.where(escape, 0, param)
+            low_shifts[lane] = numpy.uint64(64) - params[lane]
+            escape_bits[lane] = numpy.where(escape, (window << bits) >> numpy.uint64(59), 0)
+            escaped[lane] = escape
+            any_escaped = escaped.any()
+            pos[lane] += bits + escape * numpy.uint64(5)
+        window = _windows(buf, pos)
+        # The quotient is the count of zeros before the first one bit, found
+        # from the top 16 bits of the window; longer ones are decoded slowly
+        top = window >> numpy.uint64(48)
+        quotient = leading_zeros[top]
+        step = quotient + one
+        value = (quotient << params) | ((window << step) >> low_shifts)
+        step += params
+        value = value.view(numpy.int64)
+        value = (value >> 1) ^ -(value & 1)
+        slow = None if top.all() else top == 0
+        if any_escaped:
+            raw = escaped if active is None else escaped & active
+            raw = numpy.flatnonzero(raw)
+            bits = escape_bits[raw]
+            value[raw] = numpy.where(bits > 0, window[raw].view(numpy.int64) >>
+                                     (64 - bits.astype(numpy.int64)), 0)
+            step[raw] = bits
+            if slow is not None:
+                slow[raw] = False
+        if slow is not None:
+            if active is not None:
+                slow &= active
+            for lane in numpy.flatnonzero(slow):
+                value[lane], end = read_rice(data, int(pos[lane]), int(params[lane]))
+                step[lane] = end - int(pos[lane])
+        residuals[:, n] = value
+        if active is None:
+            pos += step
+        else:
+            pos += numpy.where(active, step, 0).astype(numpy.uint64)
+    return residuals, pos.astype(numpy.int64)
+
+
+def _restore_samples(residuals, warmups, coefs, shifts, orders, blocksizes):
+    # Undo the prediction of a batch of subframes, one per lane.  residuals
+    # holds each lane's residual by sample number, warmups each lane's list of
+    # warm-up samples, and coefs each lane's predictor coefficients, most
+    # recent sample first.  Returns the samples.  Arrays are kept in column
+    # order, so each step works on contiguous memory.
+    lanes, width = residuals.shape
+    history = max(int(orders.max()), 1)
+    samples = numpy.zeros((lanes, history + width), dtype=numpy.int64, order='F')
+    for lane, values in enumerate(warmups):
+        if values:
+            samples[lane, history:history + len(values)] = values
+    # Coefficients laid out to match the window of preceding samples
+    taps = numpy.zeros((lanes, history), dtype=numpy.int64, order='F')
+    for lane, lane_coefs in enumerate(coefs):
+        if lane_coefs:
+            taps[lane, history - len(lane_coefs):] = lane_coefs[::-1]
+    predicted = orders > 0
+    if predicted.any():
+        # Lanes that aren't predicted are filled in afterwards, so only the
+        # steps outside every lane's range need masking
+        all_active = range(int(orders.max()), int(blocksizes.min()))
+        for n in range(int(orders[predicted].min()), width):
+            prediction = numpy.einsum('ij,ij->i', samples[:, n:n + history], taps) >> shifts
+            if n in all_active:
+                samples[:, history + n] = residuals[:, n] + prediction
+            else:
+                active = (n >= orders) & (n < blocksizes)
+                samples[active, history + n] = residuals[active, n] + prediction[active]
+    if not predicted.all():
+        samples[~predicted, history:] = residuals[~predicted]
+    return samples[:, history:]
+
+
+def decode_frames(data, buf, frames, streaminfo):
+    # Decode a batch of audio frames, returning each frame's samples as an
+    # array of shape (blocksize, channels).  data holds the whole file, and
+    # buf the same as rows of 8 bytes (see _windows).  The subframes of every
+    # channel of every frame are lanes of the same arrays, channel by channel.
+    channels = streaminfo.channels
+    lanes = len(frames)
+    blocksizes = numpy.array([frame.blocksize for frame in frames])
+    width = int(blocksizes.max())
+    pos = [(frame.pos + frame.length) * 8 for frame in frames]
+    residuals = numpy.zeros((channels * lanes, width), dtype=numpy.int64, order='F')
+    subframes = []
+    for channel in range(channels):
+        rows = residuals[channel * lanes:(channel + 1) * lanes]
+        parsed = []
+        for lane, frame in enumerate(frames):
+            assignment = frame.channel_assignment
+            if (assignment + 1 if assignment < 8 else 2) != channels:
+                raise ValueError('Frame %d has the wrong number of channels' % frame.number)
+            if not frame.sample_size:
+                raise ValueError('Frame %d has no sample size' % frame.number)
+            # The side channel of a stereo frame has an extra bit
+            side = ((assignment == 8 and channel == 1) or (assignment == 9 and channel == 0)
+                    or (assignment == 10 and channel == 1))
+            parsed.append(parse_subframe(data, pos[lane], frame.sample_size + side,
+                                         frame.blocksize))
+            pos[lane] = parsed[-1].pos
+        coded = [lane for lane, subframe in enumerate(parsed) if subframe.param_bits]
+        if coded:
+            def lane_array(field):
+                return numpy.array([getattr(parsed[lane], field) for lane in coded])
+            coded_residuals, ends = _decode_residuals(
+                    data, buf, lane_array('pos'), lane_array('order'), blocksizes[coded],
+                    lane_array('param_bits'), lane_array('partition_order'))
+            rows[coded, :coded_residuals.shape[1]] = coded_residuals
+            del coded_residuals
+            for lane, end in zip(coded, ends.tolist()):
+                pos[lane] = end
+        for lane, subframe in enumerate(parsed):
+            if subframe.kind == SUBFRAME_CONSTANT:
+                rows[lane] = subframe.values[0]
+            elif subframe.kind == SUBFRAME_VERBATIM:
+                rows[lane, :len(subframe.values)] = subframe.values
+        subframes.extend(parsed)
+    # Restore the samples of every channel of every frame together
+    samples = _restore_samples(
+            residuals,
+            [subframe.values if subframe.param_bits else None for subframe in subframes],
+            [subframe.coefs for subframe in subframes],
+            numpy.array([subframe.shift for subframe in subframes]),
+            numpy.array([subframe.order if subframe.param_bits else 0 for subframe in subframes]),
+            numpy.tile(blocksizes, channels))
+    del residuals
+    samples <<= numpy.array([subframe.wasted for subframe in subframes])[:, numpy.newaxis]
+    samples = samples.reshape(channels, lanes, width)
+    # Undo the stereo decorrelation
+    assignments = numpy.array([frame.channel_assignment for frame in frames])[:, numpy.newaxis]
+    if channels == 2 and (assignments >= 8).any():
+        first, second = samples
+        left = numpy.where(assignments == 9, first + second, first)
+        right = numpy.where(assignments == 8, first - second, second)
+        mid = (first << 1) | (second & 1)
+        left = numpy.where(assignments == 10, (mid + second) >> 1, left)
+        right = numpy.where(assignments == 10, (mid - second) >> 1, right)
+        samples = numpy.stack((left, right))
+    samples = samples.transpose(1, 2, 0)
+    return [samples[lane, :frame.blocksize] for lane, frame in enumerate(frames)]
+
+
+def verify_audio(path):
+    # Decode the audio of a FLAC file, checking it against the MD5 in the
+    # STREAMINFO block.  Needs numpy.  Returns a list of problems found,
+    # empty if the audio is fine, and the peak sample level as a fraction of
+    # full scale, or None if the audio couldn't be decoded.
+    if not numpy:
+        return ['Verifying audio needs numpy'], None
+    try:
+        header = FlacHeader(path)
+        streaminfo = header.streaminfo
+        # Read the file with 8 bytes of padding, for the rows of buf
+        padded = numpy.zeros(header.file_size + 8, dtype=numpy.uint8)
+        with open(path, 'rb') as f:
+            size = f.readinto(memoryview(padded)[:header.file_size])
+    except (OSError, ValueError) as e:
+        return [str(e)], None
+    data = memoryview(padded)[:size]
+    buf = numpy.lib.stride_tricks.as_strided(padded, (size, 8), (1, 1), writeable=False)
+    frames, gaps = find_frames(data, header.audio_offset, streaminfo)
+    if not frames or gaps or frames[0].pos != header.audio_offset:
+        return ['Audio frames are damaged (see --verify-frames)'], None
+    bits = streaminfo.bits_per_sample
+    sample_bytes = (bits + 7) // 8
+    md5 = hashlib.md5()
+    peak = samples = 0
+    try:
+        for start in range(0, len(frames), decode_batch_frames):
+            batch = frames[start:start + decode_batch_frames]
+            block = numpy.concatenate(decode_frames(data, buf, batch, streaminfo))
+            samples += len(block)
+            if len(block):
+                peak = max(peak, int(block.max()), -int(block.min()))
+            pcm = block.astype('<i4', order='C').view(numpy.uint8).reshape(-1, 4)
+            md5.update(pcm[:, :sample_bytes].tobytes())
+    except (ValueError, IndexError) as e:
+        return ['Decoding failed: %s' % e], None
+    problems = []
+    if streaminfo.total_samples and samples != streaminfo.total_samples:
+        problems.append('Decoded %d samples, STREAMINFO total_samples is %d' %
+                        (samples, streaminfo.total_samples))
+    if not any(streaminfo.md5):
+        problems.append('STREAMINFO has no audio MD5')
+    elif md5.digest() != streaminfo.md5:
+        problems.append('Audio MD5 does not match STREAMINFO (decoded %s, stored %s)' %
+                        (md5.hexdigest(), streaminfo.md5.hex()))
+    return problems, peak / (1 << (bits - 1))
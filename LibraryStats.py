@@ -0,0 +1,232 @@
+#! python3
+
+# Report statistics on a library of FLAC albums: tag coverage per profile,
+# the most common values of tags like genre and label, AccurateRip results,
+# albums per decade, and how many tracks are missing each optional tag.
+#
+# The library is read in a single pass, reading just the metadata blocks of
+# each FLAC file, and only counters are kept, so memory use doesn't grow
+# with the size of the library.  Tags with an unbounded number of values,
+# like label, are counted with a Space-Saving sketch that keeps a fixed
+# number of counters, so the most common values and their counts are found
+# without counting every value.  The report can be output as text, JSON, or
+# both.
+
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import re
+import sys
+
+import CheckFlacTags
+from CommonUtils import *
+from CommonUtils import uprint as print
+
+default_path = 'D:\\CDRip'
+default_top = 15
+default_jobs = 8
+
+value_tags = ('genre', 'label', 'encoder settings', 'source')
+sketch_factor = 10          # Counters kept per value shown in a top-K list
+
+args = None
+
+
+def parse_args():
+    global args
+    parser = argparse.ArgumentParser(
+            description='Report statistics on trees of FLAC files.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', nargs='*', default=[default_path],
+                        help='root of a tree to search for albums of FLAC files')
+    parser.add_argument('-k', '--top', type=int, default=default_top, metavar='K',
+                        help='number of values to show for each tag')
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the report as JSON to FILE ('-' for "
+                             "stdout, replacing the text report)")
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs,
+                        help='number of albums to read in parallel')
+    args = parser.parse_args()
+
+
+class TopK:
+    """
+    Space-Saving sketch of the most frequent items in a stream, using a fixed
+    number of counters.  When a new item arrives and all counters are in use,
+    the item with the smallest count is replaced, and the new item inherits
+    that count as its possible overcount.  Any item occurring more often than
+    total / capacity is guaranteed to be kept.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+
+    def add(self, item, count=1):
+        self.total += count
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+        else:
+            smallest = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(smallest)
+            del self.errors[smallest]
+            self.counts[item] = floor + count
+            self.errors[item] = floor
+
+    def top(self, k):
+        # Returns the k most frequent items as (item, count, max overcount)
+        items = sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+        return [(item, count, self.errors[item]) for item, count in items[:k]]
+
+
+def rip_result(value):
+    # Reduce an AccurateRip result like 'AccurateRip: Accurate (confidence 5)
+    # [Pressing #1]' to its category, e.g. 'Accurate'.
+    value = re.sub(r'^AccurateRip:\s*', '', value, flags=re.I)
+    value = re.sub(r'\s*[(\[].*$', '', value)
+    return value.strip() or 'Unknown'
+
+
+class Stats:
+    """
+    Counters for the whole library, updated one album at a time.
+    """
+    def __init__(self):
+        self.albums = 0
+        self.discs = 0
+        self.tracks = 0
+        self.seconds = 0
+        self.bytes = 0
+        self.profile_tracks = Counter()             # profile -> tracks
+        self.profile_tags = defaultdict(Counter)    # profile -> tag -> tracks
+        self.values = {tag: TopK(args.top * sketch_factor) for tag in value_tags}
+        self.rip_results = Counter()
+        self.decades = Counter()
+        self.missing_optional = Counter()
+
+    def add_album(self, tracks):
+        # tracks is a list of (tags, StreamInfo, file size) tuples
+        if not tracks:
+            return
+        self.albums += 1
+        self.discs += len({flatten_tag(tags.get('discnumber', ['1']))
+                           for tags, _, _ in tracks})
+        dates = Counter(flatten_tag(tags['date'])[:4] for tags, _, _ in tracks
+                        if 'date' in tags)
+        if dates and dates.most_common(1)[0][0].isdigit():
+            year = int(dates.most_common(1)[0][0])
+            self.decades['%ds' % (year // 10 * 10)] += 1
+        else:
+            self.decades['Unknown'] += 1
+        for tags, streaminfo, size in tracks:
+            self.tracks += 1
+            self.bytes += size
+            if streaminfo.sample_rate:
+                self.seconds += streaminfo.total_samples / streaminfo.sample_rate
+            profile = flatten_tag(tags.get('profile', ['(none)']))
+            self.profile_tracks[profile] += 1
+            self.profile_tags[profile].update(tags.keys())
+            for tag in value_tags:
+                for value in tags.get(tag, ['(none)']):
+                    self.values[tag].add(value)
+            for value in tags.get('accurateripresult', ['(none)']):
+                self.rip_results[rip_result(value)] += 1
+            for tag in CheckFlacTags.optional_tags:
+                if tag not in tags:
+                    self.missing_optional[tag] += 1
+
+    def report(self):
+        # Return the statistics as a dict, ready for output as JSON
+        return {
+            'albums': self.albums,
+            'discs': self.discs,
+            'tracks': self.tracks,
+            'hours': round(self.seconds / 3600, 1),
+            'bytes': self.bytes,
+            'tag_coverage': {
+                profile: {'tracks': count,
+                          'tags': {tag: tag_count for tag, tag_count in
+                                   sorted(self.profile_tags[profile].items())}}
+                for profile, count in sorted(self.profile_tracks.items())},
+            'values': {
+                tag: {'tracks': sketch.total,
+                      'top': [{'value': value, 'count': count, 'max_overcount': error}
+                              for value, count, error in sketch.top(args.top)]}
+                for tag, sketch in self.values.items()},
+            'accurateripresult': dict(self.rip_results.most_common()),
+            'decades': dict(sorted(self.decades.items())),
+            'missing_optional_tags': dict(sorted(self.missing_optional.items(),
+                                                 key=lambda item: (-item[1], item[0]))),
+        }
+
+
+def read_album(album_path):
+    # Read the tags and STREAMINFO of every FLAC file in an album folder.
+    tracks = []
+    for file in os.listdir(album_path):
+        if not file.endswith('.flac'):
+            continue
+        try:
+            header = FlacHeader(os.path.join(album_path, file))
+            tracks.append((header.get_tags(), header.streaminfo, header.file_size))
+        except (OSError, ValueError) as e:
+            print('Warning: %s' % e, file=sys.stderr)
+    return tracks
+
+
+def percent(count, total):
+    return '%5.1f%%' % (100 * count / total) if total else '    -'
+
+
+def print_report(report):
+    print('%d albums, %d discs, %d tracks, %.1f hours, %.1f GB' %
+          (report['albums'], report['discs'], report['tracks'], report['hours'],
+           report['bytes'] / 1e9))
+    for profile, coverage in report['tag_coverage'].items():
+        total = coverage['tracks']
+        print("\nTag coverage for profile '%s' (%d tracks):" % (profile, total))
+        for tag, count in coverage['tags'].items():
+            print('  %-24s %s' % (tag, percent(count, total)))
+    for tag, values in report['values'].items():
+        print("\nMost common values of '%s':" % tag)
+        for item in values['top']:
+            approx = ' (+/- %d)' % item['max_overcount'] if item['max_overcount'] else ''
+            print('  %7d %s  %s%s' % (item['count'], percent(item['count'], values['tracks']),
+                                      item['value'], approx))
+    print('\nAccurateRip results:')
+    for result, count in report['accurateripresult'].items():
+        print('  %7d %s  %s' % (count, percent(count, report['tracks']), result))
+    print('\nAlbums per decade:')
+    for decade, count in report['decades'].items():
+        print('  %-8s %6d' % (decade, count))
+    print('\nTracks missing optional tags:')
+    for tag, count in report['missing_optional_tags'].items():
+        print('  %-24s %7d %s' % (tag, count, percent(count, report['tracks'])))
+
+
+def main():
+    parse_args()
+    stats = Stats()
+    album_paths = (album_path for root in args.path for album_path in find_albums(root))
+    jobs = max(args.jobs, 1)
+    with ThreadPoolExecutor(jobs) as executor:
+        for tracks in map_albums(executor, read_album, album_paths, jobs):
+            stats.add_album(tracks)
+    report = stats.report()
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+        return
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='UTF-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+if __name__ == '__main__':
+    main()
@@ -17,23 +17,150 @@
 # script will determine the process ID (PID) of the CD Ripper instance, then
 # use that in the file name.
 
+# Since this runs after every track, it's kept as cheap as possible.  CD
+# Ripper runs the script through a new cmd.exe for every track, so the parent
+# PID says nothing about which CD Ripper instance is running it.  Instead, the
+# slow path of importing psutil and walking up the chain of parent processes
+# also saves the CD Ripper PID in a key file, named from a checksum of the
+# arguments.  Later tracks of the same disc pass the same arguments, so the
+# key file gives the PID directly, as long as that instance's file still holds
+# the same arguments and was used recently.  The key file also holds the time
+# the CD Ripper process started, as recorded by the OS, which is cheap to
+# look up without psutil.  If the process has exited, or its PID has been
+# reused, the start time won't match and the slow path is taken, so a CD
+# Ripper restarted to re-rip the same disc gets its own file.  The arguments
+# name the disc, so
+# two instances sharing a key file would have to be ripping the same disc into
+# the same folder.  The files are only rewritten when the arguments change,
+# which is usually only on the first track of each disc.
+
+# If CD Ripper also passes the ripped track file ([outfilelong]) as a third
+# argument, a 'track' event is added to the rip ledger kept by RipLedger.py,
+# so ripping throughput can be reported on later.  A failure to write the
+# ledger never stops the rip.
+
 import os
-import psutil
 import sys
 import tempfile
+import time
+import zlib
 
-pid = os.getpid()
-try:
+ripper_name = 'cdgrab.exe'
+session_max_age = 3600  # Secs a log file can go unused before it's distrusted
+
+
+def find_ripper_pid():
+    # Follow the chain of parent processes up to CD Ripper.
+    import psutil
+    pid = os.getpid()
     while True:
         proc = psutil.Process(pid)
-        if proc.name().lower() == 'cdgrab.exe':
-            break
+        if proc.name().lower() == ripper_name:
+            return pid
         pid = proc.ppid()
-except:
-    print('Script not run from within CD Ripper, aborting')
-    sys.exit(1)
-
-fname = os.path.join(tempfile.gettempdir(), 'LastRipped-%d.txt' % pid)
-with open(fname, 'wt', encoding='UTF-8') as f:
-    print(sys.argv[1], file=f)
-    print(sys.argv[2], file=f)
+
+
+def process_start(pid):
+    # Return the start time of a running process as recorded by the OS, or
+    # None if it isn't running or the time can't be found.  Used instead of
+    # psutil, which takes longer to import than this script takes to run.
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # QUERY_LIMITED_INFORMATION
+        if not handle:
+            return None
+        try:
+            times = [wintypes.FILETIME() for _ in range(4)]
+            exit_code = wintypes.DWORD()
+            if (not kernel32.GetProcessTimes(handle, *map(ctypes.byref, times)) or
+                    not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)) or
+                    exit_code.value != 259):    # STILL_ACTIVE
+                return None
+            return (times[0].dwHighDateTime << 32) | times[0].dwLowDateTime
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        with open('/proc/%d/stat' % pid, 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Fields after the parenthesized command name, from the state onward
+    fields = stat[stat.rindex(b')') + 2:].split()
+    if fields[0] == b'Z':
+        return None
+    return int(fields[19])
+
+
+def log_file_name(pid):
+    return os.path.join(tempfile.gettempdir(), 'LastRipped-%d.txt' % pid)
+
+
+def write_file(fname, text):
+    # Write to a temporary file and rename it, so PostRipProcess never sees
+    # a partially written file.
+    temp_fname = '%s.%d' % (fname, os.getpid())
+    with open(temp_fname, 'wt', encoding='UTF-8') as f:
+        f.write(text)
+    os.replace(temp_fname, fname)
+
+
+text = '%s\n%s\n' % (sys.argv[1], sys.argv[2])
+key_fname = os.path.join(tempfile.gettempdir(), 'LastRipped-key-%08x.txt' %
+                         zlib.crc32(text.encode('UTF-8')))
+
+# Fast path - the key file names the CD Ripper instance last given these
+# arguments, which is still running, and its file was written with them
+# earlier in the session
+ripper_pid = None
+try:
+    with open(key_fname, 'rt') as f:
+        pid, start = f.read().split()
+    pid = int(pid)
+    fname = log_file_name(pid)
+    if (str(process_start(pid)) == start and
+            time.time() - os.path.getmtime(fname) < session_max_age):
+        with open(fname, 'rt', encoding='UTF-8') as f:
+            if f.read() == text:
+                ripper_pid = pid
+except (OSError, ValueError):
+    pass
+
+if ripper_pid is not None:
+    # Just mark the file as still in use by this session
+    os.utime(fname)
+else:
+    try:
+        ripper_pid = find_ripper_pid()
+    except:
+        print('Script not run from within CD Ripper, aborting')
+        sys.exit(1)
+    fname = log_file_name(ripper_pid)
+    try:
+        with open(fname, 'rt', encoding='UTF-8') as f:
+            unchanged = (f.read() == text)
+    except OSError:
+        unchanged = False
+    if unchanged:
+        os.utime(fname)
+    else:
+        write_file(fname, text)
+    start = process_start(ripper_pid)
+    if start is not None:
+        write_file(key_fname, '%d %d' % (ripper_pid, start))
+
+if len(sys.argv) > 3:
+    import RipLedger
+    track_file = sys.argv[3].strip(' "')
+    if not os.path.splitext(track_file)[1]:
+        track_file += '.flac'
+    try:
+        size, seconds = RipLedger.track_info(track_file)
+    except OSError:
+        size = seconds = None
+    try:
+        RipLedger.record('track', ripper_pid, folder=sys.argv[2].strip(' "').rstrip('\\/'),
+                         file=track_file, bytes=size, seconds=seconds)
+    except OSError as e:
+        print("Can't add the track to the rip ledger: %s" % e)
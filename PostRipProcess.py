@@ -30,14 +30,44 @@
 # the PID as an argument.  The reinvoking is via "start", which will give the
 # script a visible console window in which to run, and which runs disassociated
 # from CD Ripper, which can then proceed.
+#
+# When several CD Ripper instances rip in parallel, running a CheckFlacTags for
+# each finished disc at once just has those checks fighting over the disk.
+# Instead, each run of this script drops a job into a queue kept in the
+# %TEMP%\PostRipQueue folder.  Whichever instance of the script holds the lock
+# file in that folder acts as the worker, running the queued checks with at
+# most max_checks running at once, and jobs waiting for the same album folder
+# (e.g. discs of a multi-disc set ripped on different drives) are combined into
+# a single check.  The results of each job are saved in the queue folder, and
+# each instance of the script shows the results for its own rip when ready.
+#
+# Each finished disc, and each finished check, is also added to the rip ledger
+# kept by RipLedger.py, along with the drive named in the extraction log, so
+# ripping throughput and the time spent waiting for checks can be reported on.
 
+import json
 import os
 import psutil
 import re
+import subprocess
 import sys
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import QueryRipLogs
+import RipLedger
 
 max_pathlen = 259
+max_checks = 2                  # Max CheckFlacTags runs at the same time
+poll_interval = 1               # Secs between checks of the job queue
+result_max_age = 30 * 86400     # Secs to keep the saved results of a job
+
+queue_dir = os.path.join(tempfile.gettempdir(), 'PostRipQueue')
+pending_dir = os.path.join(queue_dir, 'pending')
+done_dir = os.path.join(queue_dir, 'done')
+lock_file = os.path.join(queue_dir, 'worker.lock')
+lock_grace = 5                  # Secs an unreadable lock is assumed still held
 
 if len(sys.argv) == 1:
     # No arguments, so this is the first invocation.  Find the CD Ripper
@@ -74,6 +104,274 @@ class Error(Exception):
     # use a private exception whenever we need to exit early.
     pass
 
+
+def write_json(path, data):
+    # Write a job file in one step, so a reader never sees a partial file.
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wt', encoding='UTF-8') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def read_json(path):
+    with open(path, 'rt', encoding='UTF-8') as f:
+        return json.load(f)
+
+
+def queue_job(folder, ripper_pid):
+    # Add a CheckFlacTags job for an album folder to the queue, returning
+    # the job ID.
+    os.makedirs(pending_dir, exist_ok=True)
+    os.makedirs(done_dir, exist_ok=True)
+    job_id = '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    write_json(os.path.join(pending_dir, job_id + '.json'),
+               {'id': job_id, 'folder': folder, 'ripper_pid': ripper_pid,
+                'queued': time.time()})
+    return job_id
+
+
+def read_lock(path=lock_file):
+    # Return the text of a lock file, or None if it can't be read.
+    try:
+        with open(path, 'rt') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def lock_owner():
+    # Return the PID saved in the lock file, or None if it can't be read.
+    try:
+        return int(read_lock())
+    except (TypeError, ValueError):
+        return None
+
+
+def try_lock():
+    # Try to become the worker which runs the queued jobs, by creating the
+    # lock file.  The lock is written to a temporary file first and then
+    # linked into place, so another instance never sees a lock without a
+    # PID in it.  A lock left behind by a worker which no longer exists is
+    # taken over, as is one that still can't be read after lock_grace secs.
+    # Several instances can find the same stale lock, so it's taken over by
+    # renaming it aside, which only one of them can do, and then making sure
+    # it was the stale lock that was renamed, not a new worker's lock.
+    temp_path = '%s.%d.tmp' % (lock_file, os.getpid())
+    stale_path = '%s.%d.stale' % (lock_file, os.getpid())
+    with open(temp_path, 'wt') as f:
+        f.write(str(os.getpid()))
+    try:
+        for _ in range(2):
+            try:
+                os.link(temp_path, lock_file)
+                return True
+            except FileExistsError:
+                pass
+            text = read_lock()
+            pid = lock_owner()
+            if pid is None:
+                try:
+                    if time.time() - os.path.getmtime(lock_file) < lock_grace:
+                        return False
+                except OSError:
+                    continue
+            elif psutil.pid_exists(pid):
+                return False
+            try:
+                os.replace(lock_file, stale_path)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                return False
+            if read_lock(stale_path) != text:
+                # Another instance took the lock over first, and this was
+                # its new lock, so put it back
+                try:
+                    os.link(stale_path, lock_file)
+                except OSError:
+                    pass
+                os.remove(stale_path)
+                return False
+            os.remove(stale_path)
+        return False
+    finally:
+        os.remove(temp_path)
+
+
+def release_lock():
+    # Remove the lock file, unless another instance has taken it over.
+    if lock_owner() == os.getpid():
+        os.remove(lock_file)
+
+
+def record_disc(folder, log_path, ripper_pid):
+    # Add the finished disc to the rip ledger, with the drive and offset from
+    # its extraction log if there is one.
+    try:
+        log = QueryRipLogs.read_log(log_path)
+    except OSError:
+        log = None
+    try:
+        RipLedger.record('disc', ripper_pid, folder=folder,
+                         drive=log and log['drive'], offset=log and log['offset'])
+    except OSError as e:
+        uprint("Can't add the disc to the rip ledger: %s" % e)
+
+
+def run_check(folder, jobs):
+    # Run CheckFlacTags for an album folder, and save the results for each of
+    # the jobs for that folder.
+    started = time.time()
+    script = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                          'CheckFlacTags.py')
+    env = dict(os.environ, PYTHONIOENCODING='UTF-8')
+    try:
+        proc = subprocess.run([sys.executable, script, '-Sv', folder],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              env=env)
+        output = proc.stdout.decode('UTF-8', errors='replace')
+        exit_code = proc.returncode
+    except Exception as e:
+        output = 'Failed to run CheckFlacTags: %s' % e
+        exit_code = None
+    finished = time.time()
+    for job in jobs:
+        job.update(output=output, exit_code=exit_code, started=started,
+                   finished=finished, combined=len(jobs))
+        write_json(os.path.join(done_dir, job['id'] + '.json'), job)
+        try:
+            os.remove(os.path.join(pending_dir, job['id'] + '.json'))
+        except FileNotFoundError:
+            pass
+        try:
+            RipLedger.record('check', job['ripper_pid'], folder=job['folder'],
+                             queued=job['queued'], started=started,
+                             finished=finished, combined=len(jobs))
+        except OSError:
+            pass
+
+
+def fail_jobs(jobs, error):
+    # Finish jobs whose check couldn't save its results, saving the error
+    # instead.  Returns the IDs of any jobs which couldn't even be moved out
+    # of the pending folder, so they can be skipped from now on.
+    stuck = set()
+    for job in jobs:
+        done_path = os.path.join(done_dir, job['id'] + '.json')
+        if os.path.exists(done_path):
+            # The results were saved after all, perhaps by another worker
+            try:
+                os.remove(os.path.join(pending_dir, job['id'] + '.json'))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                stuck.add(job['id'])
+            continue
+        job.update(output='Failed to save the CheckFlacTags results: %s' % error,
+                   exit_code=None, started=None, finished=time.time(),
+                   combined=len(jobs))
+        try:
+            write_json(done_path, job)
+        except OSError:
+            pass
+        try:
+            os.remove(os.path.join(pending_dir, job['id'] + '.json'))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            stuck.add(job['id'])
+    return stuck
+
+
+def run_queue(own_job_id):
+    # Act as the worker, running queued jobs until the queue is empty.  Jobs
+    # for an album folder which is already being checked wait for that check
+    # to finish, since the new rip changed the folder.  Also shows the
+    # results of this script's own job as soon as they're ready.  The lock
+    # is released however this ends, so other instances never wait forever
+    # on a worker that has stopped working.
+    running = {}    # folder -> (Future of the check for that folder, its jobs)
+    skipped = set() # IDs of jobs which can't be run or removed
+    shown = False
+    try:
+        for fname in os.listdir(done_dir):
+            path = os.path.join(done_dir, fname)
+            if time.time() - os.path.getmtime(path) > result_max_age:
+                os.remove(path)
+        with ThreadPoolExecutor(max_checks) as executor:
+            while True:
+                for folder, (future, jobs) in list(running.items()):
+                    if not future.done():
+                        continue
+                    del running[folder]
+                    if future.exception():
+                        uprint('Check of %s failed: %s' %
+                               (jobs[0]['folder'], future.exception()))
+                        skipped |= fail_jobs(jobs, future.exception())
+                waiting = {}
+                # If another instance has somehow taken over as the worker,
+                # just finish the checks already running
+                if lock_owner() == os.getpid():
+                    fnames = sorted(os.listdir(pending_dir))
+                else:
+                    fnames = []
+                for fname in fnames:
+                    if not fname.endswith('.json'):
+                        continue
+                    try:
+                        job = read_json(os.path.join(pending_dir, fname))
+                    except (OSError, ValueError):
+                        continue
+                    if job['id'] in skipped:
+                        continue
+                    folder = os.path.normcase(os.path.abspath(job['folder']))
+                    if folder not in running:
+                        waiting.setdefault(folder, []).append(job)
+                for folder, jobs in waiting.items():
+                    if len(jobs) > 1:
+                        uprint('Combining %d queued checks of %s' %
+                               (len(jobs), jobs[0]['folder']))
+                    running[folder] = (executor.submit(run_check, jobs[0]['folder'], jobs),
+                                       jobs)
+                if not shown:
+                    shown = show_results(own_job_id)
+                if not running:
+                    break
+                time.sleep(poll_interval)
+    finally:
+        release_lock()
+    if not shown and own_job_id in skipped:
+        uprint("Couldn't save the results of the check of this rip")
+        shown = True
+    return shown
+
+
+def show_results(job_id):
+    # Show the results of a finished job.  Returns False if not done yet.
+    try:
+        job = read_json(os.path.join(done_dir, job_id + '.json'))
+    except (OSError, ValueError):
+        return False
+    uprint(job['output'].rstrip())
+    if job['combined'] > 1:
+        uprint('\n(Checked along with %d other queued rip%s of this album)' %
+               (job['combined'] - 1, '' if job['combined'] == 2 else 's'))
+    return True
+
+
+def wait_for_results(job_id):
+    # Wait for a job to be run, taking over as the worker if there isn't one.
+    waiting_shown = False
+    while not show_results(job_id):
+        if try_lock():
+            if run_queue(job_id):
+                return
+            continue
+        if not waiting_shown:
+            uprint('Waiting for queued checks from other rips to finish...')
+            waiting_shown = True
+        time.sleep(poll_interval)
+
 try:
     uprint('')
 
@@ -125,7 +423,11 @@ try:
         uprint("Renaming 'cuesheet.cue' to '%s'" % os.path.basename(new_cue_file))
         os.rename(old_cue_file, new_cue_file)
 
-    os.system('CheckFlacTags.py -Sv "%s"' % folder)
+    # CD Ripper names the extraction log the same as the cuesheet
+    record_disc(folder, os.path.splitext(new_cue_file)[0] + '.txt', int(sys.argv[1]))
+
+    job_id = queue_job(folder, int(sys.argv[1]))
+    wait_for_results(job_id)
 except Error as e:
     uprint(e)
     exit_code = 1
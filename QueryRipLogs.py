@@ -0,0 +1,269 @@
+#! python3
+
+# Index the dBpoweramp extraction logs in a library of FLAC albums, and query
+# the per-track results they hold, e.g. all tracks with an AccurateRip
+# confidence below 2, or every track that needed re-reads.
+#
+# Extraction logs are the UTF-16 .txt files CD Ripper writes next to each
+# ripped disc.  Each one is parsed as a stream, a line at a time, into a
+# record of the drive used and, for every track, the AccurateRip result and
+# confidence, the CRC32 and AccurateRip CRC, whether it was ripped securely,
+# and how many frames were re-ripped.  The records are kept in a cache file,
+# so a log is only decoded again when its size or modification time changes,
+# and a query over a whole library only has to list the album folders.
+#
+# The same records are used by CheckFlacTags --rip-log to cross-check the
+# crc and accurateripresult tags of each track against its log.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import operator
+import os
+import re
+import tempfile
+
+from CommonUtils import *
+from CommonUtils import uprint as print
+
+default_path = 'D:\\CDRip'
+default_cache = os.path.join(tempfile.gettempdir(), 'QueryRipLogs-cache.json')
+default_jobs = 8
+cache_version = 1
+
+log_header_re = re.compile(r'dBpoweramp.*Digital Audio Extraction Log')
+drive_re = re.compile(r"Ripping with drive '\s*(.*?)\s*'")
+offset_re = re.compile(r'Drive offset:\s*(-?\d+)')
+track_re = re.compile(r'\s*Track\s+(\d+):\s+Ripped LBA (\d+) to (\d+)')
+result_re = re.compile(r'\s*AccurateRip:\s*(.*)')
+confidence_re = re.compile(r'\s*(.*?)\s*(?:\(confidence (\d+)\))?\s*(?:\[.*)?$')
+crc_re = re.compile(r'\bCRC32:\s*([0-9A-Fa-f]{8})')
+ar_crc_re = re.compile(r'AccurateRip CRC:\s*([0-9A-Fa-f]{8})')
+secure_re = re.compile(r'\s*(Secure|Insecure)\b', re.I)
+reread_re = re.compile(r're-?ripp?ed\s+(\d+)\s+frames?|(\d+)\s+frames?\s+re-?ripp?ed', re.I)
+
+# Fields of a track record which can be queried, and their types
+fields = {
+    'log': str, 'drive': str, 'offset': int, 'track': int, 'result': str,
+    'confidence': int, 'crc': str, 'arcrc': str, 'secure': bool, 'rereads': int,
+}
+operators = {
+    '<=': operator.le, '>=': operator.ge, '!=': operator.ne, '<': operator.lt,
+    '>': operator.gt, '=': operator.eq, '~': lambda value, text: text.lower() in value.lower(),
+}
+
+args = None
+
+
+def parse_args():
+    global args
+    parser = argparse.ArgumentParser(
+            description='Query the per-track results in dBpoweramp extraction logs.')
+    parser.add_argument('path', nargs='*', default=[default_path],
+                        help='root of a tree to search for albums of FLAC files '
+                             '(default: %s)' % default_path)
+    parser.add_argument('-w', '--where', action='append', default=[], metavar='COND',
+                        help="only show tracks matching COND, e.g. 'confidence<2', "
+                             "'rereads>0', 'secure=no' or 'drive~plextor' (~ "
+                             "matches part of the text); repeat to combine "
+                             "conditions. Fields: %s" % ', '.join(fields))
+    parser.add_argument('--json', action='store_true',
+                        help='output the matching tracks as JSON lines')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='file caching the parsed logs between runs '
+                             '(default: QueryRipLogs-cache.json in the temp '
+                             'directory)')
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs,
+                        help='number of logs to parse in parallel (default: %d)' % default_jobs)
+    args = parser.parse_args()
+    try:
+        args.where = [parse_condition(cond) for cond in args.where]
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def parse_condition(cond):
+    # Parse a --where condition into a (field, operator, value) tuple
+    match = re.match(r'\s*(\w+)\s*(<=|>=|!=|<|>|=|~)\s*(.*?)\s*$', cond)
+    if not match or match.group(1).lower() not in fields:
+        raise ValueError("bad condition '%s'" % cond)
+    field, op, value = match.group(1).lower(), match.group(2), match.group(3)
+    kind = fields[field]
+    if op == '~':
+        if kind is not str:
+            raise ValueError("'~' only works on text fields, not '%s'" % field)
+    elif kind is int:
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError("'%s' needs a number, not '%s'" % (field, value))
+    elif kind is bool:
+        if value.lower() not in ('yes', 'no', 'true', 'false', '1', '0'):
+            raise ValueError("'%s' needs yes or no, not '%s'" % (field, value))
+        value = value.lower() in ('yes', 'true', '1')
+    return field, operators[op], value
+
+
+def parse_result(text):
+    # Split an AccurateRip result such as 'Accurate (confidence 8) [DA4E45B8]'
+    # into the result and the confidence, which is None if not given
+    match = confidence_re.match(text)
+    confidence = match.group(2)
+    return match.group(1), int(confidence) if confidence else None
+
+
+def parse_log(f):
+    # Parse an extraction log from a text file object, a line at a time.
+    # Returns None if it isn't an extraction log, else a dict with the
+    # 'drive' and drive 'offset' used, and a list of 'tracks', each a dict
+    # with the fields described at the top of the script.  Lines that aren't
+    # recognized are skipped, so settings lines added by newer versions of CD
+    # Ripper don't matter.
+    if not log_header_re.search(f.readline()):
+        return None
+    log = {'drive': None, 'offset': None, 'tracks': []}
+    track = None
+    for line in f:
+        match = track_re.match(line)
+        if match:
+            track = {'track': int(match.group(1)), 'start': int(match.group(2)),
+                     'end': int(match.group(3)), 'result': None, 'confidence': None,
+                     'crc': None, 'arcrc': None, 'secure': None, 'rereads': 0}
+            log['tracks'].append(track)
+            continue
+        if track is None:
+            match = drive_re.search(line)
+            if match and log['drive'] is None:
+                log['drive'] = match.group(1)
+            match = offset_re.search(line)
+            if match and log['offset'] is None:
+                log['offset'] = int(match.group(1))
+            continue
+        match = result_re.match(line)
+        if match:
+            track['result'], track['confidence'] = parse_result(match.group(1))
+        match = crc_re.search(line)
+        if match:
+            track['crc'] = match.group(1).upper()
+        match = ar_crc_re.search(line)
+        if match:
+            track['arcrc'] = match.group(1).upper()
+        match = secure_re.match(line)
+        if match:
+            track['secure'] = match.group(1).lower() == 'secure'
+        for match in reread_re.finditer(line):
+            track['rereads'] += int(match.group(1) or match.group(2))
+    return log
+
+
+def read_log(path):
+    # Parse the extraction log at path, returning None if it isn't one
+    with open(path, 'rb') as raw:
+        with io.TextIOWrapper(raw, encoding='utf_16_le', errors='replace') as f:
+            return parse_log(f)
+
+
+class LogCache:
+    """
+    The parsed extraction logs, keyed on the path of the log, saved between
+    runs.  Each entry also holds the size and modification time of the log
+    when it was parsed, so only new or changed logs are parsed again.  Text
+    files which aren't extraction logs are remembered too, with a log of None.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.logs = {}
+        self.changed = False
+        try:
+            with open(path, encoding='UTF-8') as f:
+                data = json.load(f)
+            if data.get('version') == cache_version:
+                self.logs = data['logs']
+        except (OSError, ValueError):
+            pass
+
+    def get(self, log_path):
+        # Return the parsed log at log_path, parsing it only if it isn't
+        # cached or has changed since.  Safe to call from several threads.
+        stat = os.stat(log_path)
+        entry = self.logs.get(log_path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['log']
+        log = read_log(log_path)
+        self.logs[log_path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'log': log}
+        self.changed = True
+        return log
+
+    def save(self):
+        if not self.changed:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='UTF-8') as f:
+            json.dump({'version': cache_version, 'logs': self.logs}, f,
+                      ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, self.path)
+        self.changed = False
+
+
+def track_records(log_path, log):
+    # Yield the track records of a parsed log, with the log-wide fields added
+    for track in log['tracks']:
+        record = dict(track, log=log_path, drive=log['drive'], offset=log['offset'])
+        yield record
+
+
+def matches(record):
+    for field, op, value in args.where:
+        if record.get(field) is None:
+            return False
+        if not op(record[field], value):
+            return False
+    return True
+
+
+def format_result(record):
+    result = record['result'] or 'no AccurateRip result'
+    if record['confidence'] is not None:
+        result += ' (confidence %d)' % record['confidence']
+    return result
+
+
+def format_record(record):
+    details = [format_result(record), 'CRC32 %s' % (record['crc'] or '-')]
+    if record['secure'] is not None:
+        details.append('secure' if record['secure'] else 'insecure')
+    if record['rereads']:
+        details.append('%d frames re-ripped' % record['rereads'])
+    return '  Track %d: %s' % (record['track'], ', '.join(details))
+
+
+def main():
+    parse_args()
+    cache = LogCache(args.cache or default_cache)
+    log_paths = (os.path.join(album_path, file)
+                 for root in args.path for album_path in find_albums(root)
+                 for file in sorted(os.listdir(album_path)) if file.lower().endswith('.txt'))
+    logs = tracks = shown = 0
+    with ThreadPoolExecutor(max(args.jobs, 1)) as executor:
+        for log_path, log in executor.map(lambda path: (path, cache.get(path)), log_paths):
+            if log is None:
+                continue
+            logs += 1
+            records = list(track_records(log_path, log))
+            tracks += len(records)
+            records = [record for record in records if matches(record)]
+            shown += len(records)
+            if args.json:
+                for record in records:
+                    print(json.dumps(record, ensure_ascii=False, sort_keys=True))
+            elif records:
+                print("\n%s (%s)" % (log_path, log['drive'] or 'unknown drive'))
+                for record in records:
+                    print(format_record(record))
+    cache.save()
+    if not args.json:
+        print('\n%d of %d tracks matched, in %d extraction logs' % (shown, tracks, logs))
+
+if __name__ == '__main__':
+    main()
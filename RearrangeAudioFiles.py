@@ -56,28 +56,118 @@ renamed as above will also be moved to the destination.
 For safety, <source-root> and <destination-root> must be different.  Also for
 safety, by default files are actually copied to a new destination, not moved.
 This can be overridden with the --move (-m) option.
+
+With the --check (-c) option, each album is also run through the CheckFlacTags
+checks, using the tags already read for the rearrangement, so a staging tree
+only needs to be read once.  Albums which fail those checks are skipped, and
+listed at the end of the run.
+
+When copying, the --link option places files in the destination as hard links
+(--link=hard) or copy-on-write clones (--link=reflink) of the source files,
+which costs next to no disk space or time when both trees share a filesystem.
+A normal copy is made whenever the link can't be created, and after one
+failure, links aren't tried again between the same pair of devices.
+
+The --sync option allows copying to a destination which already holds an
+earlier copy of an album, e.g. after fixing a tag in the source.  Files whose
+size and modification time match are skipped.  FLAC files with identical audio
+and the same space reserved for metadata only have their metadata blocks
+rewritten in place, and destination FLAC files left over from an earlier name
+are renamed rather than copied again.  Anything else which differs is copied.
+
+To keep a library move from getting in the way of CD Ripper writing to the
+same disk, copies can be limited to a maximum rate with --max-rate, run at the
+idle I/O priority with --idle, or paused whenever files in the folder given by
+--watch (e.g. the ripping staging folder) are being written.
+
+The --progress option shows a status line while copying or moving, with the
+overall progress, throughput, and estimated time remaining, followed by a
+summary at the end of the run.  Use --progress=json to instead get a stream of
+JSON objects, one per line, for use by other programs.  Progress is written to
+stderr.
+
+The --simulate option plans the rename/move of every album under the source
+without changing anything, keeping the planned destination layout in memory
+instead of checking the destination for each file.  The run ends with a report
+of path lengths, truncated names, and albums or files which would collide.
+
+With --jobs N, N planner processes read, check and plan albums ahead of time,
+while the main process moves or copies the albums already planned, in the
+same order as without --jobs.  Only a few albums per planner are planned
+ahead, so memory use stays flat however big the source tree is.
+
+With --preflight, every album is planned before any file is touched, and the
+bytes each destination device needs are compared with its free space, less a
+reserve.  The run refuses to start if they won't fit, or with --fit, just moves
+or copies the albums that do.  The time taken is estimated from the copy
+throughput of earlier runs, kept in the temp directory.
+
+A dry run or --simulate can plan from a snapshot saved by CheckFlacTags
+--export-snapshot (--from-snapshot), without access to the source tree.
 """
 
 import argparse
-from collections import OrderedDict
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import copy
 import fnmatch
+import heapq
+import io
+import json
 import mutagen.flac
 import os
 import re
+import shlex
 import shutil
 import sys
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # Not available on Windows, so no reflinks there
 
+import CheckFlacTags
 from CommonUtils import *
 from CommonUtils import uprint as print
 
 default_maxpath = 259
 default_retain_name = 10  # Min chars to retain from basename when truncating
+sync_mtime_window = 2     # Max secs between mtimes of files considered in sync
+copy_chunk_size = 1024 * 1024   # Bytes per read/write for throttled copies
+watch_interval = 2        # Min secs between scans of the --watch folder
+watch_quiet = 10          # Secs without writes before --watch folder is idle
+progress_interval = 0.5   # Min secs between --progress updates
+progress_window = 10      # Secs of history used for --progress rates
+simulate_longest = 10     # Number of longest paths shown by --simulate
+planner_lookahead = 2     # Albums planned ahead per --jobs planner process
+preflight_reserve = 1e9   # Min bytes left free on a destination by --preflight...
+preflight_reserve_fraction = 0.01   # ...or this fraction of the disk, if larger
+throughput_runs = 20      # Copy runs kept in the throughput history
+throughput_min_bytes = 50e6     # Smallest copy run recorded in the history
+throughput_file = os.path.join(tempfile.gettempdir(), 'RearrangeAudioFiles-throughput.json')
 
 known_profiles = ('Classical', 'Pop/Rock')
 
+FICLONE = 0x40049409    # Linux ioctl to clone a file's extents (btrfs, xfs)
+
 prog = sys.argv[0]
 args = None
 msgs = None
+skipped_albums = []
+link_failed = set()       # (source, destination) st_dev pairs --link failed on
+throttle = None
+progress = None
+vfs = None
+claimed_paths = {}        # Lower-cased new album path -> new file names
+unfit_albums = []         # Albums left out by --preflight --fit
+reflink_devices = {}      # st_dev -> whether --preflight could reflink there
+copied_bytes = 0          # Bytes copied (not linked or renamed) this run...
+copy_seconds = 0          # ...and the time spent copying them
+
+check_counters = ('album_count', 'disc_count', 'track_count', 'warn_count')
 
 
 class Error(Exception):
@@ -97,11 +187,36 @@ def parse_args():
                              'If omitted, then files and album folders are '
                              'renamed in place as necessary and not '
                              'copied/moved to a new location.')
+    parser.add_argument('-c', '--check', action='store_true',
+                        help='Run the CheckFlacTags checks on each album first, '
+                             'skipping any album with errors')
+    parser.add_argument('-C', '--check-options', default='', metavar='opts',
+                        help='Options passed to the CheckFlacTags checks run by '
+                             '--check, e.g. -C="-S -o"')
+    parser.add_argument('--from-snapshot', metavar='FILE',
+                        help='Plan the albums saved by CheckFlacTags '
+                             '--export-snapshot instead of reading the source '
+                             'tree (only with --dry-run or --simulate)')
+    parser.add_argument('--idle', action='store_true',
+                        help='Run file transfers at idle I/O priority, so '
+                             'they only use the disk when nothing else does')
+    parser.add_argument('-j', '--jobs', type=int, default=0, metavar='N',
+                        help='Read, check and plan albums in N processes, '
+                             'ahead of the albums being moved/copied (default: '
+                             'plan each album just before moving/copying it)')
     parser.add_argument('-l', '--len', type=int, default=default_maxpath, metavar='max',
                         help="Truncate generated pathnames that exceed 'max' "
                              "characters (default %d)" % default_maxpath)
+    parser.add_argument('--link', choices=('hard', 'reflink'),
+                        help="When copying, create the new files as hard links "
+                             "or reflinks (copy-on-write clones) of the source "
+                             "files, falling back to a normal copy if that's "
+                             "not possible. Note that hard linked files share "
+                             "their tags with the source files.")
     parser.add_argument('-m', '--move', action='store_true',
                         help='Move files to the destination instead of copying')
+    parser.add_argument('--max-rate', type=float, metavar='MB/s',
+                        help='Limit copies to the given rate in MB per second')
     parser.add_argument('-n', '--dry-run', action='store_true',
                         help="Don't actually move/copy/rename, just show what "
                              "would be done (implies -vv)")
@@ -115,29 +230,441 @@ def parse_args():
                              'Example: -o artist "John Doe;Jane Smith"')
     parser.add_argument('-p', '--pause', action='store_true',
                         help='Pause before exiting')
+    parser.add_argument('-P', '--progress', nargs='?', const='text',
+                        choices=('text', 'json'),
+                        help='Show progress, throughput and ETA for a copy/move '
+                             'to a destination, as a status line or as a '
+                             'stream of JSON objects (default text)')
+    parser.add_argument('--preflight', action='store_true',
+                        help='Plan every album before touching any files, and '
+                             'refuse to start if the destination would run out '
+                             'of space, showing the estimated time taken')
+    parser.add_argument('--fit', action='store_true',
+                        help='With --preflight, move/copy just the albums that '
+                             'fit in the free space instead of refusing to start')
     parser.add_argument('-s', '--sorted-artist', action='store_true',
                         help="For non-classical albums, use the [Album Artist Sort] "
                              "tag, not [AlbumArtist], for the top-level directory "
                              "under which albums are written.")
+    parser.add_argument('--sync', action='store_true',
+                        help='Allow copying into existing album folders in the '
+                             'destination, only copying files which differ, '
+                             'and rewriting just the tags of FLAC files whose '
+                             'audio is unchanged')
+    parser.add_argument('--simulate', action='store_true',
+                        help="Don't move/copy/rename, just plan the new layout "
+                             "of all albums in memory and report path lengths, "
+                             "truncations and collisions across the whole run")
     parser.add_argument('-t', '--truncate-warn', action='store_false',
                         help='Disable the warning if a file needs to be truncated')
+    parser.add_argument('-w', '--watch', metavar='path',
+                        help='Pause copies while files under this path (e.g. '
+                             'where CD Ripper writes new rips) are being '
+                             'written')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Output more info about what's being done. Repeated "
                              "uses (-vv) will display even more info.")
     args = parser.parse_args()
     prog = parser.prog
-    if not os.path.exists(args.source):
+    if args.from_snapshot:
+        # Snapshot paths are used just as they were saved
+        if not (args.dry_run or args.simulate):
+            raise Error('--from-snapshot can only be used with --dry-run or --simulate')
+        if args.sync:
+            raise Error('--sync cannot be used with --from-snapshot')
+        try:
+            load_snapshot(args.from_snapshot)
+        except (OSError, ValueError) as e:
+            raise Error("can't load snapshot '%s': %s" % (args.from_snapshot, e))
+    elif not os.path.exists(args.source):
         raise Error('source path does not exist')
-    args.source = os.path.abspath(args.source)
+    else:
+        args.source = os.path.abspath(args.source)
     if args.dest:
         args.dest = os.path.abspath(args.dest)
         if args.source.lower() == args.dest.lower():
             raise Error('source and destination arguments must be different')
+    if args.link and (args.move or not args.dest):
+        raise Error('--link can only be used when copying to a destination')
+    if args.sync and (args.move or not args.dest):
+        raise Error('--sync can only be used when copying to a destination')
+    if args.check:
+        try:
+            CheckFlacTags.parse_args(shlex.split(args.check_options))
+        except SystemExit:
+            raise Error('bad --check-options for CheckFlacTags')
+        # Only the checks themselves are run on each album, so options that
+        # choose the albums or fix or save them would be silently ignored
+        check_args = CheckFlacTags.args
+        ignored = [option for option, used in (
+            ('paths', check_args.path != [CheckFlacTags.default_path]),
+            ('--fix', check_args.fix),
+            ('--recent-first', check_args.recent_first),
+            ('--since', check_args.since),
+            ('--budget', check_args.budget is not None),
+            ('--shard', check_args.shard),
+            ('--results', check_args.results),
+            ('--merge', check_args.merge),
+            ('--export-snapshot', check_args.export_snapshot),
+            ('--from-snapshot', check_args.from_snapshot),
+            ('--pause', check_args.pause)) if used]
+        if ignored:
+            raise Error("%s can't be used in --check-options" % ', '.join(ignored))
+        if args.from_snapshot and (CheckFlacTags.args.verify_frames or
+                                   CheckFlacTags.args.verify_audio or
+                                   CheckFlacTags.args.cover_art or
+                                   CheckFlacTags.args.rip_log):
+            raise Error('--verify-frames, --verify-audio, --cover-art and '
+                        '--rip-log need the files themselves, not a snapshot')
+    if args.max_rate is not None and args.max_rate <= 0:
+        raise Error('--max-rate must be greater than 0')
+    if args.watch and not os.path.isdir(args.watch):
+        raise Error('--watch path is not a directory')
+    if args.jobs < 0:
+        raise Error('--jobs must not be negative')
+    if args.jobs and args.simulate:
+        raise Error('--jobs cannot be used with --simulate')
+    if args.preflight and (not args.dest or args.simulate):
+        raise Error('--preflight can only be used when moving/copying to a '
+                    'destination, without --simulate')
+    if args.fit and not args.preflight:
+        raise Error('--fit can only be used with --preflight')
     if args.dry_run:
         args.verbose = 2
         print('Note: This is a dry run; no changes are being made')
 
 
+class VirtualTree:
+    """
+    In-memory model of the destination layout for --simulate.  Paths planned
+    by earlier albums are recorded here instead of being created, and the
+    real directories underneath are each listed at most once, so checking if
+    a path exists never needs a per-file stat.  Names are compared without
+    regard to case, as on Windows.  Also collects the statistics reported at
+    the end of the simulation.
+    """
+    def __init__(self):
+        self.planned = defaultdict(set)     # dir -> names planned in dir
+        self.on_disk = {}                   # dir -> names found in dir
+        self.folders = OrderedDict()        # new album folder -> old folders
+        self.lengths = Counter()            # final path length -> file count
+        self.longest = []                   # heap of (length, path)
+        self.albums = 0
+        self.error_albums = 0
+        self.files = 0
+        self.too_long = 0
+        self.truncated = 0
+        self.untruncatable = 0
+        self.name_collisions = 0
+        self.existing_files = 0
+
+    def listing(self, path):
+        # Names found on disk in a directory, listing it only if its parent
+        # directory contains it.
+        key = path.lower()
+        if key not in self.on_disk:
+            parent = os.path.dirname(path)
+            names = set()
+            if (parent == path or
+                    os.path.basename(key) in self.listing(parent)):
+                try:
+                    names = {name.lower() for name in listdir(path)}
+                except OSError:
+                    pass
+            self.on_disk[key] = names
+        return self.on_disk[key]
+
+    def exists(self, path):
+        # Return 'planned' if an earlier album is planned to create path,
+        # 'existing' if it's already on disk, else None.
+        parent, name = os.path.split(path)
+        name = name.lower()
+        if name in self.planned[parent.lower()]:
+            return 'planned'
+        if name in self.listing(parent):
+            return 'existing'
+        return None
+
+    def add(self, path):
+        # Record a planned path, along with any new parent directories.
+        parent, name = os.path.split(path)
+        while name:
+            self.planned[parent.lower()].add(name.lower())
+            parent, name = os.path.split(parent)
+
+    def add_album(self, album):
+        # Record the planned paths of an album without errors.  Only these
+        # albums count toward the path statistics, since albums with errors
+        # would never be written.
+        self.add(album.new_path)
+        for new in album.new_files:
+            path = os.path.join(album.new_path, new)
+            self.add(path)
+            self.record_path(path)
+        self.too_long += album.too_long
+        self.truncated += album.truncated
+
+    def record_path(self, path):
+        self.files += 1
+        self.lengths[len(path)] += 1
+        item = (len(path), path)
+        if len(self.longest) < simulate_longest:
+            heapq.heappush(self.longest, item)
+        else:
+            heapq.heappushpop(self.longest, item)
+
+    def report(self):
+        print('\nSimulated %d albums, %d with errors' %
+              (self.albums, self.error_albums))
+        print('  Files in albums without errors: %d' % self.files)
+        print('  Paths over %d characters before truncation: %d' %
+              (args.len, self.too_long))
+        print('  Filenames truncated: %d' % self.truncated)
+        print('  Filenames too short to truncate: %d' % self.untruncatable)
+        print('  Files renamed to the same name within an album: %d' %
+              self.name_collisions)
+        print('  Files that would overwrite existing files: %d' %
+              self.existing_files)
+        collisions = [item for item in self.folders.values() if len(item[1]) > 1]
+        print('  Album folders shared by more than one album: %d' % len(collisions))
+        for new, olds in collisions:
+            print('    %s' % new)
+            for old in olds:
+                print('      <- %s' % old)
+        if self.lengths:
+            print('  Final path lengths:')
+            low = min(self.lengths) // 10 * 10
+            high = max(self.lengths) // 10 * 10
+            for bucket in range(low, high + 1, 10):
+                count = sum(self.lengths[n] for n in range(bucket, bucket + 10))
+                print('    %3d-%3d: %d' % (bucket, bucket + 9, count))
+            print('  Longest paths:')
+            for length, path in sorted(self.longest, reverse=True):
+                print('    %d %s' % (length, path))
+
+
+class Throttle:
+    """
+    Paces copies for the --max-rate and --watch options.  Call wait() after
+    transferring each chunk of data.
+    """
+    def __init__(self, max_rate, watch_path):
+        self.rate = max_rate * 1e6 if max_rate else None
+        self.watch_path = watch_path
+        self.start = time.monotonic()
+        self.bytes = 0
+        self.next_watch = 0
+        self.paused = False
+
+    def wait(self, nbytes):
+        if self.rate:
+            # Sleep until the bytes transferred so far are back under the
+            # rate limit.  Restart the accounting after falling more than a
+            # second behind (e.g. while paused), to avoid a burst afterwards.
+            self.bytes += nbytes
+            now = time.monotonic()
+            delay = self.start + self.bytes / self.rate - now
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1:
+                self.start, self.bytes = now, 0
+        if self.watch_path:
+            while self.watched_path_busy():
+                time.sleep(watch_interval)
+
+    def watched_path_busy(self):
+        # Scan the --watch folder (at most every watch_interval seconds), and
+        # report it busy if any file was modified in the last watch_quiet
+        # seconds.
+        now = time.time()
+        if now < self.next_watch:
+            return self.paused
+        self.next_watch = now + watch_interval
+        busy = False
+        for path, _, files in os.walk(self.watch_path):
+            for file in files:
+                try:
+                    mtime = os.stat(os.path.join(path, file)).st_mtime
+                except OSError:
+                    continue
+                if mtime > now - watch_quiet:
+                    busy = True
+                    break
+            if busy:
+                break
+        if busy != self.paused and args.verbose:
+            print('%s copying, %s is %s' %
+                  (('Pausing', 'Resuming')[self.paused], self.watch_path,
+                   ('busy', 'idle')[self.paused]))
+        self.paused = busy
+        return busy
+
+
+class Progress:
+    """
+    Tracks and reports the progress of a copy/move run for --progress.  The
+    planned totals come from a scan of the source albums before any files are
+    transferred.
+    """
+    def __init__(self, style, album_sizes):
+        self.style = style
+        self.planned_bytes = sum(size for size, _ in album_sizes.values())
+        self.planned_files = sum(count for _, count in album_sizes.values())
+        self.album_sizes = album_sizes
+        self.done = 0           # Bytes of files processed so far
+        self.copied = 0         # Bytes actually copied (not linked/renamed)
+        self.skipped = 0        # Planned bytes in albums with errors
+        self.files = 0
+        self.albums = 0
+        self.start = self.last_render = time.monotonic()
+        self.history = deque([(self.start, 0, 0)])
+        self.line_len = 0
+        self.emit(event='start', bytes=self.planned_bytes,
+                  files=self.planned_files, albums=len(album_sizes))
+
+    def emit(self, **event):
+        if self.style == 'json':
+            print(json.dumps(event, sort_keys=True), file=sys.stderr)
+
+    def start_album(self, path):
+        self.album = path
+        self.album_start = time.monotonic()
+
+    def end_album(self, processed):
+        elapsed = time.monotonic() - self.album_start
+        size = self.album_sizes[self.album][0]
+        if processed:
+            self.albums += 1
+        else:
+            self.skipped += size
+        self.emit(event='album', path=self.album, bytes=size,
+                  processed=processed, elapsed=round(elapsed, 3))
+        self.render(force=True)
+
+    def start_file(self):
+        self.file_start = self.done
+
+    def end_file(self, size):
+        self.done = self.file_start + size
+        self.files += 1
+        self.render()
+
+    def add(self, nbytes):
+        # Called as chunks of a file are copied, for more frequent updates
+        self.done += nbytes
+        self.render()
+
+    def rates(self, now):
+        # Return bytes and files per second over the last progress_window
+        # seconds.
+        then, done, files = self.history[0]
+        if now <= then:
+            return 0, 0
+        return (self.done - done) / (now - then), (self.files - files) / (now - then)
+
+    def render(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_render < progress_interval:
+            return
+        self.last_render = now
+        self.history.append((now, self.done, self.files))
+        while now - self.history[0][0] > progress_window:
+            self.history.popleft()
+        byte_rate, file_rate = self.rates(now)
+        remaining = max(self.planned_bytes - self.skipped - self.done, 0)
+        eta = remaining / byte_rate if byte_rate else None
+        album_elapsed = now - self.album_start
+        if self.style == 'json':
+            self.emit(event='progress', bytes_done=self.done,
+                      bytes_planned=self.planned_bytes, files_done=self.files,
+                      mb_per_sec=round(byte_rate / 1e6, 3),
+                      files_per_sec=round(file_rate, 3),
+                      eta=None if eta is None else round(eta, 1),
+                      album=self.album, album_elapsed=round(album_elapsed, 3))
+            return
+        percent = 100 * self.done / self.planned_bytes if self.planned_bytes else 100
+        line = '[%5.1f%%] %s/%s  %.1f MB/s  %.1f files/s  ETA %s  album %s  %s' % (
+            percent, format_size(self.done), format_size(self.planned_bytes),
+            byte_rate / 1e6, file_rate, format_duration(eta),
+            format_duration(album_elapsed), os.path.basename(self.album))
+        width = shutil.get_terminal_size().columns - 1
+        line = line[:width]
+        print('\r' + line.ljust(self.line_len), end='', file=sys.stderr)
+        sys.stderr.flush()
+        self.line_len = len(line)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.done / elapsed if elapsed else 0
+        self.emit(event='summary', bytes_planned=self.planned_bytes,
+                  bytes_done=self.done, bytes_copied=self.copied,
+                  bytes_skipped=self.skipped, files_planned=self.planned_files,
+                  files_done=self.files, albums_done=self.albums,
+                  elapsed=round(elapsed, 3), mb_per_sec=round(rate / 1e6, 3))
+        if self.style == 'json':
+            return
+        print('\r' + ' ' * self.line_len, file=sys.stderr)
+        print('Planned:   %s in %d files, %d albums' %
+              (format_size(self.planned_bytes), self.planned_files,
+               len(self.album_sizes)), file=sys.stderr)
+        print('Processed: %s in %d files, %d albums (%s copied)' %
+              (format_size(self.done), self.files, self.albums,
+               format_size(self.copied)), file=sys.stderr)
+        if self.skipped:
+            print('Skipped:   %s in albums with errors' %
+                  format_size(self.skipped), file=sys.stderr)
+        print('Elapsed:   %s, average %.1f MB/s, %.1f files/s' %
+              (format_duration(elapsed), rate / 1e6,
+               self.files / elapsed if elapsed else 0), file=sys.stderr)
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1000:
+            break
+        size /= 1000
+    else:
+        unit = 'TB'
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+
+
+def format_duration(secs):
+    if secs is None:
+        return '-:--:--'
+    secs = int(secs)
+    return '%d:%02d:%02d' % (secs // 3600, secs // 60 % 60, secs % 60)
+
+
+def get_album_sizes(album_paths):
+    # Total up the size and number of the files in each album folder, for
+    # the --progress planned totals.
+    sizes = OrderedDict()
+    for album_path in album_paths:
+        size = count = 0
+        for fname in os.listdir(album_path):
+            path = os.path.join(album_path, fname)
+            if os.path.isfile(path):
+                size += os.path.getsize(path)
+                count += 1
+        sizes[album_path] = (size, count)
+    return sizes
+
+
+def set_idle_io_priority():
+    # Lower the I/O priority of the calling thread to the idle class on Linux
+    # (very low on Windows), so file transfers don't slow down CD Ripper.
+    try:
+        import psutil
+        proc = psutil.Process()
+        if hasattr(psutil, 'IOPRIO_CLASS_IDLE'):
+            proc.ionice(psutil.IOPRIO_CLASS_IDLE)
+        else:
+            proc.ionice(psutil.IOPRIO_VERYLOW)
+    except Exception as e:
+        print('Warning: Unable to set idle I/O priority')
+        print(e)
+
+
 def process_tag_overrides(album):
     # Handle the -o cmdline option, overriding the values of tags in
     # album.identical.
@@ -220,11 +747,21 @@ def check_new_path(album):
     path_head = args.dest if args.dest else os.path.dirname(album.path)
     album.new_path = os.path.join(path_head, *dirs)
     album.new_folder = dirs[-1]
-    if album.path.lower() != album.new_path.lower():
-        if os.path.exists(album.new_path):
+    if vfs:
+        vfs.folders.setdefault(album.new_path.lower(),
+                               (album.new_path, []))[1].append(album.path)
+    if album.path.lower() != album.new_path.lower() and not args.sync:
+        if path_exists(album.new_path):
             msgs.error("Destination '%s' already exists" % album.new_path)
 
 
+def path_exists(path):
+    # Check if a path exists, in the planned layout for --simulate.
+    if vfs:
+        return vfs.exists(path)
+    return exists(path)
+
+
 def get_new_audio_file_name(album, discnum, tracknum, track):
     name = '%02d %s' % (tracknum, track['title'][0])
     if track['disctotal'][0] != '1':
@@ -253,13 +790,17 @@ def record_file_to_process(album, old_name, new_name):
     if len(new_fullpath) > args.len:
         base, ext = os.path.splitext(new_name)
         shrink = len(new_fullpath) - args.len + len('..')
+        album.too_long += 1
         if len(base) - shrink < default_retain_name:
             # Error if truncating the name won't retain enough characters from
             # the original base filename.
             msgs.error('New filename is too short to truncate to keep pathname'
                         ' in limits')
             msgs.error('  %s' % new_fullpath)
+            if vfs:
+                vfs.untruncatable += 1
         else:
+            album.truncated += 1
             truncated_name = base[:-shrink] + '..' + ext
             if args.truncate_warn:
                 msgs.warn('New filename will be truncated')
@@ -273,9 +814,13 @@ def record_file_to_process(album, old_name, new_name):
         msgs.error('  %s' % prev_old_name)
         msgs.error('  %s' % old_name)
         msgs.error('  -> %s' % new_name)
-    if args.dest:
+        if vfs:
+            vfs.name_collisions += 1
+    if args.dest and not args.sync:
         new_fullpath = os.path.join(album.new_path, new_name)
-        if os.path.exists(new_fullpath):
+        if path_exists(new_fullpath):
+            if vfs:
+                vfs.existing_files += 1
             msgs.error('New file already exists in new directory:')
             msgs.error('  %s' % old_name)
             msgs.error('  -> %s' % new_fullpath)
@@ -309,11 +854,11 @@ def check_aux_file(album, fname, attrib, ext):
 def check_and_prepare_auxiliary_files(album):
     # Find the existing cuesheet and extraction log files and make sure they
     # can be successfully renamed and moved or copied.
-    for fname in sorted(os.listdir(album.path)):
+    for fname in sorted(listdir(album.path)):
         if fname.endswith('.cue'):
             check_aux_file(album, fname, 'cuesheet', '.cue')
         if fname.endswith('.txt'):
-            with open(os.path.join(album.path, fname), 'rt', encoding='utf_16_le') as f:
+            with io.TextIOWrapper(open_file(album.path, fname), encoding='utf_16_le') as f:
                 line = f.readline()
             if re.search('dBpoweramp.*Digital Audio Extraction Log', line):
                 check_aux_file(album, fname, 'logfile', '.txt')
@@ -324,7 +869,7 @@ def prepare_other_files(album):
     # transferred in addition to the audio and auxiliary files.  These files will
     # be moved without renaming.
     if args.dest:
-        for fname in sorted(os.listdir(album.path)):
+        for fname in sorted(listdir(album.path)):
             if fname not in album.old_files:
                 record_file_to_process(album, fname, fname)
 
@@ -344,8 +889,198 @@ def remove_empty_directories(path, root):
         path = os.path.dirname(path)
 
 
+def reflink_file(old_path, new_path):
+    # Create new_path as a copy-on-write clone of old_path, sharing the same
+    # disk blocks until either file is modified.  Raises OSError if reflinks
+    # aren't supported by the OS or the filesystem.
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this system')
+    try:
+        with open(old_path, 'rb') as src, open(new_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        if os.path.exists(new_path):
+            os.remove(new_path)
+        raise
+    shutil.copystat(old_path, new_path)
+
+
+def chunked_copy(old_path, new_path):
+    # Copy a file in chunks, pacing the copy for --max-rate and --watch, and
+    # updating --progress as it goes.
+    with open(old_path, 'rb') as src, open(new_path, 'wb') as dst:
+        while True:
+            data = src.read(copy_chunk_size)
+            if not data:
+                break
+            dst.write(data)
+            if throttle:
+                throttle.wait(len(data))
+            if progress:
+                progress.add(len(data))
+    shutil.copystat(old_path, new_path)
+    return new_path
+
+
+def copy_file(old_path, new_path):
+    # Copy a file to the destination, as a hard link or reflink if requested
+    # with --link.  If the link can't be made (e.g. the destination is on a
+    # different filesystem, or the filesystem doesn't support reflinks), warn
+    # and fall back to a normal copy.  Links aren't tried again between the
+    # same source and destination devices, but still are between others.
+    # Copies are throttled if needed.
+    global copied_bytes, copy_seconds
+    if args.link:
+        devices = (os.stat(old_path).st_dev, os.stat(os.path.dirname(new_path)).st_dev)
+    if args.link and devices not in link_failed:
+        try:
+            if args.link == 'hard':
+                os.link(old_path, new_path)
+            else:
+                reflink_file(old_path, new_path)
+            return
+        except OSError as e:
+            print('Warning: Unable to create %s in %s, copying files there instead' %
+                  ('hard link' if args.link == 'hard' else 'reflink',
+                   os.path.dirname(new_path)))
+            print(e)
+            link_failed.add(devices)
+    start = time.monotonic()
+    if throttle or progress:
+        chunked_copy(old_path, new_path)
+    else:
+        shutil.copy2(old_path, new_path)
+    size = os.path.getsize(new_path)
+    copied_bytes += size
+    copy_seconds += time.monotonic() - start
+    if progress:
+        progress.copied += size
+    return new_path
+
+
+def get_unchanged_audio_header(old_path, new_path):
+    # For --sync, check if two FLAC files hold the same audio at the same file
+    # offset, so only their metadata blocks can differ.  The audio is compared
+    # using the STREAMINFO block, which includes an MD5 of the decoded audio,
+    # and the size of the encoded audio, so the audio is never read.  Returns
+    # the FlacHeader of old_path if so, else None.
+    try:
+        old_header = FlacHeader(old_path)
+        new_header = FlacHeader(new_path)
+    except (OSError, ValueError):
+        return None
+    streaminfo = old_header.get_block(FLAC_STREAMINFO)
+    if (streaminfo is None or
+            streaminfo != new_header.get_block(FLAC_STREAMINFO) or
+            old_header.streaminfo.md5 == bytes(16) or
+            old_header.audio_offset != new_header.audio_offset or
+            old_header.audio_size != new_header.audio_size):
+        return None
+    return old_header
+
+
+def sync_file(old_path, new_path):
+    # Bring an existing destination file up to date with the source file.
+    # Returns the operation performed (or that would be performed, for a dry
+    # run): 'Skip' if the size and modification times match, 'Update tags'
+    # for a FLAC file whose metadata blocks could be rewritten in place, else
+    # 'Copy'.
+    old_stat = os.stat(old_path)
+    new_stat = os.stat(new_path)
+    if (old_stat.st_size == new_stat.st_size and
+            abs(old_stat.st_mtime - new_stat.st_mtime) < sync_mtime_window):
+        return 'Skip'
+    if old_path.endswith('.flac'):
+        header = get_unchanged_audio_header(old_path, new_path)
+        if header:
+            if not args.dry_run:
+                with open(old_path, 'rb') as f:
+                    metadata = f.read(header.audio_offset)
+                with open(new_path, 'r+b') as f:
+                    f.write(metadata)
+                shutil.copystat(old_path, new_path)
+            return 'Update tags'
+    if not args.dry_run:
+        # Remove the old file first, in case it's a hard link to some other
+        # file which shouldn't be overwritten.
+        os.remove(new_path)
+        copy_file(old_path, new_path)
+    return 'Copy'
+
+
+def do_sync(album):
+    # Perform a --sync copy, where the album folder may already exist in
+    # the destination.  Destination FLAC files which aren't part of the new
+    # layout, but hold the same audio as one of the source files (typically
+    # because a retagged title changed the filename), are renamed instead of
+    # making a new copy.  Any other unexpected files are reported, not removed.
+    if args.verbose > 1:
+        print('Sync to:   %s' % album.new_path)
+    stale = {}
+    extra = []
+    if os.path.isdir(album.new_path):
+        for fname in sorted(os.listdir(album.new_path)):
+            if fname in album.new_files:
+                continue
+            extra.append(fname)
+            if fname.endswith('.flac'):
+                try:
+                    header = FlacHeader(os.path.join(album.new_path, fname))
+                except (OSError, ValueError):
+                    continue
+                streaminfo = header.get_block(FLAC_STREAMINFO)
+                if streaminfo is not None:
+                    stale.setdefault(streaminfo, fname)
+    elif not args.dry_run:
+        os.makedirs(album.new_path)
+    for old, new in album.old_files.items():
+        old_path = os.path.join(album.path, old)
+        new_path = os.path.join(album.new_path, new)
+        if progress:
+            progress.start_file()
+        sync_one_file(album, old, new, old_path, new_path, stale, extra)
+        if progress:
+            progress.end_file(os.path.getsize(old_path))
+    if extra:
+        print('Warning: Files in %s not found in the source:' % album.new_path)
+        for fname in extra:
+            print('  %s' % fname)
+
+
+def sync_one_file(album, old, new, old_path, new_path, stale, extra):
+    # Helper for do_sync, bringing a single destination file up to date.
+    # Only a source FLAC file with a readable STREAMINFO block can match a
+    # stale file; any other file is just copied.
+    if not os.path.exists(new_path):
+        streaminfo = None
+        if stale and old.endswith('.flac'):
+            try:
+                streaminfo = FlacHeader(old_path).get_block(FLAC_STREAMINFO)
+            except (OSError, ValueError):
+                pass
+        if streaminfo is None or streaminfo not in stale:
+            if args.verbose > 1:
+                print('Copy %s\n  -> %s' % (old, new))
+            if not args.dry_run:
+                copy_file(old_path, new_path)
+            return
+        stale_name = stale.pop(streaminfo)
+        extra.remove(stale_name)
+        if args.verbose > 1:
+            print('Rename %s\n    -> %s' % (stale_name, new))
+        if args.dry_run:
+            return
+        os.rename(os.path.join(album.new_path, stale_name), new_path)
+    operation = sync_file(old_path, new_path)
+    if args.verbose > 1 and operation != 'Skip':
+        print('%s %s\n  -> %s' % (operation, old, new))
+
+
 def do_move_or_copy(album):
     # Perform the actual move/copy when source and destination are specified.
+    if args.sync:
+        do_sync(album)
+        return
     operation = 'Move' if args.move else 'Copy'
     if args.verbose > 1:
         print('%s to:   %s' % (operation, album.new_path))
@@ -357,10 +1092,15 @@ def do_move_or_copy(album):
         if not args.dry_run:
             old_path = os.path.join(album.path, old)
             new_path = os.path.join(album.new_path, new)
+            if progress:
+                progress.start_file()
+                size = os.path.getsize(old_path)
             if args.move:
-                shutil.move(old_path, new_path)
+                shutil.move(old_path, new_path, copy_function=copy_file)
             else:
-                shutil.copy2(old_path, new_path)
+                copy_file(old_path, new_path)
+            if progress:
+                progress.end_file(size)
     if args.move:
         remove_empty_directories(album.path, args.source)
 
@@ -387,9 +1127,20 @@ def do_rename_in_place(album):
         print('No album files renamed')
 
 
-def process_album(album_path):
+def plan_album(album_path):
+    # Read, check and plan the rename or move/copy of a single album, without
+    # changing anything.  Returns the album and the messages for any problems
+    # found, or None for the album if --check found errors.
     global msgs
     album, msgs = get_album(album_path)
+    if args.check:
+        # The checks print their own report, so start over with a fresh
+        # set of messages for the rearrangement itself.  The checks are run
+        # on a copy, since they add tags (e.g. disctotal from totaldiscs)
+        # which aren't in the files and mustn't change the new paths.
+        if not CheckFlacTags.check_album(copy.deepcopy(album), msgs) and msgs.errors:
+            return None, msgs
+        msgs = Messages()
     if not msgs.errors:
         find_common_album_tags(album)
         find_identical_album_tags(album)
@@ -399,30 +1150,304 @@ def process_album(album_path):
         check_new_path(album)
         album.old_files = OrderedDict()
         album.new_files = {}
+        album.too_long = 0          # New paths over --len...
+        album.truncated = 0         # ...and how many were truncated
         check_and_prepare_audio_files(album)
         check_and_prepare_auxiliary_files(album)
         prepare_other_files(album)
+    return album, msgs
+
+
+def execute_album(album, album_msgs):
+    # Rename or move/copy a single album planned by plan_album.  Returns False
+    # if the album was skipped because of errors.
+    global msgs
+    msgs = album_msgs
+    album_path = album.path
+    if not msgs.errors and not args.sync:
+        # Albums planned ahead with --jobs can't see the destinations of the
+        # albums before them, so check for collisions with those here.
+        claimed = claimed_paths.get(album.new_path.lower())
+        if claimed is not None:
+            msgs.error("Destination '%s' already exists" % album.new_path)
+            for old, new in album.old_files.items():
+                if args.dest and new in claimed:
+                    msgs.error('New file already exists in new directory:')
+                    msgs.error('  %s' % old)
+                    msgs.error('  -> %s' % os.path.join(album.new_path, new))
+    if vfs:
+        # Just record the planned layout, reporting on it at the end of the run
+        vfs.albums += 1
+        if msgs.errors:
+            vfs.error_albums += 1
+        else:
+            vfs.add_album(album)
+        if args.verbose and msgs:
+            print('\nProblems found in %s\n%s' % (album_path, msgs))
+        return not msgs.errors
     if msgs:
         kind = ('Errors' if not msgs.warnings
                 else 'Warnings' if not msgs.errors
                 else 'Errors and warnings')
         print('\n%s found in %s\n%s' % (kind, album_path, msgs))
         if msgs.errors:
-            return
+            return False
     if args.verbose:
         print('\nProcessing %s' % album_path)
     if args.dest:
         do_move_or_copy(album)
     else:
         do_rename_in_place(album)
-    return
+    claimed_paths.setdefault(album.new_path.lower(), set()).update(album.new_files)
+    return True
+
+
+def init_planner(main_args):
+    # Initializer for the --jobs planner processes, which need the same
+    # settings as the main process.
+    global args
+    args = main_args
+    if args.from_snapshot:
+        load_snapshot(args.from_snapshot)
+    if args.check:
+        CheckFlacTags.parse_args(shlex.split(args.check_options))
+    if args.idle:
+        set_idle_io_priority()
+
+
+def plan_album_in_planner(album_path):
+    # Run plan_album in a planner process.  Its output is captured so the
+    # main process can print it in order, and the CheckFlacTags counts for
+    # the album are returned to be added to the main process's totals.
+    output = io.StringIO()
+    before = [getattr(CheckFlacTags, name) for name in check_counters]
+    with contextlib.redirect_stdout(output):
+        album, album_msgs = plan_album(album_path)
+    counts = [getattr(CheckFlacTags, name) - count
+              for name, count in zip(check_counters, before)]
+    return album, album_msgs, output.getvalue(), counts
+
+
+def planned_albums(album_paths):
+    # Generator yielding (album path, album, messages) for each album, in
+    # order.  With --jobs, the albums are planned by a pool of processes,
+    # keeping at most planner_lookahead albums per process in flight.
+    if not args.jobs:
+        for album_path in album_paths:
+            yield (album_path,) + plan_album(album_path)
+        return
+    with ProcessPoolExecutor(args.jobs, initializer=init_planner,
+                             initargs=(args,)) as executor:
+        pending = deque()
+        album_paths = iter(album_paths)
+        while True:
+            for album_path in album_paths:
+                pending.append((album_path, executor.submit(plan_album_in_planner, album_path)))
+                if len(pending) >= args.jobs * planner_lookahead:
+                    break
+            if not pending:
+                break
+            album_path, future = pending.popleft()
+            album, album_msgs, output, counts = future.result()
+            print(output, end='')
+            for name, count in zip(check_counters, counts):
+                setattr(CheckFlacTags, name, getattr(CheckFlacTags, name) + count)
+            yield album_path, album, album_msgs
+
+
+def existing_ancestor(path):
+    # Return the nearest directory at or above path which already exists
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def can_reflink(album, ancestor, device):
+    # Return whether files of an album can be reflinked onto a device, by
+    # cloning one of them into a temporary file.  Filesystems like ext4 and
+    # NTFS don't support reflinks, so copy_file would copy every byte.  The
+    # answer is remembered for each device.  A dry run mustn't write to the
+    # destination, so it assumes reflinks can't be made.
+    if args.dry_run:
+        return False
+    if device not in reflink_devices:
+        old = next(iter(album.old_files), None)
+        probe_path = os.path.join(ancestor, '.reflink-probe-%d' % os.getpid())
+        try:
+            if old is None:
+                raise OSError('no files to probe')
+            reflink_file(os.path.join(album.path, old), probe_path)
+            os.remove(probe_path)
+            reflink_devices[device] = True
+        except OSError:
+            reflink_devices[device] = False
+    return reflink_devices[device]
+
+
+def album_transfer_bytes(album):
+    # Return the bytes the move/copy of an album will add to its destination
+    # device.  Nothing is added when the files can be renamed or hard linked
+    # on the same device, or reflinked onto a device which supports it, and
+    # --sync only copies files which differ in size.
+    source_dev = os.stat(album.path).st_dev
+    ancestor = existing_ancestor(album.new_path)
+    dest_dev = os.stat(ancestor).st_dev
+    if source_dev == dest_dev:
+        if args.move or args.link == 'hard':
+            return 0
+        if args.link == 'reflink' and can_reflink(album, ancestor, dest_dev):
+            return 0
+    total = 0
+    for old, new in album.old_files.items():
+        size = os.path.getsize(os.path.join(album.path, old))
+        if args.sync:
+            try:
+                if os.path.getsize(os.path.join(album.new_path, new)) == size:
+                    continue
+            except OSError:
+                pass
+        total += size
+    return total
+
+
+def load_throughput():
+    # Return the throughput history, a list of [device, bytes, seconds] for
+    # the most recent copy runs.
+    try:
+        with open(throughput_file, encoding='UTF-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def record_throughput():
+    # Add this run's copy throughput to the history used by --preflight
+    if args.dry_run or copied_bytes < throughput_min_bytes or not copy_seconds:
+        return
+    device = os.stat(existing_ancestor(args.dest)).st_dev
+    history = load_throughput() + [[device, copied_bytes, copy_seconds]]
+    try:
+        with open(throughput_file, 'w', encoding='UTF-8') as f:
+            json.dump(history[-throughput_runs:], f)
+    except OSError as e:
+        print('Warning: Unable to save throughput history')
+        print(e)
+
+
+def estimate_rate(device):
+    # Average copy rate in bytes/sec from the throughput history, preferring
+    # runs to the same device.  Returns (rate, runs used), or (None, 0).
+    history = load_throughput()
+    runs = [run for run in history if run[0] == device] or history
+    seconds = sum(run[2] for run in runs)
+    if not seconds:
+        return None, 0
+    return sum(run[1] for run in runs) / seconds, len(runs)
+
+
+def preflight(planned):
+    # Check that the planned albums will fit on their destination devices,
+    # leaving a reserve of free space, before any files are touched.  Prints
+    # the space needed and the estimated time taken.  Raises Error if the
+    # albums won't fit, unless --fit is used, in which case albums that don't
+    # fit are left out.  Returns the list of albums to move/copy.
+    devices = OrderedDict()     # st_dev -> [path, free, reserve, needed]
+    sizes = []
+    for album_path, album, album_msgs in planned:
+        if album is None or album_msgs.errors:
+            sizes.append((None, 0))
+            continue
+        ancestor = existing_ancestor(album.new_path)
+        device = os.stat(ancestor).st_dev
+        if device not in devices:
+            usage = shutil.disk_usage(ancestor)
+            reserve = max(preflight_reserve, usage.total * preflight_reserve_fraction)
+            devices[device] = [ancestor, usage.free, reserve, 0]
+        sizes.append((device, album_transfer_bytes(album)))
+    kept = []
+    for (album_path, album, album_msgs), (device, size) in zip(planned, sizes):
+        if device is not None:
+            _, free, reserve, needed = devices[device]
+            if args.fit and needed + size > free - reserve:
+                unfit_albums.append((album_path, size))
+                continue
+            devices[device][3] += size
+        kept.append((album_path, album, album_msgs))
+    errors = sum(1 for device, _ in sizes if device is None)
+    print('\nPreflight: %d albums planned, %d with errors' % (len(planned), errors))
+    full = []
+    for device, (path, free, reserve, needed) in devices.items():
+        fits = needed <= free - reserve
+        if not fits:
+            full.append(path)
+        print('  %s: %s needed, %s free, %s reserved - %s' %
+              (path, format_size(needed), format_size(free), format_size(reserve),
+               'OK' if fits else 'NOT ENOUGH SPACE'))
+        rate, runs = estimate_rate(device)
+        if needed and rate:
+            print('  Estimated time: %s at %.1f MB/s (average of %d earlier run%s)' %
+                  (format_duration(needed / rate), rate / 1e6, runs, '' if runs == 1 else 's'))
+        elif needed:
+            print('  Estimated time: unknown, no copy throughput recorded yet')
+    if unfit_albums:
+        print('  Leaving out %d album%s (%s) which do not fit:' %
+              (len(unfit_albums), '' if len(unfit_albums) == 1 else 's',
+               format_size(sum(size for _, size in unfit_albums))))
+        for album_path, size in unfit_albums:
+            print('    %s (%s)' % (album_path, format_size(size)))
+    if full:
+        raise Error('not enough free space on %s; use --fit to move/copy just '
+                    'the albums that fit' % ', '.join(full))
+    return kept
 
 
 def main():
+    global throttle, progress, vfs
     try:
         parse_args()
-        for album_path in find_albums(args.source):
-            process_album(album_path)
+        if args.simulate:
+            vfs = VirtualTree()
+        if args.max_rate or args.watch:
+            throttle = Throttle(args.max_rate, args.watch)
+        if args.idle:
+            set_idle_io_priority()
+        album_paths = find_albums(args.source)
+        if args.preflight:
+            # Plan everything up front, then just move/copy what fits
+            planned = preflight(list(planned_albums(album_paths)))
+            album_paths = [album_path for album_path, _, _ in planned]
+        if args.progress and args.dest and not (args.dry_run or vfs):
+            album_paths = list(album_paths)
+            progress = Progress(args.progress, get_album_sizes(album_paths))
+        if not args.preflight:
+            planned = planned_albums(album_paths)
+        for album_path, album, album_msgs in planned:
+            if progress:
+                progress.start_album(album_path)
+            if album is None:
+                skipped_albums.append(album_path)
+                processed = False
+            else:
+                processed = execute_album(album, album_msgs)
+            if progress:
+                progress.end_album(processed)
+        if progress:
+            progress.summary()
+        record_throughput()
+        if unfit_albums:
+            print('\nLeft out %d album%s which did not fit:' %
+                  (len(unfit_albums), '' if len(unfit_albums) == 1 else 's'))
+            for album_path, _ in unfit_albums:
+                print('  %s' % album_path)
+        if vfs:
+            vfs.report()
+        if args.check:
+            CheckFlacTags.print_summary()
+            if skipped_albums:
+                print('\nSkipped %d album%s with errors:' %
+                      (len(skipped_albums), '' if len(skipped_albums) == 1 else 's'))
+                for album_path in skipped_albums:
+                    print('  %s' % album_path)
     except Error as e:
         print('%s: error: %s' % (prog, e))
         exit_code = 1
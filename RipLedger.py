@@ -0,0 +1,286 @@
+#! python3
+
+# Keep a ledger of ripping events, and report on rip throughput per drive and
+# per ripping session.
+#
+# LogRippedTrack and PostRipProcess call record() to append an event to the
+# ledger, %TEMP%\RipLedger.jsonl, one JSON object per line:
+#
+# * 'track' - a track finished ripping (from LogRippedTrack): the album
+#   folder, and the file ripped, its size and its length in seconds.
+# * 'disc' - CD Ripper finished a disc (from PostRipProcess): the album
+#   folder, and the drive and drive offset named in the extraction log.
+# * 'check' - the CheckFlacTags run for a disc finished (from
+#   PostRipProcess): when the job was queued, started and finished.
+#
+# Every event also holds its time and the PID of the CD Ripper instance.
+# Several CD Ripper instances can be ripping at once, so the ledger is only
+# appended to while holding a lock file.
+#
+# Run as a script, reports the ripping speed, throughput and the time taken
+# per track (50th, 90th and 99th percentiles) for each drive and for each
+# ripping session (the events from one CD Ripper instance, with no gap of an
+# hour or more), and how long the checks after each disc wait and take.  The
+# first track of each disc isn't timed, since its start isn't known.
+#
+# LogRippedTrack imports this for every track ripped, so argparse, which
+# only the report needs, isn't imported until then.
+
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+ledger_file = os.path.join(tempfile.gettempdir(), 'RipLedger.jsonl')
+lock_timeout = 10       # Secs to wait for the ledger lock
+lock_stale_age = 60     # Secs after which a lock is assumed left behind
+session_gap = 3600      # Secs between events that start a new session
+percentiles = (50, 90, 99)
+
+args = None
+
+
+@contextlib.contextmanager
+def ledger_lock(path):
+    # Hold the lock file for the ledger at path.  A lock older than
+    # lock_stale_age is removed, since its owner must have died.  Raises
+    # TimeoutError if the lock can't be had within lock_timeout.
+    lock_path = path + '.lock'
+    deadline = time.time() + lock_timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > lock_stale_age:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            if time.time() > deadline:
+                raise TimeoutError("Timed out waiting for '%s'" % lock_path)
+            time.sleep(0.05)
+    try:
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock_path)
+
+
+def record(event, ripper_pid, path=ledger_file, **fields):
+    # Append an event to the ledger.  Raises OSError if it can't be written.
+    entry = dict(time=time.time(), event=event, ripper_pid=ripper_pid, **fields)
+    line = json.dumps(entry, ensure_ascii=False) + '\n'
+    with ledger_lock(path):
+        with open(path, 'a', encoding='UTF-8') as f:
+            f.write(line)
+
+
+def track_info(path):
+    # Return the size of a ripped FLAC file and its length in seconds, from
+    # the STREAMINFO block, which must be the first.  The length is None if
+    # it can't be read.
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.read(42)
+    if len(header) < 42 or header[:4] != b'fLaC' or header[4] & 0x7f:
+        return size, None
+    bits = int.from_bytes(header[18:26], 'big')
+    sample_rate = bits >> 44
+    total_samples = bits & 0xfffffffff
+    return size, total_samples / sample_rate if sample_rate else None
+
+
+def parse_args():
+    global args
+    import argparse
+    parser = argparse.ArgumentParser(
+            description='Report rip throughput per drive and session from the rip ledger.')
+    parser.add_argument('--ledger', default=ledger_file, metavar='FILE',
+                        help='ledger to report on (default: RipLedger.jsonl in '
+                             'the temp directory)')
+    parser.add_argument('--since', metavar='DATE',
+                        help='only report on events on or after DATE (YYYY-MM-DD)')
+    args = parser.parse_args()
+    if args.since:
+        try:
+            args.since = time.mktime(time.strptime(args.since, '%Y-%m-%d'))
+        except ValueError:
+            parser.error("--since needs a date like 2024-01-31, not '%s'" % args.since)
+
+
+def read_ledger(path):
+    # Return the events in the ledger, oldest first, skipping any line that
+    # can't be parsed
+    events = []
+    with open(path, encoding='UTF-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(event, dict) and 'time' in event and 'event' in event:
+                events.append(event)
+    events.sort(key=lambda event: event['time'])
+    return events
+
+
+class Session:
+    """
+    The events from one CD Ripper instance, with no long gaps between them.
+    Code also creates these instance attributes:
+    session.ripper_pid = PID of the CD Ripper instance
+    session.start = time of the first event
+    session.end = time of the last event
+    session.discs = list of Discs, in ripping order
+    session.ripping = dict mapping album folder to the Disc still being ripped
+    """
+    def __init__(self, ripper_pid, start):
+        self.ripper_pid = ripper_pid
+        self.start = start
+        self.end = start
+        self.discs = []
+        self.ripping = {}
+
+    def drives(self):
+        return sorted({disc.drive for disc in self.discs})
+
+
+class Disc:
+    """
+    The tracks ripped into an album folder by one batch of CD Ripper.
+    Code also creates these instance attributes:
+    disc.folder = the album folder, normalized for comparing
+    disc.drive = drive from the extraction log, or 'unknown drive'
+    disc.track_count = number of tracks ripped
+    disc.tracks = list of (wall secs, audio secs, bytes) for each timed track
+    disc.last = time the last track finished
+    disc.done = time of the 'disc' event, or None if there wasn't one yet
+    disc.checks = list of (queue wait secs, check secs) for each check
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.drive = 'unknown drive'
+        self.track_count = 0
+        self.tracks = []
+        self.last = None
+        self.done = None
+        self.checks = []
+
+
+def build_sessions(events):
+    # Group the events into Sessions of Discs
+    sessions = []
+    current = {}    # ripper PID -> its latest Session
+    for event in events:
+        pid = event.get('ripper_pid')
+        folder = os.path.normcase(event.get('folder') or '')
+        if event['event'] == 'check':
+            # A check can finish after the ripper has moved on, so it goes
+            # with the last disc of that ripper and folder done before the
+            # check was queued
+            discs = [disc for session in sessions if session.ripper_pid == pid
+                     for disc in session.discs if disc.folder == folder and
+                     disc.done is not None and disc.done <= event['queued']]
+            if discs:
+                discs[-1].checks.append((event['started'] - event['queued'],
+                                         event['finished'] - event['started']))
+            continue
+        session = current.get(pid)
+        if session is None or event['time'] - session.end > session_gap:
+            session = current[pid] = Session(pid, event['time'])
+            sessions.append(session)
+        session.end = event['time']
+        disc = session.ripping.get(folder)
+        if disc is None:
+            disc = session.ripping[folder] = Disc(folder)
+            session.discs.append(disc)
+        if event['event'] == 'track':
+            disc.track_count += 1
+            if disc.last is not None and event.get('seconds'):
+                disc.tracks.append((event['time'] - disc.last, event['seconds'],
+                                    event.get('bytes') or 0))
+            disc.last = event['time']
+        elif event['event'] == 'disc':
+            if event.get('drive'):
+                disc.drive = event['drive']
+            disc.done = event['time']
+            # The next rip into the same folder (e.g. the next disc of a
+            # set) is a new disc
+            del session.ripping[folder]
+    return sessions
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile of a list of numbers
+    values = sorted(values)
+    return values[max(-(-pct * len(values) // 100) - 1, 0)]
+
+
+def format_percentiles(values):
+    if not values:
+        return '-'
+    return ' / '.join('%.1f' % percentile(values, pct) for pct in percentiles)
+
+
+def format_throughput(tracks):
+    # Format the ripping speed (multiple of real time), MB/s and percentiles
+    # of secs per track, for a list of (wall secs, audio secs, bytes)
+    wall = sum(track[0] for track in tracks)
+    if not wall:
+        return '%6s %6s  %s' % ('-', '-', '-')
+    audio = sum(track[1] for track in tracks)
+    size = sum(track[2] for track in tracks)
+    return '%5.1fx %6.2f  %s' % (audio / wall, size / wall / 1e6,
+                                 format_percentiles([track[0] for track in tracks]))
+
+
+def report(sessions):
+    pct_label = '/'.join('p%d' % pct for pct in percentiles)
+    by_drive = {}
+    for session in sessions:
+        for disc in session.discs:
+            by_drive.setdefault(disc.drive, []).append(disc)
+
+    print('Ripping by drive (speed, MB/s, secs per track %s):' % pct_label)
+    for drive, discs in sorted(by_drive.items()):
+        tracks = [track for disc in discs for track in disc.tracks]
+        print('  %-40s %3d discs %4d tracks  %s' %
+              (drive, len(discs), sum(disc.track_count for disc in discs),
+               format_throughput(tracks)))
+
+    print('\nRipping by session (speed, MB/s, secs per track %s):' % pct_label)
+    for session in sessions:
+        tracks = [track for disc in session.discs for track in disc.tracks]
+        started = time.strftime('%Y-%m-%d %H:%M', time.localtime(session.start))
+        print('  %s  CD Ripper %-6s %-28s %3d discs %4d tracks  %s' %
+              (started, session.ripper_pid, ', '.join(session.drives())[:28],
+               len(session.discs), sum(disc.track_count for disc in session.discs),
+               format_throughput(tracks)))
+
+    print('\nChecks after each disc, by drive (secs %s):' % pct_label)
+    for drive, discs in sorted(by_drive.items()):
+        checks = [check for disc in discs for check in disc.checks]
+        if checks:
+            print('  %-40s %4d checks  waiting %s, checking %s, total %s' %
+                  (drive, len(checks), format_percentiles([check[0] for check in checks]),
+                   format_percentiles([check[1] for check in checks]),
+                   format_percentiles([sum(check) for check in checks])))
+
+
+def main():
+    parse_args()
+    try:
+        events = read_ledger(args.ledger)
+    except OSError as e:
+        print("Can't read the ledger: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    if args.since:
+        events = [event for event in events if event['time'] >= args.since]
+    report(build_sessions(events))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#! python3
+
+# Benchmark LogRippedTrack as CD Ripper runs it: from a fake CD Ripper
+# process (a link to the Python interpreter named cdgrab.exe), through a new
+# shell for every track, as cmd.exe is used on Windows.  Reports the time per
+# call for the first track of a disc (the slow path) and the rest (the fast
+# path).  Needs a POSIX shell and symlinks, so it doesn't run on Windows.
+#
+# The tests in test_log_ripped_track.py use run_tracks() from here too.
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'LogRippedTrack.py')
+
+# Run by the fake CD Ripper: run each call through sh, which doesn't exec
+# the command since it isn't the last one, and print the results as JSON
+driver = r'''
+import json, os, subprocess, sys, time
+results = []
+for args in json.loads(sys.argv[1]):
+    start = time.perf_counter()
+    proc = subprocess.run(['sh', '-c', '"$0" "$@"; status=$?; exit $status'] + args,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    results.append([time.perf_counter() - start, proc.returncode,
+                    proc.stdout.decode(), proc.stderr.decode()])
+print(json.dumps([os.getpid(), results]))
+'''
+
+
+def run_tracks(temp_dir, calls, python_args=()):
+    # Run LogRippedTrack once for each list of arguments in calls, from a new
+    # fake CD Ripper process, with temp_dir as the temp directory.  Returns
+    # the fake CD Ripper's PID, and a [secs, exit code, stdout, stderr] list
+    # for each call.
+    ripper = os.path.join(temp_dir, 'bin', 'cdgrab.exe')
+    if not os.path.exists(ripper):
+        os.makedirs(os.path.dirname(ripper), exist_ok=True)
+        os.symlink(os.path.realpath(sys.executable), ripper)
+    commands = [[sys.executable] + list(python_args) + [script] + list(args)
+                for args in calls]
+    env = dict(os.environ, TMPDIR=temp_dir, TEMP=temp_dir, TMP=temp_dir)
+    proc = subprocess.run([ripper, '-c', driver, json.dumps(commands)],
+                          stdout=subprocess.PIPE, env=env, check=True)
+    pid, results = json.loads(proc.stdout.decode())
+    return pid, results
+
+
+def main():
+    tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with tempfile.TemporaryDirectory() as temp_dir:
+        calls = [['Artist - Album.cue', os.path.join(temp_dir, 'Album')]] * tracks
+        pid, results = run_tracks(temp_dir, calls)
+    failed = [result for result in results if result[1]]
+    if failed:
+        sys.exit('LogRippedTrack failed: %s' % failed[0][2:])
+    secs = [result[0] * 1000 for result in results]
+    print('First track of the disc: %.1f ms' % secs[0])
+    print('Other %d tracks: median %.1f ms, max %.1f ms' %
+          (len(secs) - 1, statistics.median(secs[1:]), max(secs[1:])))
+
+if __name__ == '__main__':
+    main()
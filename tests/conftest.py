@@ -0,0 +1,7 @@
+# The scripts are flat modules at the top of the repo, not a package, so put
+# that directory on the path for the tests.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
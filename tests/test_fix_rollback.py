@@ -0,0 +1,74 @@
+# Tests for the rollback in CheckFlacTags.commit_track_fixes, when a file
+# can't be updated partway through fixing an album.  Plain files stand in for
+# the FLAC files, since only their bytes are written.
+
+import io
+import os
+
+import pytest
+
+import CheckFlacTags
+
+
+class FailingFile(io.FileIO):
+    # A file that writes only half of the next write, then fails
+    def write(self, data):
+        io.FileIO.write(self, data[:len(data) // 2])
+        raise OSError(28, 'No space left on device')
+
+
+@pytest.fixture
+def tracks(tmp_path):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / ('%02d.flac' % (i + 1))))
+        with open(paths[-1], 'wb') as f:
+            f.write(b'fLaC old header %d' % i + bytes(100))
+    return paths
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def fail_writes(monkeypatch, fail):
+    # Make CheckFlacTags' open() return a FailingFile for the calls where
+    # fail(path) is true
+    def fake_open(path, mode='r', *args, **kwargs):
+        if fail(path):
+            return FailingFile(path, mode.replace('b', ''))
+        return open(path, mode, *args, **kwargs)
+    monkeypatch.setattr(CheckFlacTags, 'open', fake_open, raising=False)
+
+
+def test_partial_header_write_restored(tracks, monkeypatch):
+    before = [read(path) for path in tracks]
+    fail_writes(monkeypatch, lambda path: path == tracks[1])
+    staged = [(path, ('header', b'fLaC new header %d' % i)) for i, path in enumerate(tracks)]
+    with pytest.raises(OSError):
+        CheckFlacTags.commit_track_fixes(staged)
+    assert [read(path) for path in tracks] == before
+
+
+def test_failed_restore_does_not_stop_others(tracks, tmp_path, monkeypatch, capsys):
+    # The copy of the last track is missing, so the fixes fail there.  Then
+    # the second track can't be restored, but the first still is, and the
+    # error that stopped the fixes is the one raised.
+    before = [read(path) for path in tracks]
+    opens = []
+
+    def fail(path):
+        opens.append(path)
+        return path == tracks[1] and opens.count(path) == 2
+
+    fail_writes(monkeypatch, fail)
+    staged = [(tracks[0], ('header', b'fLaC new header 0')),
+              (tracks[1], ('header', b'fLaC new header 1')),
+              (tracks[2], ('copy', str(tmp_path / 'missing.tmp')))]
+    with pytest.raises(FileNotFoundError):
+        CheckFlacTags.commit_track_fixes(staged)
+    assert read(tracks[0]) == before[0]
+    assert read(tracks[2]) == before[2]
+    assert not os.path.exists(tracks[2] + '.fixbak')
+    assert "Unable to restore '%s'" % tracks[1] in capsys.readouterr().out
@@ -0,0 +1,104 @@
+# Tests for FlacFrames.  The FLAC files are encoded with libFLAC through
+# soundfile, so these are skipped if numpy or soundfile isn't installed.
+
+import hashlib
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+soundfile = pytest.importorskip('soundfile')
+
+import FlacFrames
+from CommonUtils import FlacHeader
+
+rate = 44100
+
+
+def fake_header(block_code, size_code, number):
+    # Bytes of a frame header for a stereo 44.1 kHz frame, with a valid CRC-8
+    header = bytes([0xff, 0xf8, (block_code << 4) | 9, (1 << 4) | (size_code << 1), number])
+    return header + bytes([FlacFrames.crc8(header)])
+
+
+def write_noise(path, level, hidden=None):
+    # Write 20 secs of 16-bit stereo noise, which libFLAC stores verbatim.
+    # If hidden is given, those bytes are written into the samples of frame
+    # 40, so they appear as is inside its audio data.  Returns the bytes of
+    # the file.
+    soundfile.write(str(path), numpy.zeros((rate, 2), numpy.int16), rate,
+                    subtype='PCM_16', compression_level=level)
+    blocksize = FlacHeader(str(path)).streaminfo.max_blocksize
+    noise = numpy.random.default_rng(1).integers(-32768, 32768, size=(20 * rate, 2),
+                                                 dtype=numpy.int16)
+    if hidden:
+        start = 40 * blocksize + 100
+        noise[start:start + len(hidden) // 2, 0] = numpy.frombuffer(hidden, dtype='>i2')
+    soundfile.write(str(path), noise, rate, subtype='PCM_16', compression_level=level)
+    with open(str(path), 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('level', [0.0, 1.0])
+@pytest.mark.parametrize('kind', ['8-bit', 'consistent'])
+def test_sync_code_in_audio_data(tmp_path, level, kind):
+    # A sync code inside the audio data whose header passes CRC-8 and
+    # continues the frame numbers within max_frame_gap is not a frame: one
+    # that disagrees with STREAMINFO is rejected outright, one that agrees
+    # is rejected because frame 40 doesn't end there and frame 41 follows.
+    path = tmp_path / 'noise.flac'
+    write_noise(path, level)
+    block_code = {1152: 3, 4096: 12}[FlacHeader(str(path)).streaminfo.max_blocksize]
+    if kind == '8-bit':
+        hidden = fake_header(10, 1, 85)
+    else:
+        hidden = fake_header(block_code, 4, 85)
+    data = write_noise(path, level, hidden)
+    assert data.find(hidden) > 0
+    assert FlacFrames.verify_frames(str(path)) == []
+    problems, peak = FlacFrames.verify_audio(str(path))
+    assert problems == []
+    assert peak == 1.0
+
+
+def test_damage_still_found(tmp_path):
+    path = tmp_path / 'noise.flac'
+    data = write_noise(path, 1.0, fake_header(12, 4, 85))
+    header = FlacHeader(str(path))
+    frames, gaps = FlacFrames.find_frames(data, header.audio_offset, header.streaminfo)
+    assert gaps == []
+
+    flipped = bytearray(data)
+    flipped[frames[50].pos + 300] ^= 0x55
+    path.write_bytes(bytes(flipped))
+    assert FlacFrames.verify_frames(str(path)) == ['1 frame fails CRC-16 check: 50']
+
+    path.write_bytes(data[:frames[50].pos] + data[frames[53].pos:])
+    problems = FlacFrames.verify_frames(str(path))
+    assert problems[0] == ('Frames missing or damaged at offset %d (expected frame 50, '
+                           'found 53)' % frames[50].pos)
+    assert len(problems) == 2
+
+
+@pytest.mark.parametrize('level', [0.0, 0.5, 1.0])
+@pytest.mark.parametrize('channels', [1, 2])
+@pytest.mark.parametrize('subtype, bits', [('PCM_S8', 8), ('PCM_16', 16), ('PCM_24', 24)])
+def test_decode_matches_soundfile(tmp_path, subtype, bits, channels, level):
+    # Music-like audio (a tone, plus quieter noise that differs a little
+    # between the channels), so the encoder uses fixed and LPC predictors and
+    # the stereo decorrelation modes.  The MD5 and peak from decoding must
+    # match libFLAC's decoding of the same file.
+    path = str(tmp_path / 'tone.flac')
+    rng = numpy.random.default_rng(bits * 10 + channels)
+    t = numpy.arange(3 * rate) / rate
+    tone = 0.6 * numpy.sin(2 * numpy.pi * 440 * t) * numpy.linspace(0.2, 1, len(t))
+    audio = numpy.stack([tone + 0.05 * rng.standard_normal(len(t)) * (1 + ch)
+                         for ch in range(channels)], axis=1)
+    soundfile.write(path, numpy.clip(audio, -1, 1), rate, subtype=subtype,
+                    compression_level=level)
+    samples = soundfile.read(path, dtype='int32', always_2d=True)[0] >> (32 - bits)
+    pcm = samples.astype('<i4').view(numpy.uint8).reshape(-1, 4)[:, :(bits + 7) // 8]
+    md5 = hashlib.md5(pcm.tobytes()).digest()
+    assert md5 == FlacHeader(path).streaminfo.md5
+    problems, peak = FlacFrames.verify_audio(path)
+    assert problems == []
+    assert peak == numpy.abs(samples).max() / (1 << (bits - 1))
@@ -0,0 +1,63 @@
+# Tests for the LogRippedTrack fast path, run from a fake CD Ripper process.
+# Skipped where the benchmark's fake CD Ripper can't run, or psutil isn't
+# installed.
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('psutil')
+if sys.platform == 'win32' or not os.path.isdir('/proc'):
+    pytest.skip('needs /proc, a POSIX shell and symlinks', allow_module_level=True)
+
+from bench_log_ripped_track import run_tracks
+
+
+def uses_psutil(result):
+    # Whether a call run with -X importtime imported psutil
+    return ' psutil\n' in result[3]
+
+
+def read(path):
+    with open(path, encoding='UTF-8') as f:
+        return f.read()
+
+
+def test_fast_path_after_first_track(tmp_path):
+    temp_dir = str(tmp_path)
+    disc1 = ['Artist - Album (Disc 1).cue', '"D:\\CDRip\\Album\\"']
+    disc2 = ['Artist - Album (Disc 2).cue', '"D:\\CDRip\\Album\\"']
+    pid, results = run_tracks(temp_dir, [disc1] * 3 + [disc2] * 2, ['-X', 'importtime'])
+    assert [result[1] for result in results] == [0] * 5
+    assert [uses_psutil(result) for result in results] == [True, False, False, True, False]
+    assert read(os.path.join(temp_dir, 'LastRipped-%d.txt' % pid)) == '%s\n%s\n' % tuple(disc2)
+
+
+def test_restarted_ripper_gets_its_own_file(tmp_path):
+    # Re-ripping the same disc from a new CD Ripper instance must not reuse
+    # the key file of the earlier one, which has exited
+    temp_dir = str(tmp_path)
+    disc = ['Artist - Album.cue', 'D:\\CDRip\\Album']
+    first_pid, results = run_tracks(temp_dir, [disc] * 2)
+    pid, results = run_tracks(temp_dir, [disc] * 3, ['-X', 'importtime'])
+    assert pid != first_pid
+    assert [uses_psutil(result) for result in results] == [True, False, False]
+    assert read(os.path.join(temp_dir, 'LastRipped-%d.txt' % pid)) == '%s\n%s\n' % tuple(disc)
+
+
+def test_dead_pid_in_key_file(tmp_path):
+    # A key file naming a PID whose start time doesn't match is ignored
+    temp_dir = str(tmp_path)
+    disc = ['Artist - Album.cue', 'D:\\CDRip\\Album']
+    pid, results = run_tracks(temp_dir, [disc])
+    key_files = [name for name in os.listdir(temp_dir) if name.startswith('LastRipped-key-')]
+    assert len(key_files) == 1
+    key_path = os.path.join(temp_dir, key_files[0])
+    key_pid, start = read(key_path).split()
+    assert int(key_pid) == pid
+    with open(key_path, 'w') as f:
+        f.write('%d %d' % (os.getpid(), int(start) + 1))
+    pid, results = run_tracks(temp_dir, [disc], ['-X', 'importtime'])
+    assert uses_psutil(results[0])
+    assert read(key_path).split()[0] == str(pid)
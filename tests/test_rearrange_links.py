@@ -0,0 +1,128 @@
+# Tests for RearrangeAudioFiles --link on loopback filesystems: reflinks on
+# btrfs and xfs, and the fallback to a normal copy where a link can't be made.
+# Each filesystem is skipped unless it can be made and mounted here (root,
+# its mkfs tool, and kernel support).
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+if sys.platform != 'linux':
+    pytest.skip('needs Linux loop mounts', allow_module_level=True)
+
+import RearrangeAudioFiles
+
+image_sizes = {'btrfs': 128, 'xfs': 320, 'ext4': 16}    # MiB, near each minimum
+
+
+def kernel_filesystems():
+    with open('/proc/filesystems') as f:
+        return {line.split()[-1] for line in f if line.strip()}
+
+
+@pytest.fixture
+def mount(tmp_path):
+    # Return a function that makes and mounts a loopback filesystem, and
+    # unmount them all afterwards
+    mounted = []
+
+    def mount(fs):
+        if os.geteuid() != 0:
+            pytest.skip('mounting needs root')
+        if not shutil.which('mkfs.' + fs):
+            pytest.skip('mkfs.%s not found' % fs)
+        if fs not in kernel_filesystems():
+            pytest.skip('%s not supported by the kernel' % fs)
+        image = tmp_path / (fs + '.img')
+        with open(image, 'wb') as f:
+            f.truncate(image_sizes[fs] << 20)
+        subprocess.run(['mkfs.' + fs, '-q', str(image)], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        path = tmp_path / fs
+        path.mkdir()
+        result = subprocess.run(['mount', '-o', 'loop', str(image), str(path)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode:
+            pytest.skip('unable to mount %s: %s' % (fs, result.stderr.decode().strip()))
+        mounted.append(path)
+        return path
+
+    yield mount
+    for path in reversed(mounted):
+        subprocess.run(['umount', str(path)], check=True)
+
+
+@pytest.fixture
+def rearrange(monkeypatch):
+    # Reset the script's globals for a run with the given --link option
+    def rearrange(link):
+        monkeypatch.setattr(RearrangeAudioFiles, 'args', argparse.Namespace(link=link))
+        monkeypatch.setattr(RearrangeAudioFiles, 'link_failed', set())
+        monkeypatch.setattr(RearrangeAudioFiles, 'copied_bytes', 0)
+        monkeypatch.setattr(RearrangeAudioFiles, 'copy_seconds', 0)
+        return RearrangeAudioFiles
+    return rearrange
+
+
+def write_files(path, count, size=100000):
+    paths = []
+    for i in range(count):
+        paths.append(path / ('%02d.flac' % (i + 1)))
+        paths[-1].write_bytes(os.urandom(size))
+    return paths
+
+
+@pytest.mark.parametrize('fs', ['btrfs', 'xfs'])
+def test_reflink(mount, rearrange, capsys, fs):
+    path = mount(fs)
+    (path / 'new').mkdir()
+    script = rearrange('reflink')
+    for old_path in write_files(path, 2):
+        new_path = path / 'new' / old_path.name
+        script.copy_file(str(old_path), str(new_path))
+        assert new_path.read_bytes() == old_path.read_bytes()
+    assert script.copied_bytes == 0
+    assert not script.link_failed
+    assert 'Warning' not in capsys.readouterr().out
+
+
+def test_reflink_falls_back_on_ext4(mount, rearrange, capsys):
+    path = mount('ext4')
+    (path / 'new').mkdir()
+    script = rearrange('reflink')
+    old_paths = write_files(path, 3)
+    for old_path in old_paths:
+        new_path = path / 'new' / old_path.name
+        script.copy_file(str(old_path), str(new_path))
+        assert new_path.read_bytes() == old_path.read_bytes()
+    assert script.copied_bytes == sum(p.stat().st_size for p in old_paths)
+    assert script.link_failed == {(path.stat().st_dev, path.stat().st_dev)}
+    # Warned once, not for every file
+    assert capsys.readouterr().out.count('Warning: Unable to create reflink') == 1
+
+
+def test_fallback_is_per_device_pair(mount, tmp_path, rearrange, capsys):
+    # A hard link across filesystems fails, but links within either of them
+    # are still made afterwards
+    other = mount('ext4')
+    (other / 'new').mkdir()
+    (tmp_path / 'new').mkdir()
+    script = rearrange('hard')
+    old_paths = write_files(tmp_path, 3)
+    script.copy_file(str(old_paths[0]), str(other / 'new' / old_paths[0].name))
+    assert (other / 'new' / old_paths[0].name).stat().st_nlink == 1
+    assert script.copied_bytes == old_paths[0].stat().st_size
+    assert 'Warning: Unable to create hard link' in capsys.readouterr().out
+
+    script.copy_file(str(old_paths[1]), str(tmp_path / 'new' / old_paths[1].name))
+    assert old_paths[1].stat().st_nlink == 2
+    local_path = other / old_paths[2].name
+    shutil.copy(old_paths[2], local_path)
+    script.copy_file(str(local_path), str(other / 'new' / local_path.name))
+    assert local_path.stat().st_nlink == 2
+    assert script.copied_bytes == old_paths[0].stat().st_size
+    assert 'Warning' not in capsys.readouterr().out
@@ -0,0 +1,37 @@
+# Tests for RearrangeAudioFiles --sync matching stale destination files to
+# source files by their STREAMINFO block.
+
+import argparse
+from collections import OrderedDict
+import types
+
+import RearrangeAudioFiles
+
+
+def flac_without_streaminfo():
+    # A FLAC file whose only metadata block is a VORBIS_COMMENT
+    data = b'vendor'
+    return b'fLaC' + bytes([0x80 | 4]) + len(data).to_bytes(3, 'big') + data + bytes(50)
+
+
+def test_sync_without_streaminfo(tmp_path, monkeypatch, capsys):
+    # Neither a stale file without STREAMINFO, nor a source file that isn't
+    # FLAC or can't be read, is matched; the source files are just copied
+    monkeypatch.setattr(RearrangeAudioFiles, 'args', argparse.Namespace(
+        verbose=0, dry_run=False, link=None))
+    source = tmp_path / 'source'
+    dest = tmp_path / 'dest'
+    source.mkdir()
+    dest.mkdir()
+    (source / '01.flac').write_bytes(b'fLaC' + bytes([0x80, 0, 0, 34]))    # Truncated
+    (source / 'folder.jpg').write_bytes(b'\xff\xd8 cover')
+    (dest / 'old.flac').write_bytes(flac_without_streaminfo())
+    album = types.SimpleNamespace(
+        path=str(source), new_path=str(dest),
+        old_files=OrderedDict([('01.flac', '01 Title.flac'), ('folder.jpg', 'folder.jpg')]))
+    album.new_files = {new: old for old, new in album.old_files.items()}
+    RearrangeAudioFiles.do_sync(album)
+    for old, new in album.old_files.items():
+        assert (dest / new).read_bytes() == (source / old).read_bytes()
+    assert (dest / 'old.flac').read_bytes() == flac_without_streaminfo()
+    assert 'not found in the source:\n  old.flac' in capsys.readouterr().out